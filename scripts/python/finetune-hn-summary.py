@@ -13,26 +13,50 @@ summarizing Hacker News comments. The script:
 The original training data comes from summaries generated by top models like GPT-4,
 Claude and similar high-end models. We fine-tune smaller models on this data to get
 improved performance while reducing costs.
+
+Subcommands (each one imports only the libraries it needs, so data preparation and profiling start without
+importing torch, Unsloth, trl or wandb, and without probing the GPU):
+    prepare-data  load, deduplicate and tokenize the training data into the on-disk caches
+    profile       token lengths and predicted training memory of every post (see hn_length_profile.py)
+    train         train (or --sweep) with a config (see hn_train_config.py)
+    evaluate      summarize the validation/test posts and report speed and quality metrics (see hn_eval.py)
+    export        export the LoRA model of the latest checkpoint of the run to GGUF
+    serve         start the Ollama server and create the Ollama model
+
+Usage:
+    python finetune-hn-summary.py prepare-data --config configs/train.toml
+    python finetune-hn-summary.py train --config configs/train.toml
 """
 
+import argparse
 import os
-import subprocess
-import time
+import sys
 from dotenv import load_dotenv
-from unsloth import FastLanguageModel
-from unsloth import is_bfloat16_supported
-from datasets import load_dataset
-from trl import SFTTrainer
-from transformers import TrainingArguments, TextStreamer
-import wandb
+from hn_train_config import (DEFAULT_CONFIG, config_dtype, config_revision, load_train_config, run_output_dir,
+                             training_arguments_config)
 
 # Load environment variables
 load_dotenv()
 
 
-def initialize_model(base_model_name, max_seq_length):
-    """Initialize the base model and tokenizer"""
-    print(f"\nInitializing base model: {base_model_name} with max_seq_length: {max_seq_length}\n")
+def initialize_model(base_model_name, max_seq_length, load_in_4bit=True, dtype=None, backend="unsloth"):
+    """
+    Initialize the base model and tokenizer.
+    dtype None is auto detection. load_in_4bit uses 4bit quantization to reduce memory usage.
+    The "tiny" backend is a tiny random Llama model with a synthetic tokenizer, for CPU runs (see hn_train_config.py).
+    """
+    print(f"\nInitializing base model: {base_model_name} with max_seq_length: {max_seq_length}, backend: {backend}\n")
+
+    if backend == "tiny":
+        from hn_packing import make_tiny_model
+        from hn_synthetic import make_synthetic_tokenizer
+
+        tokenizer = make_synthetic_tokenizer()
+        base_model = make_tiny_model(len(tokenizer))
+        return base_model, tokenizer
+
+    # Unsloth needs a GPU, so it is only imported when it is used
+    from unsloth import FastLanguageModel
 
     fourbit_models = [
         "unsloth/mistral-7b-v0.3-bnb-4bit",  # New Mistral v3 2x faster!
@@ -47,9 +71,9 @@ def initialize_model(base_model_name, max_seq_length):
         "unsloth/DeepSeek-R1-Distill-Llama-8B-unsloth-bnb-4bit"
     ]  # More models at https://huggingface.co/unsloth
 
-    # Model initialization parameters
-    dtype = None  # None for auto detection
-    load_in_4bit = True  # Use 4bit quantization to reduce memory usage
+    if isinstance(dtype, str):
+        import torch
+        dtype = getattr(torch, dtype)
 
     # Initialize base model and tokenizer
     base_model, tokenizer = FastLanguageModel.from_pretrained(
@@ -63,23 +87,33 @@ def initialize_model(base_model_name, max_seq_length):
     return base_model, tokenizer
 
 
-def setup_lora_adapter(base_model):
-    """Set up LoRA adapters for efficient fine-tuning"""
+def setup_lora_adapter(base_model, r=16, lora_alpha=16, lora_dropout=0, target_modules=None,
+                       use_gradient_checkpointing="unsloth", random_state=3407, backend="unsloth"):
+    """Set up LoRA adapters for efficient fine-tuning. r is the rank of the fine-tuning process."""
+
+    print(f"\nSetting up LoRA adapter with r: {r}...")
+    if target_modules is None:
+        target_modules = DEFAULT_CONFIG['lora']['target_modules']
+
+    if backend == "tiny":
+        from peft import LoraConfig, get_peft_model
+
+        lora_config = LoraConfig(r=r, lora_alpha=lora_alpha, lora_dropout=lora_dropout,
+                                 target_modules=target_modules, bias="none", task_type="CAUSAL_LM")
+        return get_peft_model(base_model, lora_config)
+
+    from unsloth import FastLanguageModel
 
-    print(f"\nSetting up LoRA adapter...")
     # Ann: change r from 8 to 16
     lora_model = FastLanguageModel.get_peft_model(
         base_model,
-        r=16,  # Rank of the fine-tuning process
-        target_modules=[
-            "q_proj", "k_proj", "v_proj", "o_proj",
-            "gate_proj", "up_proj", "down_proj",
-        ],
-        lora_alpha=16,
-        lora_dropout=0,
+        r=r,
+        target_modules=target_modules,
+        lora_alpha=lora_alpha,
+        lora_dropout=lora_dropout,
         bias="none",
-        use_gradient_checkpointing="unsloth",
-        random_state=3407,
+        use_gradient_checkpointing=use_gradient_checkpointing,
+        random_state=random_state,
         use_rslora=False,
         loftq_config=None,
     )
@@ -88,14 +122,35 @@ def setup_lora_adapter(base_model):
     return lora_model
 
 
-def load_training_data(dataset_id="annjose/hn-comments-small", hf_token=None):
-    """Load the training dataset from HuggingFace"""
+def load_tokenizer(config):
+    """
+    Only the tokenizer of the model, for the data subcommands. It's the same tokenizer as the one loaded with the
+    model, so the cached data prepared with it is used by training. PreTrainedTokenizerFast is imported directly
+    instead of AutoTokenizer, which imports torch and the model classes.
+    """
+    if config['model']['backend'] == "tiny":
+        from hn_synthetic import make_synthetic_tokenizer
+
+        return make_synthetic_tokenizer()
+
+    from transformers import PreTrainedTokenizerFast
+
+    return PreTrainedTokenizerFast.from_pretrained(config['model']['base_model_name'])
+
+
+def load_training_data(dataset_id="annjose/hn-comments-small", hf_token=None, exclude_ids=None, revision=None,
+                       offline=None):
+    """Load the training dataset from HuggingFace (through the local dataset cache)"""
+    from hn_dataset_cache import load_cached_dataset
+    from hn_post_index import exclude_posts
 
     print(f"\nLoading training data from {dataset_id}")
-    # Load dataset splits
-    train_dataset = load_dataset(dataset_id, split="train", token=hf_token)
-    val_dataset = load_dataset(dataset_id, split="validation", token=hf_token)
-    test_dataset = load_dataset(dataset_id, split="test", token=hf_token)
+    # Load all dataset splits at once. The dataset is resolved once and cached as memory-mapped Arrow files,
+    #  so later runs (or offline runs, with HF_HUB_OFFLINE=1) don't go to the Hub again.
+    dataset_dict = load_cached_dataset(dataset_id, revision=revision, offline=offline, token=hf_token)
+    train_dataset = dataset_dict["train"]
+    val_dataset = dataset_dict["validation"]
+    test_dataset = dataset_dict["test"]
 
     # ...item[0]: post id: 42803774, comment length: 6762, summary length: 4460
     # ...item[1]: post id: 42931109, comment length: 5864, summary length: 3380
@@ -105,16 +160,20 @@ def load_training_data(dataset_id="annjose/hn-comments-small", hf_token=None):
     # ...item[5]: post id: 42681762, comment length: 8109, summary length: 4158
 
     # in the smaller dataset, exclude two posts with 3000+ token length
+    #  These were found by trial and error. To find the posts that don't fit in memory without a training attempt,
+    #  use find_memory_outliers() from hn_length_profile.py and pass the result as exclude_ids.
     # exclude_ids = ['42889786', '42901616'] # training works fine - starts and ends in ~ 180 seconds
-    exclude_ids = ['42803774', '42931109'] # training works fine - starts and ends in ~ 180 seconds => doesn't matter which posts we choose.
+    # exclude_ids = ['42803774', '42931109'] # training works fine - starts and ends in ~ 180 seconds => doesn't matter which posts we choose.
     # exclude_ids = ['42803774', '42931109', '42901616'] # training works fine - starts and ends in ~ 180 seconds => doesn't matter which posts we choose.
     # exclude_ids = ['42803774'] # training does NOT start, it stalls at 0 epoch. starts and ends in 180 seconds => if there are more than 4 posts, it stalls.
     # exclude_ids = ['42889786']   # training does NOT start, even with truncating to 2000 chars, max_seq_length = 4096, 8192
     # exclude_ids = ['42901616']   # training does NOT start, even with truncating to 2000 chars, max_seq_length = 4096, 8192
     # exclude_ids = []
+    if exclude_ids is None:
+        exclude_ids = ['42803774', '42931109']
 
-    # Filter the dataset to keep only rows where post_id is not in exclude_ids
-    train_filtered_dataset = train_dataset.filter(lambda x: x['post_id'] not in exclude_ids)
+    # Keep only rows where post_id is not in exclude_ids (row lookup through the post_id index, no full scan)
+    train_filtered_dataset = exclude_posts(train_dataset, exclude_ids)
 
     print(f"Dataset Size: Train: {len(train_filtered_dataset)}, Validation: {len(val_dataset)}, Test: {len(test_dataset)}")
     return train_filtered_dataset, val_dataset, test_dataset
@@ -122,23 +181,13 @@ def load_training_data(dataset_id="annjose/hn-comments-small", hf_token=None):
 
 def format_training_data(dataset, tokenizer, truncate, max_char_length=4000):
     """Format the dataset according to model's template"""
-    print(f"\nFormatting training data with truncate: {truncate}, max_char_length: {max_char_length}...")
-
-    # Define prompts and templates
-    system_prompt = """You are an AI assistant specialized in analyzing and summarizing Hacker News discussions.
-A discussion consists of threaded comments where each comment can have child comments (replies) nested underneath it,
-forming interconnected conversation branches. Your task is to provide concise, meaningful summaries that capture the
-essence of the discussion while prioritizing engaging and high quality content."""
+    from hn_prompts import SYSTEM_PROMPT, format_prompt
+    from hn_thread import select_thread
 
-    user_prompt_prefix = "This is your input:\n The title of the post and comments are separated by dashed lines."
-
-    llama_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
-
-{SYSTEM}<|eot_id|><|start_header_id|>user<|end_header_id|>
-
-{INPUT}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    print(f"\nFormatting training data with truncate: {truncate}, max_char_length: {max_char_length}...")
 
-{OUTPUT}<|eot_id|>"""
+    # Prompts and template are defined in hn_prompts.py
+    system_prompt = SYSTEM_PROMPT
 
     def format_prompts_func(examples):
         try:
@@ -157,18 +206,14 @@ essence of the discussion while prioritizing engaging and high quality content."
                 if truncate:
                     print(f"\tTruncating: Original Text length: system_prompt: {len(system_prompt)}. comment: {len(comment)}. summary: {len(summary)}")
 
-                    # Truncate comment and summary if they exceed max_chars
-                    comment = comment[:max_char_length] if len(comment) > max_char_length else comment
+                    # Reduce the comments to max_chars by keeping the highest scored whole subtrees of the thread
+                    #  (see hn_thread.py), instead of cutting the text in the middle of a comment.
+                    comment = select_thread(comment, max_char_length, lambda texts: [len(text) for text in texts])
                     summary = summary[:max_char_length] if len(summary) > max_char_length else summary
 
                 print(f"\tText length: system_prompt: {len(system_prompt)}. comment: {len(comment)}. summary: {len(summary)}")
 
-                user_prompt = f"{user_prompt_prefix}\n{comment}"
-                formatted_text = llama_template.format(
-                    SYSTEM=system_prompt,
-                    INPUT=user_prompt,
-                    OUTPUT=summary
-                ) + tokenizer.eos_token
+                formatted_text = format_prompt(comment, summary, system_prompt) + tokenizer.eos_token
 
                 formatted_texts.append(formatted_text)
 
@@ -184,116 +229,535 @@ essence of the discussion while prioritizing engaging and high quality content."
     return formatted_dataset
 
 
-def setup_trainer(lora_model, tokenizer, dataset, run_name, max_seq_length):
-    """Set up the SFT trainer with training arguments"""
-    print(f"\nSetting up trainer...")
+def setup_trainer(lora_model, tokenizer, dataset, run_name, max_seq_length, packing=False, use_wandb=True,
+                  profile_path="outputs/train_profile.jsonl", training_config=None, block_diagonal_mask=False,
+                  backend="unsloth"):
+    """
+    Set up the SFT trainer with training arguments.
+    training_config has the TrainingArguments that differ from the trainer section of DEFAULT_CONFIG.
+    The phase times, tokens and memory of every step are written to profile_path (see hn_train_profiler.py),
+    with or without wandb. On SIGTERM, a checkpoint is saved and training stops (see hn_checkpoint.py).
+    """
+    import torch
+    from datasets import IterableDataset
+    from transformers import DataCollatorForLanguageModeling, TrainingArguments
+
+    from hn_checkpoint import PreemptionCallback
+    from hn_packing import PackedDataCollator, pack_dataset, pack_iterable_dataset
+    from hn_train_profiler import TrainingProfilerCallback
+
+    print(f"\nSetting up trainer with packing: {packing}...")
+    training_config = {**training_arguments_config(DEFAULT_CONFIG), **(training_config or {})}
+
+    if use_wandb:
+        import wandb
+
+        run = wandb.init(
+            project='HN-Summarize FineTune DeepSeek-R1-Distill-Llama-8B using HN Comments Data',
+            name=run_name,
+        )
+
+    # A dataset from tokenize_training_data() already has input_ids. Tell SFTTrainer to use it as is instead of
+    #  tokenizing the text again, and pad the batches with the LM collator.
+    #  A streamed dataset (see hn_streaming.py) is always tokenized, and is packed within windows of examples.
+    is_streaming = isinstance(dataset, IterableDataset)
+    is_tokenized = is_streaming or "input_ids" in dataset.column_names
+    data_collator = None
+    if is_streaming and packing:
+        dataset = pack_iterable_dataset(dataset, max_seq_length).select_columns(["input_ids", "seq_lengths"])
+        data_collator = PackedDataCollator(tokenizer.pad_token_id, block_diagonal_mask=block_diagonal_mask)
+    elif is_tokenized and packing:
+        # Pack the examples into rows of max_seq_length tokens (see hn_packing.py). Each row is a full batch of
+        #  tokens, so one row per device batch is usually best. The seq_lengths column is needed by the collator,
+        #  so don't let the trainer remove it. The block diagonal mask is needed without flash attention (eg. on CPU).
+        dataset = pack_dataset(dataset, max_seq_length).select_columns(["input_ids", "seq_lengths"])
+        data_collator = PackedDataCollator(tokenizer.pad_token_id, block_diagonal_mask=block_diagonal_mask)
+    elif is_tokenized:
+        dataset = dataset.select_columns(["input_ids", "attention_mask"])
+        data_collator = DataCollatorForLanguageModeling(tokenizer, mlm=False)
+    elif packing:
+        raise ValueError("Packing needs a dataset from tokenize_training_data()")
+
+    profiler = TrainingProfilerCallback(profile_path, run_name, run_config={
+        'max_seq_length': max_seq_length,
+        'packing': packing,
+        'per_device_train_batch_size': training_config['per_device_train_batch_size'],
+        'gradient_accumulation_steps': training_config['gradient_accumulation_steps'],
+    })
 
-    wandb.login()
+    callbacks = [profiler, PreemptionCallback()]
 
-    run = wandb.init(
-        project='HN-Summarize FineTune DeepSeek-R1-Distill-Llama-8B using HN Comments Data',
-        name=run_name,
+    bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    training_args = TrainingArguments(
+        **training_config,
+        fp16=torch.cuda.is_available() and not bf16,
+        bf16=bf16,
+        report_to="wandb" if use_wandb else "none",
+        run_name=run_name,
+        remove_unused_columns=not packing,
     )
 
+    if backend == "tiny":
+        # The data is already tokenized, so the plain Trainer is enough (and trl is not needed on CPU)
+        from transformers import Trainer
+
+        if not is_tokenized:
+            raise ValueError("The tiny backend needs a dataset from tokenize_training_data()")
+        return Trainer(model=lora_model, train_dataset=dataset, data_collator=data_collator, callbacks=callbacks,
+                       args=training_args)
+
+    from trl import SFTTrainer
+
     trainer = SFTTrainer(
         model=lora_model,
         tokenizer=tokenizer,
         train_dataset=dataset,
-        dataset_text_field="text",
+        dataset_text_field=None if is_tokenized else "text",
+        dataset_kwargs={"skip_prepare_dataset": True} if is_tokenized else None,
+        data_collator=data_collator,
         max_seq_length=max_seq_length,
         dataset_num_proc=2,
         packing=False,
-        args=TrainingArguments(
-            per_device_train_batch_size=2,
-            gradient_accumulation_steps=4,
-            warmup_steps=5,
-            max_steps=60,
-            learning_rate=2e-4,
-            fp16=not is_bfloat16_supported(),
-            bf16=is_bfloat16_supported(),
-            logging_steps=1,
-            optim="adamw_8bit",
-            weight_decay=0.01,
-            lr_scheduler_type="linear",
-            seed=3407,
-            output_dir="outputs",
-            report_to="wandb",
-            run_name=run_name,
-        ),
+        callbacks=callbacks,
+        args=training_args,
     )
     return trainer
 
 
-def export_model(model, tokenizer, output_dir="model"):
-    """Export the model to GGUF format"""
+def load_trained_model(checkpoint_dir, max_seq_length, load_in_4bit=True, dtype=None):
+    """Load the base model with the LoRA adapter of a checkpoint"""
+    from unsloth import FastLanguageModel
 
-    print("\nExporting model to GGUF format...")
-    model.save_pretrained_gguf(output_dir, tokenizer)
-    print(f"Model exported to GGUF format in {output_dir}")
+    print(f"\nLoading trained model from checkpoint: {checkpoint_dir}")
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        model_name=checkpoint_dir,
+        max_seq_length=max_seq_length,
+        dtype=dtype,
+        load_in_4bit=load_in_4bit
+    )
+    return model, tokenizer
 
-def setup_ollama():
-    """Initialize Ollama server"""
-    print("\nStarting Ollama server...")
 
-    # Start Ollama server
-    subprocess.Popen(["ollama", "serve"])
-    time.sleep(3)  # Wait for server to start
+def export_model(model, tokenizer, output_dir="model", quantizations=("q8_0",), num_ctx=8192):
+    """
+    Export the model to GGUF format, one file per quantization method, each with its Ollama Modelfile
+    (see hn_gguf.py). Returns {quantization: GGUF path}.
+    """
+    from hn_gguf import export_gguf_variants, write_modelfile
 
-    # Create Ollama model
-    # Make sure that the Modelfile has the full path to the location FROM /home/george/work/unsloth/model/unsloth.Q8_0.gguf
-    # run directly with this command:
-    #      ollama create hn-finetune-model -f ./model/Modelfile
-    subprocess.run(["ollama", "create", "hn-finetune-text-trunc-2medium", "-f", "./model/Modelfile"])
-    print("Ollama model created.")
+    gguf_files = export_gguf_variants(model, tokenizer, output_dir, quantizations)
+    for gguf_path in gguf_files.values():
+        print(f"...Modelfile: {write_modelfile(gguf_path, num_ctx)}")
+    print(f"Model exported to GGUF format in {output_dir}")
+    return gguf_files
+
+def setup_ollama(model_name="hn-finetune-text-trunc-2medium", modelfile="./model/unsloth.Q8_0.Modelfile", host=None):
+    """
+    Start the Ollama server (or reuse the running one) and create the model, unless it's already up to date.
+    Returns the OllamaServer; stop() stops the server if it was started here (see hn_ollama.py).
+    """
+    from hn_ollama import OllamaServer
+
+    # The FROM line of the Modelfile is the GGUF file, eg. FROM ./unsloth.Q8_0.gguf (relative to the Modelfile)
+    server = OllamaServer(host).start()
+    try:
+        server.ensure_model(model_name, modelfile)
+    except Exception:
+        server.stop()
+        raise
+    return server
+
+def prepare_training_data(config, tokenizer, hf_token=None):
+    """
+    Load the train split (or synthetic posts), remove duplicates and memory outliers, and tokenize it.
+    With data.streaming, returns an IterableDataset that reads and tokenizes the shards during training instead
+    (see hn_streaming.py).
+    """
+    from hn_dedup import cached_dedup_dataset, print_dedup_report
+    from hn_length_profile import find_memory_outliers
+    from hn_post_index import exclude_posts
+    from hn_synthetic import make_synthetic_post_dataset
+    from hn_thread import make_tokenizer_counter
+    from hn_tokenize import tokenize_training_data
+
+    data_config = config['data']
+    max_seq_length = config['model']['max_seq_length']
+
+    if data_config['streaming']:
+        return streaming_training_data(config, tokenizer, hf_token)
+
+    if data_config['synthetic_posts']:
+        train_dataset = make_synthetic_post_dataset(data_config['synthetic_posts'])
+        val_dataset = test_dataset = train_dataset.select([])
+    else:
+        train_dataset, val_dataset, test_dataset = load_training_data(
+            data_config['dataset_id'], hf_token=hf_token, exclude_ids=[], revision=config_revision(config))
+    if data_config['dedup']:
+        # Drop near-duplicate posts (and the ones that duplicate a validation or test post) and boilerplate
+        #  comments. The result is cached on disk, like the tokenized data.
+        train_dataset, dedup_report = cached_dedup_dataset(train_dataset, [val_dataset, test_dataset],
+                                                           count_tokens=make_tokenizer_counter(tokenizer))
+        print_dedup_report(dedup_report)
+
+    # Exclude the posts that are predicted to run out of memory (estimated from their token length, see
+    #  hn_length_profile.py) instead of a hand-picked list.
+    if data_config['exclude_memory_outliers']:
+        memory_budget_gb = data_config['memory_budget_gb']
+        exclude_ids = find_memory_outliers(train_dataset, tokenizer, memory_budget_gb,
+                                           batch_size=config['trainer']['per_device_train_batch_size'],
+                                           max_seq_length=max_seq_length)
+        if exclude_ids:
+            print(f"\nExcluding posts predicted to go over {memory_budget_gb} GB: {exclude_ids}")
+            train_dataset = exclude_posts(train_dataset, exclude_ids)
+
+    print(f"\nPost ids selected for training (after filtering): {train_dataset['post_id']}")
+
+    # Format and tokenize in batches. Truncation is in tokens to fit max_seq_length. The result is cached on disk,
+    #  so the next run with the same tokenizer, template and data loads it without tokenizing again.
+    return tokenize_training_data(train_dataset, tokenizer, max_seq_length, data_config['max_output_tokens'],
+                                  data_config['thread_aware'])
+
+
+def streaming_shards(config, hf_token=None):
+    """Shard files of the train split for data.streaming: data.shards, or the dataset cache revision of dataset_id"""
+    from hn_dataset_cache import cached_revision_path
+    from hn_streaming import find_shards
+
+    data_config = config['data']
+    if data_config['synthetic_posts']:
+        raise ValueError("Streaming reads shard files: set data.shards instead of data.synthetic_posts")
+    shards_path = data_config['shards'] or cached_revision_path(data_config['dataset_id'], config_revision(config),
+                                                                token=hf_token)
+    return find_shards(shards_path)
+
+
+def streaming_training_data(config, tokenizer, hf_token=None):
+    """Tokenized posts streamed from the shards of the train split (see hn_streaming.py)"""
+    from hn_streaming import streaming_training_dataset
+
+    data_config = config['data']
+    if config['trainer']['max_steps'] <= 0:
+        raise ValueError("A streamed dataset has no length: set trainer.max_steps")
+    return streaming_training_dataset(streaming_shards(config, hf_token), tokenizer, config['model']['max_seq_length'],
+                                      data_config['max_output_tokens'], data_config['thread_aware'],
+                                      data_config['shuffle_buffer_size'], config['trainer']['seed'])
+
+
+def run_training(config, hf_token=None):
+    """
+    Train with the config (see hn_train_config.py). Returns the step profile summary of the run.
+    Resumes from the latest checkpoint of the run if there is one (see hn_checkpoint.py). The model is loaded again,
+    but the deduplicated and tokenized data come from the cache.
+    """
+    from hn_checkpoint import PreemptionCallback, resolve_resume_checkpoint
+    from hn_train_profiler import TrainingProfilerCallback
+
+    model_config, lora_config, trainer_config = config['model'], config['lora'], config['trainer']
+    backend = model_config['backend']
+    max_seq_length = model_config['max_seq_length']
+
+    base_model, tokenizer = initialize_model(model_config['base_model_name'], max_seq_length,
+                                             model_config['load_in_4bit'], config_dtype(config), backend)
+    lora_model = setup_lora_adapter(base_model, lora_config['r'], lora_config['lora_alpha'],
+                                    lora_config['lora_dropout'], lora_config['target_modules'],
+                                    lora_config['use_gradient_checkpointing'], lora_config['random_state'], backend)
+
+    formatted_dataset = prepare_training_data(config, tokenizer, hf_token)
+    run_name = trainer_config['run_name']
+    use_wandb = trainer_config['use_wandb']
+    output_dir = run_output_dir(config)
+    training_config = {**training_arguments_config(config), 'output_dir': output_dir}
+    if config['data']['streaming']:
+        # The shards are read, tokenized and packed in the DataLoader worker processes
+        data_config = config['data']
+        training_config['dataloader_num_workers'] = data_config['num_workers']
+        if data_config['num_workers']:
+            training_config['dataloader_prefetch_factor'] = data_config['prefetch_factor']
+    else:
+        print("\nTokenized dataset token counts:", {
+            post_id: num_tokens
+            for post_id, num_tokens in zip(formatted_dataset['post_id'], formatted_dataset['num_tokens'])
+        })
+
+    trainer = setup_trainer(lora_model, tokenizer, formatted_dataset, run_name, max_seq_length,
+                            trainer_config['packing'], use_wandb, trainer_config['profile_path'], training_config,
+                            trainer_config['block_diagonal_mask'], backend)
 
-def main():
-    # Get HuggingFace token
+    # Train model
+    resume_checkpoint = resolve_resume_checkpoint(output_dir, trainer_config['resume'])
+    print(f"Starting training... Base Model: {model_config['base_model_name']}, "
+          f"Max context window: {max_seq_length}, Run name: {run_name}"
+          + (f", resuming from: {resume_checkpoint}" if resume_checkpoint else ""))
+    trainer_stats = trainer.train(resume_from_checkpoint=resume_checkpoint)
+    if use_wandb:
+        import wandb
+
+        wandb.finish()
+
+    preemption = next(callback for callback in trainer.callback_handler.callbacks
+                      if isinstance(callback, PreemptionCallback))
+    if preemption.preempted:
+        print(f"Training stopped at step {trainer.state.global_step}. Checkpoint saved in {output_dir}, "
+              f"run again with the same config to resume.")
+        # Exit with the usual status of a process killed by the signal, so job schedulers requeue the job
+        sys.exit(128 + preemption.received_signal)
+    print(f"Training completed in {trainer_stats.metrics['train_runtime']} seconds. Run name: {run_name}")
+
+    profiler = next(callback for callback in trainer.callback_handler.callbacks
+                    if isinstance(callback, TrainingProfilerCallback))
+    return profiler.summary()
+
+
+def get_hf_token(config):
+    """HuggingFace token. Not needed for synthetic data, a local dataset directory or streamed local shards."""
+    data_config = config['data']
     hf_token = os.environ.get('HF_TOKEN')
-    if not hf_token:
+    if (not hf_token and not data_config['synthetic_posts'] and not os.path.isdir(data_config['dataset_id'])
+            and not (data_config['streaming'] and data_config['shards'])):
         raise ValueError("HF_TOKEN environment variable not set")
+    return hf_token
 
-    # Initialize model
-    # base_model_name="unsloth/llama-3-8b-Instruct-bnb-4bit"
-    base_model_name = "unsloth/llama-3-8b-bnb-4bit"
-    # max_seq_length = 4096
-    max_seq_length = 8192
-    base_model, tokenizer = initialize_model(base_model_name, max_seq_length)
-
-    # Setup LoRA adapter
-    lora_model = setup_lora_adapter(base_model)
-
-    # Load and format training data
-    train_dataset, val_dataset, test_dataset = load_training_data(hf_token=hf_token)
-    print(f"\nPost ids selected for training (after filtering):")
-    print(f"...Train: {train_dataset['post_id']}, Val: {val_dataset['post_id']}, Test: {test_dataset['post_id']}")
-    print("\nLoaded train dataset - text lengths:")
-    for idx, item in enumerate(train_dataset):
-        print(f"...item[{idx}]: post id: {item['post_id']}, comment length: {len(item['input_comment'])}, summary length: {len(item['output_summary'])}")
-
-    formatted_dataset = format_training_data(train_dataset, tokenizer, True, 2000)
-    print("\nFormatted dataset text lengths:", {
-        f"text[{idx}]": len(text)
-        for idx, text in enumerate(formatted_dataset['text'])
-    })
 
-    # Setup trainer
-    run_name = "ann-text-trunc-1medium_4small_posts_Llama-3-8b-bnb-4bit_beast_4096"
-    trainer = setup_trainer(lora_model, tokenizer, formatted_dataset, run_name, max_seq_length)
+def cmd_prepare_data(args, config):
+    """Fill the dedup and tokenization caches, so that training starts with the data ready"""
+    if config['data']['streaming']:
+        # Streamed data is tokenized during training. Only make sure that the shards are on local disk.
+        shard_paths = streaming_shards(config, get_hf_token(config))
+        print(f"\nStreaming from {len(shard_paths)} shards: {', '.join(shard_paths)}")
+        return
 
-    # Train model
-    print(f"Starting training... Base Model: {base_model_name}, Max context window: {max_seq_length}, WandB logs in run name: {run_name}")
-    trainer_stats = trainer.train()
-    wandb.finish()
-    print(f"Training completed in {trainer_stats.metrics['train_runtime']} seconds. WandB logs in run name: {run_name}")
-    #
-    # # Export model
-    # export_model(lora_model, tokenizer)
-    #
-    # # Setup Ollama integration
-    # setup_ollama()
+    tokenizer = load_tokenizer(config)
+    tokenized_dataset = prepare_training_data(config, tokenizer, get_hf_token(config))
+    num_tokens = list(tokenized_dataset['num_tokens'])
+    print(f"\nPrepared {len(num_tokens)} examples, {sum(num_tokens)} tokens "
+          f"({sum(tokenized_dataset['truncated'])} truncated) for max_seq_length: {config['model']['max_seq_length']}")
+
+
+def cmd_profile(args, config):
+    """Token lengths and predicted memory of every split, and the posts over the memory budget"""
+    from hn_length_profile import model_config_from_pretrained, profile_dataset
+
+    data_config = config['data']
+    tokenizer = load_tokenizer(config)
+    if data_config['synthetic_posts']:
+        from datasets import DatasetDict
+
+        from hn_synthetic import make_synthetic_post_dataset
+
+        dataset_dict = DatasetDict(train=make_synthetic_post_dataset(data_config['synthetic_posts']))
+    else:
+        from hn_dataset_cache import load_cached_dataset
+
+        dataset_dict = load_cached_dataset(data_config['dataset_id'], revision=config_revision(config),
+                                           token=get_hf_token(config))
+
+    # The model shape is read from its config.json. The tiny model uses the default shape of the estimate.
+    model_config = None
+    if config['model']['backend'] != "tiny":
+        model_config = model_config_from_pretrained(config['model']['base_model_name'])
+    profile_dataset(dataset_dict, tokenizer, data_config['memory_budget_gb'],
+                    config['trainer']['per_device_train_batch_size'], model_config,
+                    max_seq_length=config['model']['max_seq_length'])
+
+
+def cmd_train(args, config):
+    from hn_sweep import run_sweep
+
+    hf_token = get_hf_token(config)
+    if config['trainer']['use_wandb']:
+        # Log in before loading the model, so a missing login fails right away
+        import wandb
+
+        wandb.login()
+
+    if args.sweep:
+        # Every run of the sweep is in a fresh process (see hn_sweep.py)
+        run_sweep(config, run_training, args.sweep_output, run_args=(hf_token,))
+        return
+
+    run_training(config, hf_token=hf_token)
+    print("Model training completed successfully!")
 
-    print("Model training and export completed successfully!")
+
+def load_eval_dataset(config, split):
+    data_config = config['data']
+    if data_config['synthetic_posts']:
+        from hn_synthetic import make_synthetic_post_dataset
+
+        # Different posts than the synthetic training posts
+        return make_synthetic_post_dataset(data_config['synthetic_posts'], seed=1)
+
+    from hn_dataset_cache import load_cached_dataset
+
+    return load_cached_dataset(data_config['dataset_id'], revision=config_revision(config),
+                               token=get_hf_token(config))[split]
+
+
+def cmd_evaluate(args, config):
+    """Evaluate the trained model in this process, or a model served with an OpenAI compatible API"""
+    from hn_eval import (OpenAICompatibleTarget, TransformersTarget, evaluate_dataset, print_eval_report,
+                         write_eval_report)
+
+    target_class = TransformersTarget
+    if args.prefix_cache:
+        # Same outputs, but the KV cache of the system prompt prefix is computed once (see hn_prefix_cache.py)
+        from hn_prefix_cache import PrefixCachedTarget
+
+        target_class = PrefixCachedTarget
+
+    if args.base_url:
+        target = OpenAICompatibleTarget(args.base_url, args.server_model, api_key=os.environ.get('OPENAI_API_KEY'),
+                                        max_new_tokens=args.max_new_tokens, concurrency=args.batch_size)
+    elif config['model']['backend'] == "tiny":
+        # Untrained tiny model: only checks the evaluation pipeline
+        model, tokenizer = initialize_model(config['model']['base_model_name'], config['model']['max_seq_length'],
+                                            backend="tiny")
+        target = target_class(model.eval(), tokenizer, "tiny", args.max_new_tokens, args.batch_size)
+    else:
+        from unsloth import FastLanguageModel
+
+        from hn_checkpoint import find_resume_checkpoint
+
+        checkpoint_dir = args.checkpoint or find_resume_checkpoint(run_output_dir(config))
+        if checkpoint_dir is None:
+            raise ValueError(f"No checkpoint to evaluate in {run_output_dir(config)}")
+        model, tokenizer = load_trained_model(checkpoint_dir, config['model']['max_seq_length'],
+                                              config['model']['load_in_4bit'], config_dtype(config))
+        FastLanguageModel.for_inference(model)
+        target = target_class(model, tokenizer, os.path.abspath(checkpoint_dir), args.max_new_tokens,
+                              args.batch_size)
+
+    # The prompt and the summary have to fit in max_seq_length
+    max_input_tokens = args.max_input_tokens or config['model']['max_seq_length'] - args.max_new_tokens
+    report = evaluate_dataset(load_eval_dataset(config, args.split), target, args.split, args.limit,
+                              max_input_tokens, use_cache=not args.no_cache)
+    print_eval_report(report)
+    write_eval_report(report, args.output or f"outputs/eval_{args.split}.json")
+
+
+def cmd_export(args, config):
+    """Export the GGUF variants, and benchmark them on CPU with Ollama"""
+    from hn_gguf import benchmark_gguf_variants, benchmark_prompts, find_gguf_files
+
+    quantizations = args.quantizations.split(",")
+    max_seq_length = config['model']['max_seq_length']
+    if args.skip_export:
+        gguf_files = find_gguf_files(args.output_dir, quantizations)
+    else:
+        from hn_checkpoint import find_resume_checkpoint
+
+        if config['model']['backend'] == "tiny":
+            raise ValueError("GGUF export needs the unsloth backend")
+        checkpoint_dir = args.checkpoint or find_resume_checkpoint(run_output_dir(config))
+        if checkpoint_dir is None:
+            raise ValueError(f"No checkpoint to export in {run_output_dir(config)}")
+
+        model, tokenizer = load_trained_model(checkpoint_dir, max_seq_length, config['model']['load_in_4bit'],
+                                              config_dtype(config))
+        gguf_files = export_model(model, tokenizer, args.output_dir, quantizations, max_seq_length)
+        del model
+
+    if not args.benchmark:
+        return
+
+    from hn_ollama import OllamaServer
+
+    # The same posts of the test split for every variant
+    prompts = benchmark_prompts(load_eval_dataset(config, "test"), args.benchmark_posts,
+                                max_input_tokens=max_seq_length - args.max_new_tokens)
+    with OllamaServer(args.host) as server:
+        benchmark_gguf_variants(gguf_files, prompts, server, args.model_name, args.max_new_tokens, max_seq_length,
+                                args.num_threads, args.benchmark_output)
+
+
+def cmd_serve(args, config):
+    from hn_gguf import find_modelfile
+
+    # Default: the Modelfile that export wrote for the GGUF file of the quantization
+    modelfile = args.modelfile or find_modelfile(args.model_dir, args.quantization)
+    server = setup_ollama(args.model_name, modelfile, args.host)
+    if not server.owned or args.no_wait:
+        server.stop()
+        return
+
+    # The server was started here: keep it running until Ctrl-C or SIGTERM, then stop it
+    import signal
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    print(f"Serving {args.model_name} at {server.host}. Press Ctrl-C to stop.")
+    try:
+        server.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fine-tune a model to summarize HN comments")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, func, help):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument("--config", default=None,
+                               help="TOML/YAML config (see hn_train_config.py). Default: the values in DEFAULT_CONFIG")
+        subparser.set_defaults(func=func)
+        return subparser
+
+    add_command("prepare-data", cmd_prepare_data, "Load, deduplicate and tokenize the training data into the caches")
+    add_command("profile", cmd_profile, "Token lengths and predicted training memory of the posts")
+    train_parser = add_command("train", cmd_train, "Train the LoRA adapter")
+    train_parser.add_argument("--sweep", action="store_true", help="Run every combination of the sweep section")
+    train_parser.add_argument("--sweep-output", default="outputs/sweep_results.csv",
+                              help="CSV file of the sweep results")
+    eval_parser = add_command("evaluate", cmd_evaluate, "Evaluate the model on the validation or test split")
+    eval_parser.add_argument("--split", default="test", choices=["validation", "test"])
+    eval_parser.add_argument("--checkpoint", default=None,
+                             help="Checkpoint directory. Default: the latest checkpoint of the run")
+    eval_parser.add_argument("--base-url", default=None,
+                             help="Evaluate a server with an OpenAI compatible API instead, eg. http://localhost:11434/v1")
+    eval_parser.add_argument("--server-model", default="hn-finetune-model", help="Model name on the server")
+    eval_parser.add_argument("--limit", type=int, default=None, help="Evaluate only the first posts")
+    eval_parser.add_argument("--batch-size", type=int, default=4, help="Generation batch size (concurrent requests)")
+    eval_parser.add_argument("--max-new-tokens", type=int, default=1024)
+    eval_parser.add_argument("--max-input-tokens", type=int, default=None,
+                             help="Reduce longer threads to this size. Default: max_seq_length - max_new_tokens")
+    eval_parser.add_argument("--no-cache", action="store_true", help="Generate again instead of using cached outputs")
+    eval_parser.add_argument("--prefix-cache", action="store_true",
+                             help="Compute the KV cache of the shared prompt prefix once and reuse it for every batch")
+    eval_parser.add_argument("--output", default=None, help="JSON report file (default: outputs/eval_<split>.json)")
+    export_parser = add_command("export", cmd_export, "Export the trained model to GGUF")
+    export_parser.add_argument("--checkpoint", default=None,
+                               help="Checkpoint directory. Default: the latest checkpoint of the run")
+    export_parser.add_argument("--output-dir", default="model", help="Directory of the GGUF files")
+    export_parser.add_argument("--quantizations", default="q4_k_m,q5_k_m,q8_0",
+                               help="Comma separated GGUF quantization methods")
+    export_parser.add_argument("--skip-export", action="store_true",
+                               help="Use the GGUF files already in the output dir (eg. to only benchmark them)")
+    export_parser.add_argument("--benchmark", action="store_true",
+                               help="Benchmark the variants on CPU with Ollama (size, load time, tokens/sec, ROUGE-L)")
+    export_parser.add_argument("--benchmark-posts", type=int, default=5, help="Number of test posts to generate")
+    export_parser.add_argument("--benchmark-output", default="outputs/gguf_benchmark.json")
+    export_parser.add_argument("--max-new-tokens", type=int, default=512)
+    export_parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: Ollama's)")
+    export_parser.add_argument("--model-name", default="hn-finetune",
+                               help="Prefix of the Ollama model names (<prefix>-q4-k-m, ...)")
+    export_parser.add_argument("--host", default=None, help="Ollama host. Default: OLLAMA_HOST or 127.0.0.1:11434")
+    serve_parser = add_command("serve", cmd_serve, "Start the Ollama server and create the model")
+    serve_parser.add_argument("--model-name", default="hn-finetune-text-trunc-2medium", help="Ollama model name")
+    serve_parser.add_argument("--model-dir", default="model", help="Directory of the GGUF files written by export")
+    serve_parser.add_argument("--quantization", default="q8_0",
+                              help="GGUF quantization to serve, with the Modelfile that export wrote for it")
+    serve_parser.add_argument("--modelfile", default=None,
+                              help="Ollama Modelfile. Default: the one of --quantization in --model-dir")
+    serve_parser.add_argument("--host", default=None, help="Ollama host. Default: OLLAMA_HOST or 127.0.0.1:11434")
+    serve_parser.add_argument("--no-wait", action="store_true",
+                              help="Create the model and exit (stops the server if it was started here)")
+    args = parser.parse_args()
+
+    config = load_train_config(args.config)
+    args.func(args, config)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
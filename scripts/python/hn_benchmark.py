@@ -0,0 +1,347 @@
+"""
+Offline benchmark suite of the data pipeline, with regression checks against a stored baseline
+
+A synthetic posts DB (see write_synthetic_db() in hn_synthetic.py: the hierarchy and score format of download.js,
+threads sized in characters up to max_thread_chars) is written to a temp directory, and every stage of the pipeline
+runs on it, with a LocalHubRepo directory standing in for the Hub (see hn_hub.py):
+- synthetic_db: writing the DB (only to know how long the setup takes)
+- upload_dataset_from_db: reading the posts from the DB into a DatasetDict and uploading it (upload-hface-dataset.py)
+- load_hface_dataset: loading the uploaded dataset, which downloads it into the dataset cache (hn_dataset_cache.py)
+- load_hface_dataset_cached: loading it again in a new process, from the cache
+- get_datarow: looking up posts by post_id (hn_post_index.py)
+- format_training_data: formatting the train split with the chat template (finetune-hn-summary.py)
+- tokenize: formatting and tokenizing the train split (hn_tokenize.py), with the synthetic tokenizer
+
+Every stage runs in a new process, so its peak RSS is its own and nothing is cached in memory from the previous
+stage. The imports and the setup of a stage are not timed. The output of the stages goes to <output>.log.
+The results (seconds, CPU seconds, rows/sec, MB/sec and peak RSS per stage) are written to a JSON file. With
+--baseline, every stage is compared with the same stage of the baseline (a results file of an earlier run with the
+same sizes), and is flagged as a regression if it is slower or uses more memory than the tolerance. The exit code is
+1 if there is a regression. Everything runs on CPU, without network access.
+
+Usage:
+    uv run hn_benchmark.py --rows 2000 --save-baseline benchmarks/baseline.json
+    uv run hn_benchmark.py --rows 2000 --baseline benchmarks/baseline.json
+    uv run hn_benchmark.py --rows 100000 --max-thread-chars 150000 --stages upload_dataset_from_db,tokenize
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+DEFAULT_ROWS = 2000
+DEFAULT_MAX_THREAD_CHARS = 150000
+DEFAULT_LOOKUPS = 1000
+DEFAULT_MAX_SEQ_LENGTH = 4096
+DEFAULT_TIME_TOLERANCE = 0.2
+DEFAULT_MEMORY_TOLERANCE = 0.2
+# Differences below these are noise, even if they are over the tolerance (eg. a stage of 0.1 seconds)
+MIN_REGRESSION_SECONDS = 0.5
+MIN_REGRESSION_MB = 50
+
+HUB_DIR = "hub"
+DB_FILE = "hn_posts.db"
+
+
+def _load_script(file_name, module_name):
+    """Import a script whose file name is not a module name (eg. upload-hface-dataset.py)"""
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(os.path.dirname(__file__), file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _input_bytes(dataset):
+    """Bytes of the text of a split, from the Arrow buffers (without reading the rows)"""
+    return sum(dataset.data.column(column).nbytes for column in ["input_comment", "output_summary"])
+
+
+def _load_uploaded_dataset(work_dir):
+    upload_module = _load_script("upload-hface-dataset.py", "upload_hface_dataset")
+    upload_module.HF_REPO_NAME = os.path.join(work_dir, HUB_DIR)
+    return upload_module, upload_module.load_hface_dataset()
+
+
+# Every stage does its imports and setup, and returns the function to time. That function returns the number of rows
+#  and of bytes it processed.
+
+def stage_synthetic_db(work_dir, params):
+    from hn_synthetic import write_synthetic_db
+
+    db_path = os.path.join(work_dir, DB_FILE)
+
+    def run():
+        write_synthetic_db(db_path, params['rows'], seed=params['seed'], max_thread_chars=params['max_thread_chars'])
+        return params['rows'], os.path.getsize(db_path)
+
+    return run
+
+
+def stage_upload_dataset_from_db(work_dir, params):
+    import sqlite3
+
+    from hn_export import split_for_post_id
+    from hn_hub import LocalHubRepo
+
+    upload_module = _load_script("upload-hface-dataset.py", "upload_hface_dataset")
+    db_path = os.path.join(work_dir, DB_FILE)
+    # posts_from_db() reads DB_PATH of the script
+    upload_module.DB_PATH = db_path
+    conn = sqlite3.connect(db_path)
+    post_ids = [row[0] for row in conn.execute("select post_id from posts_comments order by post_id")]
+    conn.close()
+    test_post_ids = [post_id for post_id in post_ids if split_for_post_id(post_id) == 'test']
+    train_val_post_ids = [post_id for post_id in post_ids if split_for_post_id(post_id) != 'test']
+
+    def run():
+        upload_module.upload_dataset_from_db(train_val_post_ids, test_post_ids,
+                                             hub_repo=LocalHubRepo(os.path.join(work_dir, HUB_DIR)))
+        return len(post_ids), os.path.getsize(db_path)
+
+    return run
+
+
+def stage_load_hface_dataset(work_dir, params):
+    upload_module = _load_script("upload-hface-dataset.py", "upload_hface_dataset")
+    upload_module.HF_REPO_NAME = os.path.join(work_dir, HUB_DIR)
+
+    def run():
+        dataset_dict = upload_module.load_hface_dataset()
+        return (sum(len(split) for split in dataset_dict.values()),
+                sum(_input_bytes(split) for split in dataset_dict.values()))
+
+    return run
+
+
+def stage_get_datarow(work_dir, params):
+    import random
+
+    upload_module, dataset_dict = _load_uploaded_dataset(work_dir)
+    train_post_ids = dataset_dict['train']['post_id']
+    rng = random.Random(params['seed'])
+    post_ids = [rng.choice(train_post_ids) for _ in range(params['lookups'])]
+
+    def run():
+        found = sum(len(upload_module.get_datarow(dataset_dict, post_id, 'train')) for post_id in post_ids)
+        if found != len(post_ids):
+            raise Exception(f"get_datarow() found {found} of {len(post_ids)} posts")
+        return len(post_ids), 0
+
+    return run
+
+
+def stage_format_training_data(work_dir, params):
+    from hn_synthetic import make_synthetic_tokenizer
+
+    finetune_module = _load_script("finetune-hn-summary.py", "finetune_hn_summary")
+    _, dataset_dict = _load_uploaded_dataset(work_dir)
+    train_dataset = dataset_dict['train']
+    tokenizer = make_synthetic_tokenizer()
+
+    def run():
+        formatted = finetune_module.format_training_data(train_dataset, tokenizer, truncate=True)
+        return len(formatted), _input_bytes(train_dataset)
+
+    return run
+
+
+def stage_tokenize(work_dir, params):
+    from hn_synthetic import make_synthetic_tokenizer
+    from hn_tokenize import tokenize_training_data
+
+    _, dataset_dict = _load_uploaded_dataset(work_dir)
+    train_dataset = dataset_dict['train']
+    tokenizer = make_synthetic_tokenizer()
+
+    def run():
+        tokenized = tokenize_training_data(train_dataset, tokenizer, params['max_seq_length'],
+                                           cache_dir=os.path.join(work_dir, "cache", "tokenized"))
+        return len(tokenized), _input_bytes(train_dataset)
+
+    return run
+
+
+STAGES = {
+    'synthetic_db': stage_synthetic_db,
+    'upload_dataset_from_db': stage_upload_dataset_from_db,
+    'load_hface_dataset': stage_load_hface_dataset,
+    'load_hface_dataset_cached': stage_load_hface_dataset,
+    'get_datarow': stage_get_datarow,
+    'format_training_data': stage_format_training_data,
+    'tokenize': stage_tokenize,
+}
+
+
+def _run_stage(stage, work_dir, params, log_path, queue):
+    """Run a stage in this (new) process and put its measurements on the queue"""
+    import resource
+
+    # The output of the stage (and of the libraries, eg. progress bars) goes to the log, not to the report
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    print(f"\n===== {stage}", flush=True)
+    # Relative cache paths (eg. cache/datasets of hn_dataset_cache.py) and the HF datasets cache in the work dir
+    os.chdir(work_dir)
+    os.environ['HF_DATASETS_CACHE'] = os.path.join(work_dir, "hf_datasets")
+    # The hub is a local directory: its revision is resolved without network access
+    os.environ['HF_HUB_OFFLINE'] = "0"
+    os.environ.setdefault('HF_TOKEN', "")
+
+    run = STAGES[stage](work_dir, params)
+    rss_before_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start_time = time.perf_counter()
+    cpu_start = time.process_time()
+    rows, num_bytes = run()
+    seconds = time.perf_counter() - start_time
+    cpu_seconds = time.process_time() - cpu_start
+    sys.stdout.flush()
+
+    # ru_maxrss is in KB on Linux
+    queue.put({
+        'seconds': round(seconds, 3),
+        'cpu_seconds': round(cpu_seconds, 3),
+        'rows': rows,
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'mb_per_second': round(num_bytes / 2 ** 20 / seconds, 2) if seconds and num_bytes else None,
+        'rss_before_mb': round(rss_before_mb),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+    })
+
+
+def run_stage(stage, work_dir, params, log_path):
+    """Run a stage in a new process. Returns its measurements."""
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, work_dir, params, log_path, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception(f"Benchmark stage {stage} failed with exit code {process.exitcode}. See {log_path}")
+    return queue.get()
+
+
+def run_benchmarks(work_dir, params, stages=None, log_path="outputs/benchmark.log"):
+    """Run the stages in order on a synthetic DB in work_dir. Returns the results."""
+    stages = stages or list(STAGES)
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown benchmark stages: {unknown}. Stages: {list(STAGES)}")
+
+    log_path = os.path.abspath(log_path)
+    # The stages depend on the output of the stages before them
+    required = list(STAGES)[:max(list(STAGES).index(stage) for stage in stages) + 1]
+    results = {}
+    for stage in required:
+        result = run_stage(stage, work_dir, params, log_path)
+        if stage in stages:
+            results[stage] = result
+            mb_per_second = f"{result['mb_per_second']} MB/sec, " if result['mb_per_second'] else ""
+            print(f"...{stage}: {result['seconds']} seconds, {result['rows_per_second']} rows/sec, "
+                  f"{mb_per_second}peak RSS {result['peak_rss_mb']} MB")
+        else:
+            print(f"...{stage}: done (not measured)")
+    return results
+
+
+def find_regressions(results, baseline, time_tolerance=DEFAULT_TIME_TOLERANCE,
+                     memory_tolerance=DEFAULT_MEMORY_TOLERANCE):
+    """Stages that are slower or use more memory than in the baseline, beyond the tolerance and the noise floor"""
+    regressions = []
+    for stage, result in results['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None:
+            continue
+        if (result['seconds'] > base['seconds'] * (1 + time_tolerance)
+                and result['seconds'] - base['seconds'] >= MIN_REGRESSION_SECONDS):
+            regressions.append({'stage': stage, 'metric': 'seconds', 'baseline': base['seconds'],
+                                'value': result['seconds'],
+                                'change': round(result['seconds'] / base['seconds'] - 1, 3)})
+        if (result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + memory_tolerance)
+                and result['peak_rss_mb'] - base['peak_rss_mb'] >= MIN_REGRESSION_MB):
+            regressions.append({'stage': stage, 'metric': 'peak_rss_mb', 'baseline': base['peak_rss_mb'],
+                                'value': result['peak_rss_mb'],
+                                'change': round(result['peak_rss_mb'] / base['peak_rss_mb'] - 1, 3)})
+    return regressions
+
+
+def write_json(data, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    import platform
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline on a synthetic posts DB, offline")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="Number of posts in the synthetic DB")
+    parser.add_argument("--max-thread-chars", type=int, default=DEFAULT_MAX_THREAD_CHARS,
+                        help="Size of the longest threads, in characters")
+    parser.add_argument("--seed", type=int, default=3407)
+    parser.add_argument("--lookups", type=int, default=DEFAULT_LOOKUPS, help="Number of get_datarow() lookups")
+    parser.add_argument("--max-seq-length", type=int, default=DEFAULT_MAX_SEQ_LENGTH)
+    parser.add_argument("--stages", default=None, help=f"Comma separated stages. Default: all of {list(STAGES)}")
+    parser.add_argument("--output", default="outputs/benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="Results file to compare with")
+    parser.add_argument("--save-baseline", default=None, help="Also write the results to this baseline file")
+    parser.add_argument("--time-tolerance", type=float, default=DEFAULT_TIME_TOLERANCE,
+                        help="Slowdown of a stage that is a regression (0.2: 20%% slower)")
+    parser.add_argument("--memory-tolerance", type=float, default=DEFAULT_MEMORY_TOLERANCE,
+                        help="Peak RSS increase of a stage that is a regression")
+    parser.add_argument("--work-dir", default=None, help="Keep the DB, hub and caches here. Default: a temp dir")
+    args = parser.parse_args()
+
+    benchmark_params = {'rows': args.rows, 'max_thread_chars': args.max_thread_chars, 'seed': args.seed,
+                        'lookups': args.lookups, 'max_seq_length': args.max_seq_length}
+    benchmark_stages = args.stages.split(",") if args.stages else None
+    print(f"Benchmarking the data pipeline with {benchmark_params}")
+
+    log_file = os.path.splitext(args.output)[0] + ".log"
+    if os.path.dirname(log_file):
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        stage_results = run_benchmarks(os.path.abspath(args.work_dir), benchmark_params, benchmark_stages, log_file)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stage_results = run_benchmarks(tmp_dir, benchmark_params, benchmark_stages, log_file)
+
+    benchmark_results = {
+        'params': benchmark_params,
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'stages': stage_results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_results = json.load(f)
+        if baseline_results['params'] != benchmark_params:
+            print(f"Baseline {args.baseline} was run with other params: {baseline_results['params']}. "
+                  f"Not comparing.")
+        else:
+            benchmark_results['regressions'] = find_regressions(benchmark_results, baseline_results,
+                                                                args.time_tolerance, args.memory_tolerance)
+            for regression in benchmark_results['regressions']:
+                print(f"REGRESSION {regression['stage']} {regression['metric']}: {regression['baseline']} -> "
+                      f"{regression['value']} ({regression['change']:+.0%})")
+            if benchmark_results['regressions']:
+                exit_code = 1
+            else:
+                print(f"No regressions against {args.baseline}")
+
+    write_json(benchmark_results, args.output)
+    print(f"Benchmark results written to {args.output}")
+    if args.save_baseline:
+        write_json(benchmark_results, args.save_baseline)
+        print(f"Baseline written to {args.save_baseline}")
+    sys.exit(exit_code)
@@ -0,0 +1,105 @@
+"""
+Checkpoints, auto-resume and preemption handling of training runs
+
+The Trainer saves a checkpoint every save_steps steps into <output_dir>/checkpoint-<step>. With a LoRA model only the
+adapter weights are saved (not the base model), plus the optimizer, lr scheduler, RNG states and the trainer state
+(step, loss history). On resume, the Trainer restores all of them and skips the batches that were already used in
+the current epoch, so the run continues with the same data order as if it was never stopped.
+
+find_resume_checkpoint() returns the latest complete checkpoint of the output dir. A checkpoint that was being
+written when the machine went down has no trainer_state.json (the Trainer writes it last) and is skipped.
+
+PreemptionCallback traps SIGTERM (sent by spot instance reclaim, Slurm, Kubernetes and docker stop before they kill
+the process). The current step is finished, a checkpoint is saved and training stops, and the next run with the same
+config resumes from there.
+"""
+
+import os
+import re
+import signal
+
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+TRAINER_STATE_FILE = "trainer_state.json"
+WEIGHT_FILES = ["adapter_model.safetensors", "adapter_model.bin", "model.safetensors", "pytorch_model.bin"]
+
+CHECKPOINT_DIR_PATTERN = re.compile(rf"^{PREFIX_CHECKPOINT_DIR}-(\d+)$")
+
+
+def is_complete_checkpoint(checkpoint_dir):
+    return (os.path.exists(os.path.join(checkpoint_dir, TRAINER_STATE_FILE)) and
+            any(os.path.exists(os.path.join(checkpoint_dir, name)) for name in WEIGHT_FILES))
+
+
+def find_resume_checkpoint(output_dir):
+    """The latest complete checkpoint in output_dir, or None"""
+    if not os.path.isdir(output_dir):
+        return None
+
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = CHECKPOINT_DIR_PATTERN.match(name)
+        if match and os.path.isdir(os.path.join(output_dir, name)):
+            checkpoints.append((int(match.group(1)), os.path.join(output_dir, name)))
+
+    for step, checkpoint_dir in sorted(checkpoints, reverse=True):
+        if is_complete_checkpoint(checkpoint_dir):
+            return checkpoint_dir
+        print(f"...Skipping incomplete checkpoint: {checkpoint_dir}")
+    return None
+
+
+def resolve_resume_checkpoint(output_dir, resume):
+    """
+    The checkpoint to pass to trainer.train(resume_from_checkpoint=...).
+    resume: "auto" (the latest checkpoint if there is one), True (the latest checkpoint, which must exist), False, or
+    the path of a checkpoint.
+    """
+    if resume is False or resume in (None, "", "no", "false"):
+        return None
+    if resume is True or resume == "auto":
+        checkpoint_dir = find_resume_checkpoint(output_dir)
+        if checkpoint_dir is None and resume is True:
+            raise ValueError(f"No checkpoint to resume from in {output_dir}")
+        return checkpoint_dir
+    if not is_complete_checkpoint(resume):
+        raise ValueError(f"Not a complete checkpoint: {resume}")
+    return resume
+
+
+class PreemptionCallback(TrainerCallback):
+    """On SIGTERM, saves a checkpoint at the end of the current step and stops training (see the module docstring)"""
+
+    def __init__(self, signals=(signal.SIGTERM,)):
+        self.signals = signals
+        self.received_signal = None
+        self.previous_handlers = {}
+
+    @property
+    def preempted(self):
+        return self.received_signal is not None
+
+    def _handle_signal(self, signum, frame):
+        if self.received_signal is None:
+            print(f"\n...Received {signal.Signals(signum).name}: saving a checkpoint at the end of this step")
+        self.received_signal = signum
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.received_signal = None
+        try:
+            for signum in self.signals:
+                self.previous_handlers[signum] = signal.signal(signum, self._handle_signal)
+        except ValueError:
+            # signal() only works in the main thread
+            print("...Not in the main thread: training won't be checkpointed on SIGTERM")
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.preempted:
+            control.should_save = True
+            control.should_training_stop = True
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for signum, handler in self.previous_handlers.items():
+            signal.signal(signum, handler)
+        self.previous_handlers = {}
@@ -0,0 +1,478 @@
+"""
+Dictionary-compressed storage of the post columns, and compressed exports
+
+posts_comments keeps post_formatted_comments, comment_path_map, comment_info_map and llm_response_summary as plain
+TEXT, and every export moves all of it uncompressed through SQLite and Arrow. The threads are very repetitive (every
+line starts with (score: X) <replies: Y> {downvotes: Z}, the maps are JSON with the same keys), but a single thread is
+too short for a compressor to learn that. A dictionary trained on a sample of the posts gives it that context.
+
+build_compressed_store() trains a zstd dictionary on a sample of the posts and writes every post, with its columns
+compressed one by one, to a separate SQLite file (the compressed store, ../data/hn_posts_compressed.db). The DB of
+download.js is not changed. The dictionaries are kept in the store, and every row has the id of its dictionary, so a
+new dictionary (retrain=True) doesn't make the rows compressed with an older one unreadable.
+
+export_compressed_dataset() exports the store like export_dataset_from_db() (see hn_export.py), but the compressed
+columns go to the Parquet shards as they are, without decompressing them, together with the dictionaries in
+dictionaries.parquet. They are only decompressed at format time: decompressing_func() wraps the function that
+formats and tokenizes a batch of posts (see hn_tokenize.py), and streaming_training_dataset() (see hn_streaming.py)
+uses it for the shards of a compressed export. decompress_dataset() gives the plain columns of a loaded split.
+
+The compressed columns are not compressed again by Parquet. The shards of the plain export are already zstd
+compressed by Parquet, column by column over many rows, so the shards of the compressed export are about as big: the
+gain is in the size of the store and in the bytes read by an export, not in the bytes to upload.
+
+zstandard is a dependency (see pyproject.toml). If it is not installed, the columns are compressed with zlib and a
+preset dictionary of the most frequent words of the sample (zlib can't use more than 32 KB of it, so it compresses
+less).
+
+Run this file to measure the DB size, the bytes read by an export and the bytes to upload, plain and compressed, on
+a synthetic DB (or on a copy of the posts DB with --db):
+    uv run hn_compress.py --posts 2000
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+import zlib
+from collections import Counter
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from hn_db import DB_PATH, _iter_pages, get_connection, iter_post_pages
+from hn_export import (DEFAULT_PAGE_SIZE, SPLIT_BUCKET_SQL, _clear_shards, _finish_export, make_hash_split_fn,
+                       new_manifest, write_rows_to_shards)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_STORE_PATH = "../data/hn_posts_compressed.db"
+DEFAULT_LEVEL = 9
+DEFAULT_SAMPLE_SIZE = 500
+DEFAULT_DICT_SIZE = 112 * 1024
+# zlib uses at most the last 32 KB of a preset dictionary
+ZLIB_MAX_DICT_SIZE = 32 * 1024
+# The samples are cut in chunks of this size: the dictionary trainer works better with many small samples
+SAMPLE_CHUNK_SIZE = 8 * 1024
+
+COMPRESSED_COLUMNS = ["post_formatted_comments", "comment_path_map", "comment_info_map", "llm_response_summary"]
+DICTIONARIES_FILE = "dictionaries.parquet"
+
+STORE_SCHEMA_SQL = [
+    '''create table if not exists compression_dicts (
+        dict_id    text primary key,
+        codec      text,
+        dictionary blob,
+        created_at text default (datetime('now'))
+    )''',
+    '''create table if not exists posts_compressed (
+        post_id                 integer primary key,
+        dict_id                 text,
+        post_title              text,
+        post_formatted_comments blob,
+        comment_path_map        blob,
+        comment_info_map        blob,
+        llm_response_summary    blob,
+        llm_processed           integer,
+        llm_model_name          text
+    )''',
+    "create index if not exists idx_posts_compressed_llm_processed on posts_compressed (llm_processed, post_id)",
+]
+
+# Same rows as EXPORT_COLUMNS_SQL (see hn_export.py), with the comments and the summary still compressed
+STORE_EXPORT_COLUMNS_SQL = f'''
+    cast(post_id as text) as post_id,
+    post_title,
+    dict_id,
+    post_formatted_comments,
+    llm_response_summary as output_summary,
+    {SPLIT_BUCKET_SQL} as split_bucket
+'''
+
+COMPRESSED_EXPORT_SCHEMA = pa.schema([
+    ('post_id', pa.string()),
+    ('post_title', pa.string()),
+    ('dict_id', pa.string()),
+    ('post_formatted_comments', pa.binary()),
+    ('output_summary', pa.binary()),
+])
+
+# The compressed columns are not compressed again by Parquet
+COMPRESSED_EXPORT_COMPRESSION = {'post_id': 'zstd', 'post_title': 'zstd', 'dict_id': 'zstd',
+                                 'post_formatted_comments': 'none', 'output_summary': 'none'}
+
+
+def default_codec():
+    if zstandard is not None:
+        return "zstd"
+    print("...zstandard is not installed, compressing with zlib. Install it with: pip install zstandard")
+    return "zlib"
+
+
+class ColumnCodec:
+    """Compresses column values (text) with a trained dictionary"""
+
+    def __init__(self, dictionary, codec=None, level=DEFAULT_LEVEL):
+        self.codec = codec or default_codec()
+        if self.codec == "zstd" and zstandard is None:
+            raise ValueError("zstandard is needed for zstd compressed data. Install it with: pip install zstandard")
+        if self.codec not in ("zstd", "zlib"):
+            raise ValueError(f"Unknown codec: {self.codec}")
+        self.dictionary = dictionary
+        self.level = level
+        self.dict_id = hashlib.sha256(self.codec.encode('utf-8') + b'\0' + dictionary).hexdigest()[:16]
+        if self.codec == "zstd":
+            dict_data = zstandard.ZstdCompressionDict(dictionary)
+            self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def compress(self, text):
+        if text is None:
+            return None
+        data = text.encode('utf-8')
+        if self.codec == "zstd":
+            return self.compressor.compress(data)
+        compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, blob):
+        if blob is None:
+            return None
+        if self.codec == "zstd":
+            return self.decompressor.decompress(blob).decode('utf-8')
+        decompressor = zlib.decompressobj(zdict=self.dictionary)
+        return (decompressor.decompress(blob) + decompressor.flush()).decode('utf-8')
+
+
+def _sample_chunks(texts):
+    chunks = []
+    for text in texts:
+        data = text.encode('utf-8')
+        chunks += [data[start:start + SAMPLE_CHUNK_SIZE] for start in range(0, len(data), SAMPLE_CHUNK_SIZE)]
+    return chunks
+
+
+def _zlib_dictionary(chunks, dict_size=ZLIB_MAX_DICT_SIZE):
+    """The most frequent words (weighted by their length), the most frequent last: zlib finds close matches cheaper"""
+    counts = Counter(word for chunk in chunks for word in chunk.split())
+    words = sorted(counts, key=lambda word: counts[word] * len(word), reverse=True)
+    selected = []
+    size = 0
+    for word in words:
+        if counts[word] < 2 or size + len(word) + 1 > dict_size:
+            break
+        selected.append(word)
+        size += len(word) + 1
+    return b" ".join(reversed(selected)) + b" "
+
+
+def train_codec(texts, codec=None, level=DEFAULT_LEVEL, dict_size=DEFAULT_DICT_SIZE):
+    """ColumnCodec with a dictionary trained on the sample texts"""
+    codec = codec or default_codec()
+    chunks = _sample_chunks(text for text in texts if text)
+    if not chunks:
+        raise ValueError("No sample texts to train the compression dictionary on")
+
+    start_time = time.perf_counter()
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstandard is needed to train a zstd dictionary. Install it with: pip install zstandard")
+        dictionary = zstandard.train_dictionary(dict_size, chunks, level=level).as_bytes()
+    else:
+        dictionary = _zlib_dictionary(chunks, min(dict_size, ZLIB_MAX_DICT_SIZE))
+    print(f"...Trained a {codec} dictionary of {len(dictionary) / 1024:.0f} KB on {len(chunks)} samples "
+          f"({sum(len(chunk) for chunk in chunks) / 2 ** 20:.1f} MB) in {time.perf_counter() - start_time:.1f} seconds")
+    return ColumnCodec(dictionary, codec, level)
+
+
+def open_store(store_path=DEFAULT_STORE_PATH):
+    """Connection to the compressed store, with its tables created"""
+    if os.path.dirname(store_path):
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    conn = sqlite3.connect(store_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("pragma journal_mode = WAL")
+    for sql in STORE_SCHEMA_SQL:
+        conn.execute(sql)
+    conn.commit()
+    return conn
+
+
+def load_store_codecs(conn, level=DEFAULT_LEVEL):
+    """dict_id -> ColumnCodec of the dictionaries in the store"""
+    codecs = {}
+    for row in conn.execute("select dict_id, codec, dictionary from compression_dicts"):
+        codecs[row['dict_id']] = ColumnCodec(row['dictionary'], row['codec'], level)
+    return codecs
+
+
+def sample_posts(db_path=DB_PATH, sample_size=DEFAULT_SAMPLE_SIZE):
+    """The compressed columns of a random sample of the posts, as a list of texts"""
+    conn = get_connection(db_path)
+    columns_sql = ", ".join(COMPRESSED_COLUMNS)
+    rows = conn.execute(f'''
+        select {columns_sql}
+        from posts_comments
+        where post_id in (select post_id from posts_comments order by random() limit ?)
+    ''', (sample_size,)).fetchall()
+    return [row[column] for row in rows for column in COMPRESSED_COLUMNS if row[column]]
+
+
+def build_compressed_store(db_path=DB_PATH, store_path=DEFAULT_STORE_PATH, codec=None, level=DEFAULT_LEVEL,
+                           sample_size=DEFAULT_SAMPLE_SIZE, dict_size=DEFAULT_DICT_SIZE, retrain=False,
+                           page_size=DEFAULT_PAGE_SIZE):
+    """
+    Write all the posts of the DB to the compressed store. The dictionary is trained on a sample of the posts on the
+    first run (or with retrain=True), later runs reuse the latest one. Returns the plain and compressed bytes per
+    column.
+    """
+    conn = open_store(store_path)
+    row = conn.execute("select dict_id from compression_dicts order by created_at desc, rowid desc limit 1").fetchone()
+    if row is None or retrain:
+        column_codec = train_codec(sample_posts(db_path, sample_size), codec, level, dict_size)
+        conn.execute("insert or ignore into compression_dicts (dict_id, codec, dictionary) values (?, ?, ?)",
+                     (column_codec.dict_id, column_codec.codec, column_codec.dictionary))
+        conn.commit()
+    else:
+        column_codec = load_store_codecs(conn, level)[row['dict_id']]
+
+    sizes = {column: {'plain_bytes': 0, 'compressed_bytes': 0} for column in COMPRESSED_COLUMNS}
+    columns_sql = "post_id, post_title, llm_processed, llm_model_name, " + ", ".join(COMPRESSED_COLUMNS)
+    num_posts = 0
+    start_time = time.perf_counter()
+    for page in iter_post_pages(columns_sql, db_path, page_size=page_size, only_processed=False):
+        rows = []
+        for post in page:
+            values = []
+            for column in COMPRESSED_COLUMNS:
+                blob = column_codec.compress(post[column])
+                values.append(blob)
+                if blob is not None:
+                    sizes[column]['plain_bytes'] += len(post[column].encode('utf-8'))
+                    sizes[column]['compressed_bytes'] += len(blob)
+            rows.append((post['post_id'], column_codec.dict_id, post['post_title'], *values, post['llm_processed'],
+                         post['llm_model_name']))
+        conn.executemany('''
+            insert or replace into posts_compressed (post_id, dict_id, post_title, post_formatted_comments,
+                                                     comment_path_map, comment_info_map, llm_response_summary,
+                                                     llm_processed, llm_model_name)
+            values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        num_posts += len(page)
+    conn.close()
+
+    for column_sizes in sizes.values():
+        column_sizes['ratio'] = round(column_sizes['plain_bytes'] / max(column_sizes['compressed_bytes'], 1), 2)
+    print(f"...Compressed {num_posts} posts to {store_path} in {time.perf_counter() - start_time:.1f} seconds: "
+          + ", ".join(f"{column} {column_sizes['ratio']}x" for column, column_sizes in sizes.items()))
+    return sizes
+
+
+def iter_compressed_pages(store_path=DEFAULT_STORE_PATH, page_size=DEFAULT_PAGE_SIZE, min_post_id=-1,
+                          max_post_id=None):
+    """Yield pages of the processed posts of the store, with STORE_EXPORT_COLUMNS_SQL (still compressed)"""
+    conn = open_store(store_path)
+    query = f'''
+        select {STORE_EXPORT_COLUMNS_SQL}
+        from posts_compressed
+        where post_id > ? and post_id <= ? and llm_processed = 1
+        order by post_id
+        limit ?
+    '''
+    try:
+        yield from _iter_pages(conn, query, min_post_id, max_post_id or 2 ** 63 - 1, page_size)
+    finally:
+        conn.close()
+
+
+def export_compressed_dataset(output_dir, store_path=DEFAULT_STORE_PATH, split_fn=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Export the processed posts of the store to Parquet shards under <output_dir>/data, with the comments and the
+    summary compressed, and the dictionaries to <output_dir>/dictionaries.parquet.
+    Returns a dict of split name to number of rows exported.
+    """
+    if split_fn is None:
+        split_fn = make_hash_split_fn()
+
+    data_dir = os.path.join(output_dir, "data")
+    _clear_shards(data_dir)
+
+    manifest = new_manifest()
+    write_rows_to_shards(iter_compressed_pages(store_path, page_size), data_dir, split_fn, manifest,
+                         compression=COMPRESSED_EXPORT_COMPRESSION, schema=COMPRESSED_EXPORT_SCHEMA)
+
+    conn = open_store(store_path)
+    dictionaries = [dict(row) for row in conn.execute("select dict_id, codec, dictionary from compression_dicts")]
+    conn.close()
+    pq.write_table(pa.Table.from_pylist(dictionaries), os.path.join(output_dir, DICTIONARIES_FILE))
+
+    return _finish_export(output_dir, manifest)
+
+
+def load_export_codecs(export_dir, level=DEFAULT_LEVEL):
+    """dict_id -> ColumnCodec of a compressed export, or None if the export is not compressed"""
+    dictionaries_path = os.path.join(export_dir, DICTIONARIES_FILE)
+    if not os.path.exists(dictionaries_path):
+        return None
+    return {row['dict_id']: ColumnCodec(row['dictionary'], row['codec'], level)
+            for row in pq.read_table(dictionaries_path).to_pylist()}
+
+
+def shard_export_codecs(shard_paths):
+    """Codecs of the export that the shards (data/<split>-*.parquet) belong to, or None if it is not compressed"""
+    return load_export_codecs(os.path.dirname(os.path.dirname(os.path.abspath(shard_paths[0]))))
+
+
+def format_input_comment(post_title, post_formatted_comments):
+    """The input_comment of a post, the same text as EXPORT_COLUMNS_SQL (see hn_export.py)"""
+    return f"---- Post Title: \n{post_title}\n----- Comments: \n{post_formatted_comments}"
+
+
+def decompressing_func(func, codecs):
+    """
+    Wrap a batched map function of the posts (eg. the one of make_tokenize_func()) to take batches of a compressed
+    export: the posts of the batch are decompressed right before they are passed to func
+    """
+
+    def decompress_func(examples):
+        input_comments = []
+        output_summaries = []
+        for post_title, dict_id, comments_blob, summary_blob in zip(examples['post_title'], examples['dict_id'],
+                                                                     examples['post_formatted_comments'],
+                                                                     examples['output_summary']):
+            column_codec = codecs[dict_id]
+            input_comments.append(format_input_comment(post_title, column_codec.decompress(comments_blob)))
+            output_summaries.append(column_codec.decompress(summary_blob))
+        return func({'post_id': examples['post_id'], 'input_comment': input_comments,
+                     'output_summary': output_summaries})
+
+    return decompress_func
+
+
+def decompress_dataset(dataset, codecs):
+    """
+    The split of a compressed export with the columns of the plain export (post_id, input_comment, output_summary).
+    Nothing is decompressed until rows are read.
+    """
+    return dataset.with_transform(decompressing_func(lambda examples: examples, codecs))
+
+
+def _column_bytes(pages, columns):
+    """Number of rows and bytes of the column values of the pages (what an export reads from the DB)"""
+    num_rows = num_bytes = 0
+    for page in pages:
+        num_rows += len(page)
+        for row in page:
+            for column in columns:
+                value = row[column]
+                num_bytes += len(value.encode('utf-8') if isinstance(value, str) else value)
+    return num_rows, num_bytes
+
+
+def _upload_bytes(export_dir):
+    """Bytes of the files that upload_export_dir() (see hn_upload.py) uploads"""
+    paths = [os.path.join(export_dir, name) for name in ["README.md", "manifest.json", DICTIONARIES_FILE]]
+    data_dir = os.path.join(export_dir, "data")
+    paths += [os.path.join(data_dir, name) for name in os.listdir(data_dir) if name.endswith(".parquet")]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def _vacuumed_size(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("pragma wal_checkpoint(truncate)")
+    conn.execute("vacuum")
+    conn.close()
+    return os.path.getsize(db_path)
+
+
+def measure_compressed_storage(db_path, work_dir, codec=None, level=DEFAULT_LEVEL, sample_size=DEFAULT_SAMPLE_SIZE):
+    """DB size, bytes read by an export and bytes to upload, plain and compressed. Returns the report."""
+    from hn_export import EXPORT_COLUMNS_SQL, export_dataset_from_db
+
+    store_path = os.path.join(work_dir, "hn_posts_compressed.db")
+    column_sizes = build_compressed_store(db_path, store_path, codec, level, sample_size)
+
+    # The plain DB only counts the compressed columns and the title, like the store
+    plain_path = os.path.join(work_dir, "hn_posts_plain.db")
+    conn = sqlite3.connect(plain_path)
+    conn.execute("attach database ? as source", (db_path,))
+    conn.execute("create table posts_comments as select post_id, post_title, llm_processed, llm_model_name, "
+                 + ", ".join(COMPRESSED_COLUMNS) + " from source.posts_comments")
+    conn.commit()
+    conn.execute("detach database source")
+    conn.close()
+
+    _, plain_read_bytes = _column_bytes(iter_post_pages(EXPORT_COLUMNS_SQL, db_path),
+                                        ["input_comment", "output_summary"])
+    num_rows, compressed_read_bytes = _column_bytes(iter_compressed_pages(store_path),
+                                                    ["post_title", "post_formatted_comments", "output_summary"])
+
+    start_time = time.perf_counter()
+    export_dataset_from_db(os.path.join(work_dir, "export-plain"), db_path)
+    plain_export_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    export_compressed_dataset(os.path.join(work_dir, "export-compressed"), store_path)
+    compressed_export_seconds = time.perf_counter() - start_time
+
+    # Decompression at format time: all the posts of the compressed export
+    from datasets import load_dataset
+
+    export_dir = os.path.join(work_dir, "export-compressed")
+    codecs = load_export_codecs(export_dir)
+    dataset = load_dataset("parquet", data_dir=os.path.join(export_dir, "data"), split="train",
+                           cache_dir=os.path.join(work_dir, "hf"))
+    start_time = time.perf_counter()
+    decompressed = decompress_dataset(dataset, codecs)
+    for batch_start in range(0, len(decompressed), 256):
+        decompressed[batch_start:batch_start + 256]
+    decompress_seconds = time.perf_counter() - start_time
+
+    def measure(plain, compressed):
+        return {'plain': plain, 'compressed': compressed, 'factor': round(plain / compressed, 2)}
+
+    return {
+        'codec': codec or default_codec(),
+        'posts': num_rows,
+        'columns': column_sizes,
+        'db_bytes': measure(_vacuumed_size(plain_path), _vacuumed_size(store_path)),
+        'export_read_bytes': measure(plain_read_bytes, compressed_read_bytes),
+        'upload_bytes': measure(_upload_bytes(os.path.join(work_dir, "export-plain")), _upload_bytes(export_dir)),
+        'export_seconds': {'plain': round(plain_export_seconds, 2), 'compressed': round(compressed_export_seconds, 2)},
+        'decompress_ms_per_post': round(decompress_seconds * 1000 / max(len(dataset), 1), 3),
+    }
+
+
+if __name__ == "__main__":
+    import json
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Measure the dictionary-compressed storage of the posts")
+    parser.add_argument("--db", default=None, help="Posts DB to measure. Default: a synthetic DB")
+    parser.add_argument("--posts", type=int, default=2000, help="Number of synthetic posts")
+    parser.add_argument("--codec", default=None, choices=["zstd", "zlib"],
+                        help="Default: zstd if zstandard is installed, zlib otherwise")
+    parser.add_argument("--level", type=int, default=DEFAULT_LEVEL)
+    parser.add_argument("--sample-size", type=int, default=DEFAULT_SAMPLE_SIZE, help="Posts to train the dictionary on")
+    parser.add_argument("--output", default="outputs/compression_benchmark.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_db = args.db
+        if source_db is None:
+            from hn_synthetic import write_synthetic_db
+
+            source_db = os.path.join(tmp_dir, "hn_posts.db")
+            write_synthetic_db(source_db, args.posts)
+        report = measure_compressed_storage(source_db, tmp_dir, args.codec, args.level, args.sample_size)
+
+    print(json.dumps(report, indent=2))
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Compression results written to {args.output}")
@@ -0,0 +1,131 @@
+"""
+Local cache of the dataset splits, in front of the HF Hub (or a local directory that stands in for it)
+
+load_dataset() resolves the repo on the Hub on every call, and calling it once per split resolves it again every
+time. load_cached_dataset() resolves the repo revision once, downloads the Parquet files of that revision and
+converts every split to Arrow files on local disk:
+
+    <cache_dir>/<repo key>/<revision sha>/<split>/...   Arrow files, memory-mapped by load_from_disk()
+    <cache_dir>/<repo key>/refs/<revision name>         revision sha that the name (eg: main) resolved to last time
+
+The cache is content addressed by the revision sha, so data of a revision never changes once cached. Pinning a
+revision (a sha) or using offline mode skips the Hub completely: a warm start is just memory-mapping the Arrow files.
+Offline mode is on when offline=True or HF_HUB_OFFLINE=1, and uses the last revision seen for the name.
+Loaded datasets are also kept in memory, so that all the callers in one process share them.
+"""
+
+import os
+import re
+import shutil
+
+from datasets import Dataset, DatasetDict, load_from_disk
+
+from hn_export import SPLITS, split_of_shard
+from hn_hub import open_hub_repo
+
+DEFAULT_CACHE_DIR = "cache/datasets"
+
+# (cache path of a revision) -> DatasetDict loaded in this process
+_loaded_datasets = {}
+
+
+def is_offline():
+    return os.environ.get('HF_HUB_OFFLINE', '0').lower() in ('1', 'true', 'yes')
+
+
+def repo_cache_key(repo_id_or_dir):
+    # annjose/hn-comments-small -> annjose--hn-comments-small
+    return re.sub(r'[^A-Za-z0-9._-]+', '--', repo_id_or_dir.strip('/'))
+
+
+def _read_ref(repo_cache_dir, revision_name):
+    ref_path = os.path.join(repo_cache_dir, "refs", revision_name)
+    if not os.path.exists(ref_path):
+        return None
+    with open(ref_path) as f:
+        return f.read().strip()
+
+
+def _write_ref(repo_cache_dir, revision_name, sha):
+    os.makedirs(os.path.join(repo_cache_dir, "refs"), exist_ok=True)
+    with open(os.path.join(repo_cache_dir, "refs", revision_name), "w") as f:
+        f.write(sha)
+
+
+def _build_revision_cache(hub_repo, sha, revision_path):
+    """Download the Parquet files of the revision and save every split as Arrow files under revision_path"""
+    download_dir = revision_path + ".download"
+    tmp_path = revision_path + ".tmp"
+    shutil.rmtree(download_dir, ignore_errors=True)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    files_by_split = {}
+    for path in hub_repo.list_files(revision=sha):
+        if path.startswith("data/") and path.endswith(".parquet"):
+            files_by_split.setdefault(split_of_shard(path), []).append(path)
+    if not files_by_split:
+        raise ValueError(f"No data files (data/*.parquet) found in {hub_repo} at revision {sha}")
+
+    for split, paths in files_by_split.items():
+        local_paths = [hub_repo.download_file(path, download_dir, revision=sha) for path in sorted(paths)]
+        print(f"...Caching split '{split}' from {len(local_paths)} files")
+        split_dataset = Dataset.from_parquet(local_paths, cache_dir=os.path.join(download_dir, ".hf_cache"))
+        split_dataset.save_to_disk(os.path.join(tmp_path, split))
+
+    shutil.rmtree(download_dir, ignore_errors=True)
+    # Rename at the end, so that an interrupted run doesn't leave a partial revision in the cache
+    os.replace(tmp_path, revision_path)
+
+
+def cached_revision_path(repo_id_or_dir, revision=None, cache_dir=DEFAULT_CACHE_DIR, offline=None, token=None):
+    """
+    Cache directory of the revision of the dataset repo (HF repo id or local directory), with one directory of Arrow
+    files per split. The revision is downloaded if it's not in the cache yet. revision can be a branch, tag or commit
+    sha. Defaults to main.
+    """
+    if offline is None:
+        offline = is_offline()
+    revision_name = revision or "main"
+    repo_cache_dir = os.path.join(cache_dir, repo_cache_key(repo_id_or_dir))
+
+    # Resolve the revision name to a sha: from the refs in the cache if offline, else from the repo
+    if offline:
+        sha = _read_ref(repo_cache_dir, revision_name)
+        if sha is None and os.path.isdir(os.path.join(repo_cache_dir, revision_name)):
+            # Revision pinned to a sha that is already in the cache
+            sha = revision_name
+        if sha is None:
+            raise ValueError(f"Offline mode: revision '{revision_name}' of {repo_id_or_dir} is not in cache {cache_dir}")
+        hub_repo = None
+    else:
+        hub_repo = open_hub_repo(repo_id_or_dir, token=token)
+        sha = hub_repo.resolve_revision(revision)
+
+    revision_path = os.path.join(repo_cache_dir, sha)
+    if not os.path.isdir(revision_path):
+        if offline:
+            raise ValueError(f"Offline mode: revision {sha} ('{revision_name}') of {repo_id_or_dir} is not in cache "
+                             f"{cache_dir}. Run once online to download it.")
+        print(f"...Dataset {repo_id_or_dir} revision {sha} is not in cache. Downloading...")
+        _build_revision_cache(hub_repo, sha, revision_path)
+    # The ref is written only once the revision is in the cache, so offline mode never finds a ref without its data
+    if not offline:
+        _write_ref(repo_cache_dir, revision_name, sha)
+    return revision_path
+
+
+def load_cached_dataset(repo_id_or_dir, revision=None, cache_dir=DEFAULT_CACHE_DIR, offline=None, token=None):
+    """
+    Load all splits of the dataset repo (HF repo id or local directory) as a DatasetDict, from the local cache
+    if possible. revision can be a branch, tag or commit sha. Defaults to main.
+    """
+    revision_path = cached_revision_path(repo_id_or_dir, revision, cache_dir, offline, token)
+    if revision_path in _loaded_datasets:
+        return _loaded_datasets[revision_path]
+
+    dataset_dict = DatasetDict({
+        split: load_from_disk(os.path.join(revision_path, split))
+        for split in sorted(os.listdir(revision_path), key=lambda s: SPLITS.index(s) if s in SPLITS else len(SPLITS))
+    })
+    _loaded_datasets[revision_path] = dataset_dict
+    return dataset_dict
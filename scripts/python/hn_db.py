@@ -0,0 +1,164 @@
+"""
+Access to the posts DB (data/hn_posts.db, created by download.js)
+
+All readers share one SQLite connection per DB file (per process), opened with pragmas for large sequential reads:
+WAL journal (readers don't block the JS scripts that write), memory-mapped I/O and a large page cache.
+The first connection also creates the index on llm_processed that the exports filter on.
+
+Sets of post ids are never put in the SQL text. They are inserted in a temp table with bound parameters and joined,
+so the statement text is the same for any number of ids (it is prepared once and cached) and there is no limit on
+the number of ids.
+"""
+
+import os
+import sqlite3
+from contextlib import contextmanager
+
+DB_PATH = "../data/hn_posts.db"
+
+# Read-optimized settings, applied to every connection
+CONNECTION_PRAGMAS = [
+    "pragma journal_mode = WAL",
+    "pragma mmap_size = 268435456",  # 256 MB
+    "pragma cache_size = -65536",    # 64 MB (negative value is in KB)
+    "pragma temp_store = MEMORY",
+]
+
+INDEXES_SQL = [
+    "create index if not exists idx_posts_comments_llm_processed on posts_comments (llm_processed, post_id)",
+]
+
+# (db path, process id) -> connection. Connections must not be shared with forked worker processes.
+_connections = {}
+
+
+def get_connection(db_path=DB_PATH):
+    """Return the shared connection to the DB, opening it on first use"""
+    key = (os.path.abspath(db_path), os.getpid())
+    conn = _connections.get(key)
+    if conn is not None:
+        return conn
+
+    if not os.path.exists(db_path):
+        raise ValueError(f"DB file not found: {db_path}")
+
+    conn = sqlite3.connect(db_path, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    try:
+        for index_sql in INDEXES_SQL:
+            conn.execute(index_sql)
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        # Read-only DB file: queries still work, just without the index
+        print(f"...Could not create indexes on {db_path}: {e}")
+
+    _connections[key] = conn
+    return conn
+
+
+def db_file_state(db_path=DB_PATH):
+    """
+    (mtime_ns, size) of the DB file and of its WAL file. Every write to the DB changes one of them, so it tells if
+    the DB may have changed since a result was cached.
+    """
+    # Open the shared connection first: the first connection of a DB creates the indexes, which writes to the file
+    get_connection(db_path)
+    stat = os.stat(db_path)
+    state = [stat.st_mtime_ns, stat.st_size]
+    # Every connection creates an empty WAL file (and the last one deletes it), so only a WAL with data counts
+    wal_path = db_path + "-wal"
+    if os.path.exists(wal_path) and os.path.getsize(wal_path) > 0:
+        wal_stat = os.stat(wal_path)
+        state += [wal_stat.st_mtime_ns, wal_stat.st_size]
+    return tuple(state)
+
+
+def close_connections():
+    for key in [key for key in _connections if key[1] == os.getpid()]:
+        _connections.pop(key).close()
+
+
+@contextmanager
+def post_ids_temp_table(conn, post_ids, table_name="tmp_post_ids"):
+    """Put the post ids in a temp table (for joins) for the duration of the with block"""
+    conn.execute(f"drop table if exists temp.{table_name}")
+    conn.execute(f"create temp table {table_name} (post_id integer primary key)")
+    try:
+        conn.executemany(f"insert or ignore into temp.{table_name} (post_id) values (?)",
+                         ((int(post_id),) for post_id in post_ids))
+        yield table_name
+    finally:
+        conn.execute(f"drop table if exists temp.{table_name}")
+
+
+def iter_post_pages(columns_sql, db_path=DB_PATH, post_ids=None, page_size=50, only_processed=True, min_post_id=-1,
+                    max_post_id=None):
+    """
+    Yield pages (lists of row dicts with the given select columns) from posts_comments with
+    min_post_id < post_id <= max_post_id, ordered by post_id. Each page is one query that continues after the last
+    post_id of the previous page. If post_ids is given, only those posts are read (only_processed is ignored).
+    """
+    conn = get_connection(db_path)
+    if max_post_id is None:
+        max_post_id = 2 ** 63 - 1
+
+    if post_ids is not None:
+        with post_ids_temp_table(conn, post_ids) as table_name:
+            query = f'''
+                select {columns_sql}
+                from posts_comments
+                join temp.{table_name} using (post_id)
+                where post_id > ? and post_id <= ?
+                order by post_id
+                limit ?
+            '''
+            yield from _iter_pages(conn, query, min_post_id, max_post_id, page_size)
+        return
+
+    processed_filter = "and llm_processed = 1" if only_processed else ""
+    query = f'''
+        select {columns_sql}
+        from posts_comments
+        where post_id > ? and post_id <= ? {processed_filter}
+        order by post_id
+        limit ?
+    '''
+    yield from _iter_pages(conn, query, min_post_id, max_post_id, page_size)
+
+
+def _iter_pages(conn, query, min_post_id, max_post_id, page_size):
+    last_post_id = min_post_id
+    while True:
+        rows = conn.execute(query, (last_post_id, max_post_id, page_size)).fetchall()
+        if not rows:
+            return
+        yield [dict(row) for row in rows]
+        last_post_id = int(rows[-1]['post_id'])
+
+
+def post_id_ranges(num_partitions, db_path=DB_PATH, only_processed=True):
+    """
+    Split the posts into up to num_partitions ranges with about the same number of posts each.
+    Returns a list of (min_post_id, max_post_id) with min exclusive and max inclusive, as used by iter_post_pages().
+    """
+    conn = get_connection(db_path)
+    processed_filter = "where llm_processed = 1" if only_processed else ""
+    num_posts = conn.execute(f"select count(*) from posts_comments {processed_filter}").fetchone()[0]
+    if num_posts == 0:
+        return []
+
+    num_partitions = max(1, min(num_partitions, num_posts))
+    # The last post_id of every partition, read from the index (llm_processed, post_id)
+    query = f"select post_id from posts_comments {processed_filter} order by post_id limit 1 offset ?"
+    boundaries = [conn.execute(query, (num_posts * (i + 1) // num_partitions - 1,)).fetchone()[0]
+                  for i in range(num_partitions)]
+
+    ranges = []
+    previous = -1
+    for boundary in boundaries:
+        if boundary > previous:
+            ranges.append((previous, boundary))
+            previous = boundary
+    return ranges
@@ -0,0 +1,358 @@
+"""
+Near-duplicate and boilerplate removal for the training data
+
+Two passes over the rows, before they are formatted and tokenized:
+
+1. Near-duplicate posts (the same story posted twice, or the same thread downloaded at different times) are found
+   with MinHash + LSH. Every post is reduced to the set of 5-word shingles of its comment texts (without the scores
+   and reply counts, which change between downloads), and the set to a signature of 128 minimum hashes. Signatures
+   are computed with numpy in blocks of shingles of many posts at a time. The signatures are then split in bands and
+   posts with an identical band are candidates, so finding the pairs is linear in the number of posts and not
+   quadratic. Candidates are confirmed with the estimated Jaccard similarity of their signatures. Of every group of
+   near-duplicates only the post with the longest comments is kept, and training posts that are near-duplicates of
+   a validation or test post are dropped.
+
+2. Boilerplate comments ("[deleted]", "This.", bot replies) and comments repeated in the same thread are removed.
+   A comment is boilerplate if the same text (normalized) appears in boilerplate_min_posts posts or more. Only
+   comments without replies are removed, so the tree structure of the thread is kept.
+
+dedup_dataset() returns the reduced dataset and a report of the posts, bytes and tokens removed.
+cached_dedup_dataset() saves both to disk under a fingerprint of the data and the settings, so a restarted or resumed
+training run loads them instead of computing the signatures again.
+
+Usage:
+    uv run hn_dedup.py --dataset annjose/hn-comments-small --tokenizer unsloth/llama-3-8b-bnb-4bit
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import zlib
+
+import numpy as np
+
+from hn_thread import COMMENT_LINE_PATTERN, _render, estimate_tokens, parse_thread
+
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 16
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_SHINGLE_SIZE = 5
+DEFAULT_BOILERPLATE_MIN_POSTS = 5
+DEFAULT_CACHE_DIR = "cache/dedup"
+REPORT_FILE = "dedup_report.json"
+
+# Number of shingles hashed at once when computing signatures. The hash matrix is block size x num_perm uint32.
+SIGNATURE_BLOCK_SIZE = 16384
+
+MAX_HASH = np.uint32(0xFFFFFFFF)
+
+# Everything before the comment text: [1.2] (score: 850) <replies: 2> {downvotes: 0} author:
+COMMENT_PREFIX_PATTERN = re.compile(
+    r'^\[[\d.]+\] \(score: [^)]*\)(?: <replies: \d+>)?(?: \{downvotes: \d+\})?[^:\n]*: ', re.MULTILINE)
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def _fmix32(h):
+    # Final mix of murmur3, applied to uint32 arrays (multiplication wraps around)
+    h = h ^ (h >> np.uint32(16))
+    h = h * np.uint32(0x85ebca6b)
+    h = h ^ (h >> np.uint32(13))
+    h = h * np.uint32(0xc2b2ae35)
+    return h ^ (h >> np.uint32(16))
+
+
+def comment_text(line):
+    """The text of a comment line, without the path, score, counts and author"""
+    return COMMENT_PREFIX_PATTERN.sub('', line, count=1)
+
+
+def normalized_words(text):
+    """Lower case words of the title and comment texts of a formatted thread (the comment prefixes are dropped)"""
+    return WORD_PATTERN.findall(COMMENT_PREFIX_PATTERN.sub('', text).lower())
+
+
+def shingle_hashes(words, word_hash_cache, shingle_size=DEFAULT_SHINGLE_SIZE):
+    """uint32 hashes of the shingles (runs of shingle_size words) of the words"""
+    if not words:
+        return np.zeros(0, dtype=np.uint32)
+
+    word_hashes = np.empty(len(words), dtype=np.uint32)
+    for i, word in enumerate(words):
+        word_hash = word_hash_cache.get(word)
+        if word_hash is None:
+            word_hash = word_hash_cache[word] = zlib.crc32(word.encode('utf-8'))
+        word_hashes[i] = word_hash
+
+    size = min(shingle_size, len(words))
+    num_shingles = len(words) - size + 1
+    hashes = np.zeros(num_shingles, dtype=np.uint32)
+    for k in range(size):
+        hashes = (hashes * np.uint32(0x01000193)) ^ word_hashes[k:k + num_shingles]
+    return _fmix32(hashes)
+
+
+def minhash_signatures(hash_arrays, num_perm=DEFAULT_NUM_PERM, seed=0, block_size=SIGNATURE_BLOCK_SIZE):
+    """
+    MinHash signatures (num docs x num_perm uint32) of the shingle hash arrays of the docs.
+    The shingles of all the docs are processed together in blocks of block_size, whatever the size of each doc.
+    Docs without shingles get a signature of all MAX_HASH.
+    """
+    rng = np.random.default_rng(seed)
+    # Random odd multipliers and offsets: x -> a * x + b (mod 2^32) are num_perm different permutations of the
+    #  shingle hashes (which are already well mixed by shingle_hashes())
+    a = rng.integers(0, 2 ** 32, size=num_perm, dtype=np.uint64).astype(np.uint32) | np.uint32(1)
+    b = rng.integers(0, 2 ** 32, size=num_perm, dtype=np.uint64).astype(np.uint32)
+
+    signatures = np.full((len(hash_arrays), num_perm), MAX_HASH, dtype=np.uint32)
+    if not hash_arrays:
+        return signatures
+
+    lengths = np.array([len(hashes) for hashes in hash_arrays], dtype=np.int64)
+    all_hashes = np.concatenate(hash_arrays)
+    doc_of_shingle = np.repeat(np.arange(len(hash_arrays)), lengths)
+
+    for start in range(0, len(all_hashes), block_size):
+        block = all_hashes[start:start + block_size]
+        block_docs = doc_of_shingle[start:start + block_size]
+        # num_perm x block, so that the min over the shingles of a doc runs over contiguous memory
+        permuted = np.multiply(a[:, None], block[None, :])
+        permuted += b[:, None]
+
+        # Min over the shingles of every doc in the block. A doc can continue in the next block, so combine with
+        #  the minimum found so far.
+        segment_starts = np.flatnonzero(np.r_[True, block_docs[1:] != block_docs[:-1]])
+        docs = block_docs[segment_starts]
+        signatures[docs] = np.minimum(signatures[docs], np.minimum.reduceat(permuted, segment_starts, axis=1).T)
+
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands=DEFAULT_BANDS, valid=None):
+    """
+    Pairs (i, j) of docs that have an identical band of their signatures. Every doc of a bucket is paired with the
+    first doc of the bucket, so the number of pairs is linear in the number of docs.
+    """
+    num_docs, num_perm = signatures.shape
+    rows = num_perm // bands
+    doc_ids = np.arange(num_docs) if valid is None else np.flatnonzero(valid)
+
+    pairs = set()
+    for band in range(bands):
+        band_values = np.ascontiguousarray(signatures[doc_ids, band * rows:(band + 1) * rows])
+        band_keys = band_values.view(np.dtype((np.void, band_values.dtype.itemsize * rows))).ravel()
+        _, first_index, bucket = np.unique(band_keys, return_index=True, return_inverse=True)
+        first_doc = doc_ids[first_index[bucket]]
+        for i, j in zip(first_doc[first_doc != doc_ids], doc_ids[first_doc != doc_ids]):
+            pairs.add((int(i), int(j)))
+    return pairs
+
+
+def find_near_duplicate_clusters(signatures, threshold=DEFAULT_THRESHOLD, bands=DEFAULT_BANDS, valid=None):
+    """Groups (lists of doc indices, 2 or more) of docs with an estimated Jaccard similarity >= threshold"""
+    parent = list(range(len(signatures)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in lsh_candidate_pairs(signatures, bands, valid):
+        if np.mean(signatures[i] == signatures[j]) >= threshold:
+            parent[find(i)] = find(j)
+
+    clusters = {}
+    for i in range(len(signatures)):
+        clusters.setdefault(find(i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def _comment_key(line):
+    return ' '.join(WORD_PATTERN.findall(comment_text(line).lower()))
+
+
+def find_boilerplate_comments(texts, min_posts=DEFAULT_BOILERPLATE_MIN_POSTS):
+    """Normalized comment texts that appear in min_posts or more of the posts"""
+    num_posts = {}
+    for text in texts:
+        keys = {_comment_key(line) for line in text.split('\n') if COMMENT_LINE_PATTERN.match(line)}
+        for key in keys:
+            num_posts[key] = num_posts.get(key, 0) + 1
+    return {key for key, count in num_posts.items() if count >= min_posts}
+
+
+def remove_duplicate_comments(text, boilerplate):
+    """
+    Remove the comments without replies that are boilerplate, or that repeat an earlier comment of the thread.
+    Returns the text unchanged if nothing is removed.
+    """
+    header, top_level = parse_thread(text)
+    seen = set()
+    removed = set()
+    stack = list(reversed(top_level))
+    while stack:
+        node = stack.pop()
+        key = _comment_key(node.lines[0])
+        if not node.children and len(node.lines) == 1 and (key in boilerplate or key in seen or not key):
+            removed.add(node.path)
+        seen.add(key)
+        stack.extend(reversed(node.children))
+
+    if not removed:
+        return text
+
+    kept = set()
+    stack = list(top_level)
+    while stack:
+        node = stack.pop()
+        if node.path not in removed:
+            kept.add(node.path)
+        stack.extend(node.children)
+    return _render(header, top_level, kept)
+
+
+def _count_tokens(texts, count_tokens, batch_size=64):
+    return sum(sum(count_tokens(texts[i:i + batch_size])) for i in range(0, len(texts), batch_size))
+
+
+def dedup_dataset(dataset, reference_datasets=(), threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM,
+                  bands=DEFAULT_BANDS, boilerplate_min_posts=DEFAULT_BOILERPLATE_MIN_POSTS,
+                  count_tokens=estimate_tokens):
+    """
+    Remove near-duplicate posts and boilerplate comments from the dataset (see the module docstring).
+    Posts that are near-duplicates of a post in one of the reference_datasets (eg. validation and test) are removed.
+    Returns (dataset, report dict).
+    """
+    texts = list(dataset['input_comment'])
+    reference_texts = [text for reference in reference_datasets for text in reference['input_comment']]
+    all_texts = texts + reference_texts
+
+    print(f"\nComputing MinHash signatures of {len(texts)} posts (+{len(reference_texts)} reference posts)...")
+    word_hash_cache = {}
+    hash_arrays = [shingle_hashes(normalized_words(text), word_hash_cache) for text in all_texts]
+    signatures = minhash_signatures(hash_arrays, num_perm)
+    valid = np.array([len(hashes) > 0 for hashes in hash_arrays], dtype=bool)
+    clusters = find_near_duplicate_clusters(signatures, threshold, bands, valid)
+
+    post_ids = list(dataset['post_id'])
+    dropped_rows = set()
+    duplicate_groups = []
+    reference_duplicates = []
+    for members in clusters:
+        rows = [i for i in members if i < len(texts)]
+        if not rows:
+            continue
+        if len(rows) < len(members):
+            # Near-duplicate of a reference post: keeping it would leak the reference post into training
+            dropped_rows.update(rows)
+            reference_duplicates += [post_ids[i] for i in rows]
+        else:
+            keep = max(rows, key=lambda i: len(texts[i]))
+            dropped_rows.update(i for i in rows if i != keep)
+            duplicate_groups.append([post_ids[i] for i in sorted(rows)])
+
+    kept_rows = [i for i in range(len(texts)) if i not in dropped_rows]
+    deduped = dataset.select(kept_rows)
+
+    boilerplate = find_boilerplate_comments(texts, boilerplate_min_posts)
+
+    def clean_func(examples):
+        return {"input_comment": [remove_duplicate_comments(text, boilerplate) for text in examples["input_comment"]]}
+
+    deduped = deduped.map(clean_func, batched=True, desc="Removing duplicate comments")
+
+    new_texts = list(deduped['input_comment'])
+    report = {
+        'num_posts': len(texts),
+        'num_posts_removed': len(dropped_rows),
+        'duplicate_groups': duplicate_groups,
+        'reference_duplicates': reference_duplicates,
+        'num_boilerplate_comments': len(boilerplate),
+        'bytes_before': sum(len(text.encode('utf-8')) for text in texts),
+        'bytes_after': sum(len(text.encode('utf-8')) for text in new_texts),
+        'tokens_before': _count_tokens(texts, count_tokens),
+        'tokens_after': _count_tokens(new_texts, count_tokens),
+    }
+    return deduped, report
+
+
+def dedup_fingerprint(dataset, reference_datasets, *settings):
+    """Fingerprint of the datasets and the dedup settings (including the token counter, for the report)"""
+    from datasets.fingerprint import Hasher
+
+    hasher = hashlib.sha256()
+    for part in [dataset._fingerprint] + [reference._fingerprint for reference in reference_datasets] + [
+            Hasher.hash(setting) for setting in settings]:
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+
+def cached_dedup_dataset(dataset, reference_datasets=(), threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM,
+                         bands=DEFAULT_BANDS, boilerplate_min_posts=DEFAULT_BOILERPLATE_MIN_POSTS,
+                         count_tokens=estimate_tokens, cache_dir=DEFAULT_CACHE_DIR):
+    """dedup_dataset(), or its result from the cache if it was done before with the same data and settings"""
+    from datasets import load_from_disk
+
+    fingerprint = dedup_fingerprint(dataset, reference_datasets, threshold, num_perm, bands, boilerplate_min_posts,
+                                    count_tokens)
+    cache_path = os.path.join(cache_dir, fingerprint)
+    if os.path.exists(cache_path):
+        print(f"\nLoading deduplicated data from cache: {cache_path}")
+        with open(os.path.join(cache_path, REPORT_FILE)) as f:
+            return load_from_disk(cache_path), json.load(f)
+
+    deduped, report = dedup_dataset(dataset, reference_datasets, threshold, num_perm, bands, boilerplate_min_posts,
+                                    count_tokens)
+
+    # Save to a temp dir first, so that an interrupted run doesn't leave a partial cache entry
+    tmp_path = cache_path + ".tmp"
+    deduped.save_to_disk(tmp_path)
+    with open(os.path.join(tmp_path, REPORT_FILE), 'w') as f:
+        json.dump(report, f)
+    os.replace(tmp_path, cache_path)
+    return load_from_disk(cache_path), report
+
+
+def print_dedup_report(report):
+    print(f"\nDedup: removed {report['num_posts_removed']} of {report['num_posts']} posts")
+    for group in report['duplicate_groups']:
+        print(f"...Near-duplicate posts (kept the longest): {group}")
+    if report['reference_duplicates']:
+        print(f"...Near-duplicates of validation/test posts: {report['reference_duplicates']}")
+    print(f"...Boilerplate comment texts: {report['num_boilerplate_comments']}")
+    bytes_saved = report['bytes_before'] - report['bytes_after']
+    tokens_saved = report['tokens_before'] - report['tokens_after']
+    print(f"...Bytes: {report['bytes_before']} -> {report['bytes_after']} "
+          f"(saved {bytes_saved}, {100 * bytes_saved / max(report['bytes_before'], 1):.1f}%)")
+    print(f"...Tokens: {report['tokens_before']} -> {report['tokens_after']} "
+          f"(saved {tokens_saved}, {100 * tokens_saved / max(report['tokens_before'], 1):.1f}%)")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from hn_dataset_cache import load_cached_dataset
+    from hn_thread import make_tokenizer_counter
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Near-duplicate posts and boilerplate comments in the training data")
+    parser.add_argument("--dataset", default="annjose/hn-comments-small", help="HF dataset id or local directory")
+    parser.add_argument("--tokenizer", default=None, help="Tokenizer for the token counts (default: estimate)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Jaccard similarity threshold")
+    parser.add_argument("--boilerplate-min-posts", type=int, default=DEFAULT_BOILERPLATE_MIN_POSTS)
+    args = parser.parse_args()
+
+    count_tokens = estimate_tokens
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        count_tokens = make_tokenizer_counter(AutoTokenizer.from_pretrained(args.tokenizer))
+
+    dataset_dict = load_cached_dataset(args.dataset, token=os.environ.get('HF_TOKEN'))
+    references = [dataset_dict[split] for split in ['validation', 'test'] if split in dataset_dict]
+    _, report = dedup_dataset(dataset_dict['train'], references, args.threshold,
+                              boilerplate_min_posts=args.boilerplate_min_posts, count_tokens=count_tokens)
+    print_dedup_report(report)
@@ -0,0 +1,515 @@
+"""
+Offline evaluation of the summarization model on the validation or test split
+
+evaluate_dataset() generates a summary for every post with a target and reports:
+- speed: latency and time to first token (TTFT) percentiles per post, output tokens/sec per post and overall
+- quality against output_summary: ROUGE-1/2/L F1 and heading coverage (the share of the reference's markdown
+  headings that the generated summary also has, see summarize-comments.js for the expected sections)
+
+Targets:
+- TransformersTarget: a model loaded in this process, generating in batches (left padded) with greedy decoding
+- OpenAICompatibleTarget: a server with the OpenAI chat completions API (Ollama, llama.cpp server, vLLM), with
+  concurrent streaming requests. start_stub_server() starts a local stub of that API, to check the harness without
+  a model.
+
+Generated summaries are cached in cache/eval/<target fingerprint>.jsonl, keyed by the prompt, so a second run with
+the same target and data only computes the metrics (use_cache=False to generate again).
+
+Usage:
+    uv run hn_eval.py --base-url http://localhost:11434/v1 --model hn-finetune-model --split test
+    uv run hn_eval.py --stub --limit 10
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from hn_dedup import comment_text
+from hn_prompts import SYSTEM_PROMPT, USER_PROMPT_PREFIX, format_prompt
+from hn_thread import estimate_tokens, parse_thread, select_thread
+
+DEFAULT_CACHE_DIR = "cache/eval"
+PERCENTILES = [50, 90, 95, 99]
+
+HEADING_PATTERN = re.compile(r'^#{1,6}\s+(.+?)\s*#*\s*$', re.MULTILINE)
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def _words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+def _f1(overlap, reference_count, candidate_count):
+    if overlap == 0:
+        return 0.0
+    precision = overlap / candidate_count
+    recall = overlap / reference_count
+    return 2 * precision * recall / (precision + recall)
+
+
+def rouge_n(reference_words, candidate_words, n):
+    def ngram_counts(words):
+        counts = {}
+        for i in range(len(words) - n + 1):
+            ngram = tuple(words[i:i + n])
+            counts[ngram] = counts.get(ngram, 0) + 1
+        return counts
+
+    reference_counts = ngram_counts(reference_words)
+    candidate_counts = ngram_counts(candidate_words)
+    overlap = sum(min(count, candidate_counts.get(ngram, 0)) for ngram, count in reference_counts.items())
+    return _f1(overlap, sum(reference_counts.values()), sum(candidate_counts.values()))
+
+
+def rouge_l(reference_words, candidate_words):
+    """F1 of the longest common subsequence of words"""
+    if not reference_words or not candidate_words:
+        return 0.0
+    # One row of the LCS table at a time
+    previous = [0] * (len(candidate_words) + 1)
+    for reference_word in reference_words:
+        current = [0]
+        for j, candidate_word in enumerate(candidate_words):
+            current.append(previous[j] + 1 if reference_word == candidate_word else max(previous[j + 1], current[j]))
+        previous = current
+    return _f1(previous[-1], len(reference_words), len(candidate_words))
+
+
+def summary_headings(text):
+    return [match.group(1) for match in HEADING_PATTERN.finditer(text)]
+
+
+def heading_coverage(reference, candidate, min_overlap=0.5):
+    """Share of the reference headings that match a candidate heading (at least min_overlap of their words)"""
+    reference_headings = [set(_words(heading)) for heading in summary_headings(reference)]
+    candidate_headings = [set(_words(heading)) for heading in summary_headings(candidate)]
+    reference_headings = [words for words in reference_headings if words]
+    if not reference_headings:
+        return None
+    covered = sum(
+        1 for words in reference_headings
+        if any(len(words & candidate_words) >= min_overlap * len(words) for candidate_words in candidate_headings))
+    return covered / len(reference_headings)
+
+
+def quality_metrics(reference, candidate):
+    reference_words = _words(reference)
+    candidate_words = _words(candidate)
+    return {
+        'rouge1': round(rouge_n(reference_words, candidate_words, 1), 4),
+        'rouge2': round(rouge_n(reference_words, candidate_words, 2), 4),
+        'rougeL': round(rouge_l(reference_words, candidate_words), 4),
+        'heading_coverage': heading_coverage(reference, candidate),
+        'num_headings': len(summary_headings(candidate)),
+    }
+
+
+class _GenerationTimer:
+    """
+    Streamer for model.generate() that records the time of the first generated token and, for every row of the
+    batch, the time and number of tokens when it reached the end of sequence
+    """
+
+    def __init__(self, eos_token_ids):
+        self.eos_token_ids = set(eos_token_ids)
+        self.prompt_seen = False
+        self.first_token_time = None
+        self.end_times = None
+        self.num_tokens = None
+
+    def put(self, value):
+        # The first call has the prompt, the next ones the new token of every row
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        now = time.perf_counter()
+        tokens = value.reshape(-1).tolist()
+        if self.first_token_time is None:
+            self.first_token_time = now
+            self.end_times = [None] * len(tokens)
+            self.num_tokens = [0] * len(tokens)
+        for i, token in enumerate(tokens):
+            if self.end_times[i] is None:
+                self.num_tokens[i] += 1
+                if token in self.eos_token_ids:
+                    self.end_times[i] = now
+
+    def end(self):
+        now = time.perf_counter()
+        if self.end_times is not None:
+            self.end_times = [end_time or now for end_time in self.end_times]
+
+
+class TransformersTarget:
+    """Batched greedy generation with a model loaded in this process"""
+
+    def __init__(self, model, tokenizer, model_id, max_new_tokens=1024, batch_size=4, system_prompt=SYSTEM_PROMPT):
+        from hn_thread import make_tokenizer_counter
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_id = model_id
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = batch_size
+        self.system_prompt = system_prompt
+        self.count_tokens = make_tokenizer_counter(tokenizer)
+
+    def cache_key(self):
+        return {'target': 'transformers', 'model': self.model_id, 'max_new_tokens': self.max_new_tokens,
+                'system_prompt': self.system_prompt}
+
+    def prompt(self, comment):
+        return format_prompt(comment, system_prompt=self.system_prompt)
+
+    def generate_inputs(self, prompts):
+        """Keyword arguments of model.generate() for a batch of prompts (left padded)"""
+        self.tokenizer.padding_side = "left"
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+        return {key: value.to(self.model.device) for key, value in inputs.items()}
+
+    def generate_batch(self, prompts):
+        import torch
+
+        eos_token_ids = {self.tokenizer.eos_token_id, self.tokenizer.convert_tokens_to_ids("<|eot_id|>")}
+        timer = _GenerationTimer(token_id for token_id in eos_token_ids if token_id is not None)
+
+        start_time = time.perf_counter()
+        inputs = self.generate_inputs(prompts)
+        with torch.inference_mode():
+            output_ids = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, do_sample=False,
+                                             pad_token_id=self.tokenizer.pad_token_id,
+                                             eos_token_id=list(timer.eos_token_ids), streamer=timer)
+        texts = self.tokenizer.batch_decode(output_ids[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+
+        if timer.first_token_time is None:
+            # Nothing was generated (max_new_tokens=0)
+            return [{'output': text, 'output_tokens': 0, 'latency_seconds': 0.0, 'ttft_seconds': None}
+                    for text in texts]
+        return [{
+            'output': text.strip(),
+            'output_tokens': timer.num_tokens[i],
+            'latency_seconds': round(timer.end_times[i] - start_time, 4),
+            'ttft_seconds': round(timer.first_token_time - start_time, 4),
+        } for i, text in enumerate(texts)]
+
+
+class OpenAICompatibleTarget:
+    """Concurrent streaming requests to a server with the OpenAI chat completions API (eg. Ollama at <host>/v1)"""
+
+    def __init__(self, base_url, model, api_key=None, max_new_tokens=1024, concurrency=4, timeout=600,
+                 system_prompt=SYSTEM_PROMPT, model_id=None):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        # Identifies the model in the cache key (eg. its digest). Default: the server URL and the model name.
+        self.model_id = model_id or f"{self.base_url}/{model}"
+        self.api_key = api_key
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = concurrency
+        self.timeout = timeout
+        self.system_prompt = system_prompt
+        self.count_tokens = estimate_tokens
+
+    def cache_key(self):
+        return {'target': 'openai', 'model': self.model_id, 'max_new_tokens': self.max_new_tokens,
+                'system_prompt': self.system_prompt}
+
+    def prompt(self, comment):
+        return f"{USER_PROMPT_PREFIX}\n{comment}"
+
+    def _generate(self, prompt):
+        body = {
+            'model': self.model,
+            'messages': [{'role': 'system', 'content': self.system_prompt}, {'role': 'user', 'content': prompt}],
+            'max_tokens': self.max_new_tokens,
+            'temperature': 0,
+            'stream': True,
+            'stream_options': {'include_usage': True},
+        }
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(f"{self.base_url}/chat/completions", data=json.dumps(body).encode('utf-8'),
+                                         headers=headers, method='POST')
+
+        start_time = time.perf_counter()
+        first_token_time = None
+        parts = []
+        num_chunks = 0
+        usage = None
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            for line in response:
+                line = line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get('usage') or usage
+                for choice in chunk.get('choices') or []:
+                    content = (choice.get('delta') or {}).get('content')
+                    if content:
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter()
+                        parts.append(content)
+                        num_chunks += 1
+        end_time = time.perf_counter()
+
+        return {
+            'output': "".join(parts).strip(),
+            # Servers that don't report usage stream one token per chunk
+            'output_tokens': usage['completion_tokens'] if usage else num_chunks,
+            'latency_seconds': round(end_time - start_time, 4),
+            'ttft_seconds': round(first_token_time - start_time, 4) if first_token_time else None,
+        }
+
+    def _generate_or_error(self, prompt):
+        try:
+            return self._generate(prompt)
+        except Exception as e:
+            return {'error': f"{type(e).__name__}: {e}"}
+
+    def generate_batch(self, prompts):
+        with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+            return list(executor.map(self._generate_or_error, prompts))
+
+
+def target_fingerprint(target):
+    return hashlib.sha256(json.dumps(target.cache_key(), sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _prompt_key(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+def load_eval_cache(cache_path):
+    """prompt key -> cached result"""
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    cache[record['key']] = record
+    return cache
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    return {f"p{p}": round(float(np.percentile(values, p)), 4) for p in PERCENTILES}
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return round(sum(values) / len(values), 4) if values else None
+
+
+def evaluate_dataset(dataset, target, split="test", limit=None, max_input_tokens=None, cache_dir=DEFAULT_CACHE_DIR,
+                     use_cache=True):
+    """
+    Generate the summaries of the posts of the dataset with the target (or take them from the cache) and return
+    the report with the speed and quality metrics (see the module docstring).
+    max_input_tokens reduces long threads to their highest scored subtrees (see hn_thread.py).
+    """
+    if limit:
+        dataset = dataset.select(range(min(limit, len(dataset))))
+    post_ids = list(dataset['post_id'])
+    references = list(dataset['output_summary'])
+    prompts = []
+    for comment in dataset['input_comment']:
+        if max_input_tokens:
+            comment = select_thread(comment, max_input_tokens, target.count_tokens)
+        prompts.append(target.prompt(comment))
+    keys = [_prompt_key(prompt) for prompt in prompts]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{target_fingerprint(target)}.jsonl")
+    cache = load_eval_cache(cache_path) if use_cache else {}
+    pending = [i for i, key in enumerate(keys) if key not in cache]
+    print(f"\nEvaluating {len(prompts)} posts of the {split} split ({len(prompts) - len(pending)} cached) "
+          f"with target: {target.cache_key()['target']}, batch size: {target.batch_size}")
+
+    results = {key: cache[key] for key in keys if key in cache}
+    generation_seconds = 0.0
+    generated_tokens = 0
+    num_errors = 0
+    with open(cache_path, 'a') as cache_file:
+        for batch_start in range(0, len(pending), target.batch_size):
+            batch = pending[batch_start:batch_start + target.batch_size]
+            start_time = time.perf_counter()
+            batch_results = target.generate_batch([prompts[i] for i in batch])
+            generation_seconds += time.perf_counter() - start_time
+
+            for i, result in zip(batch, batch_results):
+                if 'error' in result:
+                    num_errors += 1
+                    print(f"...Post {post_ids[i]} failed: {result['error']}")
+                    continue
+                result = {'key': keys[i], 'post_id': post_ids[i], **result}
+                results[keys[i]] = result
+                generated_tokens += result['output_tokens']
+                # Cache every result as soon as it's done, so an interrupted run keeps its outputs
+                cache_file.write(json.dumps(result) + '\n')
+                cache_file.flush()
+            print(f"...Generated {min(batch_start + target.batch_size, len(pending))}/{len(pending)} posts")
+
+    examples = []
+    for post_id, key, reference in zip(post_ids, keys, references):
+        if key not in results:
+            continue
+        result = results[key]
+        decode_seconds = result['latency_seconds'] - (result['ttft_seconds'] or 0)
+        examples.append({
+            'post_id': post_id,
+            'cached': key in cache,
+            'output_tokens': result['output_tokens'],
+            'latency_seconds': result['latency_seconds'],
+            'ttft_seconds': result['ttft_seconds'],
+            'tokens_per_sec': round(result['output_tokens'] / decode_seconds, 1) if decode_seconds > 0 else None,
+            **quality_metrics(reference, result['output']),
+        })
+
+    report = {
+        'split': split,
+        'target': target.cache_key(),
+        'num_posts': len(prompts),
+        'num_evaluated': len(examples),
+        'num_cached': sum(1 for example in examples if example['cached']),
+        'num_errors': num_errors,
+        'latency_seconds': _percentiles([example['latency_seconds'] for example in examples]),
+        'ttft_seconds': _percentiles([example['ttft_seconds'] for example in examples
+                                      if example['ttft_seconds'] is not None]),
+        'mean_tokens_per_sec': _mean([example['tokens_per_sec'] for example in examples]),
+        # Generated tokens over the wall time of the generation in this run (cached outputs are not counted)
+        'throughput_tokens_per_sec': round(generated_tokens / generation_seconds, 1) if generation_seconds else None,
+        'rouge1': _mean([example['rouge1'] for example in examples]),
+        'rouge2': _mean([example['rouge2'] for example in examples]),
+        'rougeL': _mean([example['rougeL'] for example in examples]),
+        'heading_coverage': _mean([example['heading_coverage'] for example in examples]),
+        'examples': examples,
+    }
+    return report
+
+
+def print_eval_report(report):
+    print(f"\nEvaluation of the {report['split']} split: {report['num_evaluated']} of {report['num_posts']} posts "
+          f"({report['num_cached']} from the cache, {report['num_errors']} errors)")
+    for name in ['latency_seconds', 'ttft_seconds']:
+        if report[name]:
+            print(f"...{name}: " + ", ".join(f"{key}: {value}" for key, value in report[name].items()))
+    print(f"...Tokens/sec per post: {report['mean_tokens_per_sec']}, "
+          f"throughput: {report['throughput_tokens_per_sec']} tokens/sec")
+    print(f"...ROUGE-1: {report['rouge1']}, ROUGE-2: {report['rouge2']}, ROUGE-L: {report['rougeL']}, "
+          f"heading coverage: {report['heading_coverage']}")
+
+
+def write_eval_report(report, output_path):
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Evaluation report written to {output_path}")
+
+
+def stub_summary(prompt, max_words=None):
+    """Extractive summary of the thread in the prompt: the first sentence of the top comments, under headings"""
+    comments = prompt.split("----- Comments:", 1)[-1]
+    _, top_level = parse_thread(comments)
+    lines = ["# Overview", "The discussion covers the points below.", "", "# Main Themes & Key Insights"]
+    for node in top_level[:3]:
+        text = comment_text(node.lines[0])
+        lines.append(f"* {text.split('. ')[0]}")
+    lines += ["", "# Key Perspectives", "* Commenters share different views.", ""]
+    words = "\n".join(lines).split(" ")
+    return " ".join(words[:max_words] if max_words else words)
+
+
+class _StubChatHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        summary = stub_summary(body['messages'][-1]['content'], body.get('max_tokens'))
+        words = summary.split(" ")
+
+        if not body.get('stream'):
+            response = json.dumps({'choices': [{'message': {'role': 'assistant', 'content': summary}}],
+                                   'usage': {'completion_tokens': len(words)}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i, word in enumerate(words):
+            chunk = {'choices': [{'delta': {'content': word if i == 0 else " " + word}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        usage = {'choices': [], 'usage': {'completion_tokens': len(words)}}
+        self.wfile.write(f"data: {json.dumps(usage)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+
+
+def start_stub_server(port=0):
+    """Start the stub chat completions server in a thread. Returns (server, base url); stop it with shutdown()."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _StubChatHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from hn_dataset_cache import load_cached_dataset
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Evaluate a summarization server on the validation or test split")
+    parser.add_argument("--base-url", default="http://localhost:11434/v1", help="OpenAI compatible API base URL")
+    parser.add_argument("--model", default="hn-finetune-model", help="Model name on the server")
+    parser.add_argument("--stub", action="store_true", help="Evaluate the built-in stub server instead")
+    parser.add_argument("--dataset", default="annjose/hn-comments-small", help="HF dataset id or local directory")
+    parser.add_argument("--synthetic-posts", type=int, default=0, help="Evaluate this many synthetic posts instead")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate only the first posts")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent requests")
+    parser.add_argument("--max-new-tokens", type=int, default=1024)
+    parser.add_argument("--max-input-tokens", type=int, default=None, help="Reduce longer threads to this size")
+    parser.add_argument("--no-cache", action="store_true", help="Generate again instead of using cached outputs")
+    parser.add_argument("--output", default=None, help="JSON report file (default: outputs/eval_<split>.json)")
+    args = parser.parse_args()
+
+    if args.synthetic_posts:
+        from hn_synthetic import make_synthetic_post_dataset
+
+        eval_dataset = make_synthetic_post_dataset(args.synthetic_posts)
+    else:
+        eval_dataset = load_cached_dataset(args.dataset, token=os.environ.get('HF_TOKEN'))[args.split]
+
+    base_url, model, model_id = args.base_url, args.model, None
+    if args.stub:
+        stub_server, base_url = start_stub_server()
+        model = model_id = "stub"
+    eval_target = OpenAICompatibleTarget(base_url, model, api_key=os.environ.get('OPENAI_API_KEY'),
+                                         max_new_tokens=args.max_new_tokens, concurrency=args.concurrency,
+                                         model_id=model_id)
+    eval_report = evaluate_dataset(eval_dataset, eval_target, args.split, args.limit, args.max_input_tokens,
+                                   use_cache=not args.no_cache)
+    print_eval_report(eval_report)
+    write_eval_report(eval_report, args.output or f"outputs/eval_{args.split}.json")
@@ -0,0 +1,468 @@
+"""
+Streaming export of the posts_comments table (data/hn_posts.db) to Parquet shards.
+
+Rows are read from SQLite in pages ordered by post_id (keyset pagination: `where post_id > <last seen id>`), so only
+one page of posts is held in memory at any time, no matter how big the table is. Every split is written to its own
+sequence of Parquet shards under <output_dir>/data using the file names that the HuggingFace Hub maps to splits,
+eg: data/train-00000.parquet, data/train-00001.parquet, data/test-00000.parquet.
+
+Every export also writes a manifest.json next to the shards. It records the watermark (highest post_id exported),
+the content hash of every exported row and the shard that holds it. export_incremental_from_db() uses the manifest
+to write only the new and changed rows to new shards, so that a publish uploads the delta and not the full corpus.
+
+The split of a row (train/validation/test) is computed from a hash of its post_id in the export query, so a post
+stays in the same split across exports, no matter which other posts are added or removed.
+
+A full export of a large table is CPU-bound on building the input_comment strings, hashing and compressing the
+shards. export_dataset_parallel() splits the table into post_id ranges with about the same number of posts and
+exports the ranges in a pool of worker processes. Every worker has its own DB connection and writes its own shards
+(data/<split>-pNNN-NNNNN.parquet), and the manifests of the workers are merged at the end.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from hn_db import DB_PATH, iter_post_pages, post_id_ranges
+from hn_upload import upload_dataset_files
+
+SPLITS = ['train', 'validation', 'test']
+
+EXPORT_SCHEMA = pa.schema([
+    ('post_id', pa.string()),
+    ('input_comment', pa.string()),
+    ('output_summary', pa.string()),
+])
+
+# Multiplicative (Knuth) hash of post_id mapped to a bucket in 0..99. The same formula is used in SQL and in Python.
+#  The top bits of the 32-bit product are used because they are the well mixed ones.
+SPLIT_HASH_MULTIPLIER = 2654435761
+SPLIT_BUCKET_SQL = f"((((post_id * {SPLIT_HASH_MULTIPLIER}) & 4294967295) * 100) >> 32)"
+
+# Percentage of the buckets assigned to each split. The rest of the buckets go to train.
+DEFAULT_VALIDATION_PERCENT = 10
+DEFAULT_TEST_PERCENT = 10
+
+# Select columns are the same as the ones used by posts_from_db() in upload-hface-dataset.py, plus the split bucket
+EXPORT_COLUMNS_SQL = f'''
+    cast(post_id as text) as post_id,
+    '---- Post Title: \n' || post_title || '\n----- Comments: \n' || post_formatted_comments as input_comment,
+    llm_response_summary as output_summary,
+    {SPLIT_BUCKET_SQL} as split_bucket
+'''
+
+# Number of posts read from the DB in one query. Some posts have 120K+ chars of comments, so keep this small.
+DEFAULT_PAGE_SIZE = 50
+
+# Flush the buffered rows of a split to its Parquet shard (as one row group) once they reach this size
+DEFAULT_MAX_BUFFER_BYTES = 32 * 1024 * 1024
+
+# Start a new shard file once the current one has this many rows
+DEFAULT_ROWS_PER_SHARD = 5000
+
+MANIFEST_FILE = "manifest.json"
+README_FILE = "README.md"
+
+
+# Number of post_id ranges per worker of the parallel export. Posts differ a lot in size, so more ranges than
+#  workers keeps all the workers busy until the end.
+PARTITIONS_PER_WORKER = 4
+
+
+def iter_posts_from_db(db_path=DB_PATH, post_ids=None, page_size=DEFAULT_PAGE_SIZE, only_processed=True,
+                       min_post_id=-1, max_post_id=None):
+    """Yield pages (lists of row dicts) from posts_comments with min_post_id < post_id <= max_post_id"""
+    # Every page is an index range scan on the primary key (see hn_db.py). Explicit post ids are joined from a
+    #  temp table, so any number of ids can be exported.
+    yield from iter_post_pages(EXPORT_COLUMNS_SQL, db_path, post_ids=post_ids, page_size=page_size,
+                               only_processed=only_processed, min_post_id=min_post_id, max_post_id=max_post_id)
+
+
+def validate_export_row(row, schema=EXPORT_SCHEMA):
+    """Raise ValueError if the row does not conform to the dataset schema"""
+    for feature in schema.names:
+        if feature not in row:
+            raise ValueError(f"Missing expected feature: {feature}")
+        if row[feature] is None:
+            raise ValueError(f"Feature {feature} is empty for post_id: {row.get('post_id')}")
+
+
+def split_bucket(post_id):
+    """Python version of SPLIT_BUCKET_SQL"""
+    return (((int(post_id) * SPLIT_HASH_MULTIPLIER) & 0xFFFFFFFF) * 100) >> 32
+
+
+def split_for_bucket(bucket, validation_percent=DEFAULT_VALIDATION_PERCENT, test_percent=DEFAULT_TEST_PERCENT):
+    if bucket < test_percent:
+        return 'test'
+    if bucket < test_percent + validation_percent:
+        return 'validation'
+    return 'train'
+
+
+def split_for_post_id(post_id, validation_percent=DEFAULT_VALIDATION_PERCENT, test_percent=DEFAULT_TEST_PERCENT):
+    return split_for_bucket(split_bucket(post_id), validation_percent, test_percent)
+
+
+def make_hash_split_fn(test_post_ids=None, validation_percent=DEFAULT_VALIDATION_PERCENT,
+                       test_percent=DEFAULT_TEST_PERCENT):
+    """
+    Return a function that assigns a split to a row from the hash bucket of its post_id.
+    Posts in test_post_ids are always put in the test split.
+    """
+    test_post_ids = {str(post_id) for post_id in (test_post_ids or [])}
+
+    def split_fn(row):
+        if row['post_id'] in test_post_ids:
+            return 'test'
+        bucket = row['split_bucket'] if 'split_bucket' in row else split_bucket(row['post_id'])
+        return split_for_bucket(bucket, validation_percent, test_percent)
+
+    return split_fn
+
+
+class ShardWriter:
+    """
+    Writes the rows of one split to a sequence of Parquet shards.
+    Rows are buffered up to max_buffer_bytes and then written as one row group, so the memory used by a split is
+    bounded by the buffer size and not by the number of rows in the split.
+    """
+
+    def __init__(self, data_dir, split, max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                 rows_per_shard=DEFAULT_ROWS_PER_SHARD, compression='zstd', shard_prefix='', schema=EXPORT_SCHEMA):
+        self.data_dir = data_dir
+        self.split = split
+        self.shard_prefix = shard_prefix
+        self.max_buffer_bytes = max_buffer_bytes
+        self.rows_per_shard = rows_per_shard
+        self.compression = compression
+        self.schema = schema
+
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.writer = None
+        self.shard_index = 0
+        self.shard_rows = 0
+        self.num_rows = 0
+        self.shard_paths = []
+
+    def write(self, row):
+        self.buffer.append(row)
+        self.buffer_bytes += sum(len(value) for value in row.values() if isinstance(value, (str, bytes)))
+        self.num_rows += 1
+        self.shard_rows += 1
+
+        if self.buffer_bytes >= self.max_buffer_bytes or self.shard_rows >= self.rows_per_shard:
+            self.flush()
+        if self.shard_rows >= self.rows_per_shard:
+            self._close_shard()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.writer is None:
+            shard_name = f"{self.split}-{self.shard_prefix}{self.shard_index:05d}.parquet"
+            shard_path = os.path.join(self.data_dir, shard_name)
+            self.writer = pq.ParquetWriter(shard_path, self.schema, compression=self.compression)
+            self.shard_paths.append(shard_path)
+
+        table = pa.Table.from_pylist(self.buffer, schema=self.schema)
+        self.writer.write_table(table)
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.shard_index += 1
+        self.shard_rows = 0
+
+    def close(self):
+        self.flush()
+        self._close_shard()
+
+
+def shard_path_in_repo(shard_path):
+    return f"data/{os.path.basename(shard_path)}"
+
+
+def split_of_shard(shard_path_in_repo):
+    # data/train-00000.parquet -> train
+    return os.path.basename(shard_path_in_repo).split('-')[0]
+
+
+def row_content_hash(row, schema=EXPORT_SCHEMA):
+    """Hash of the exported columns of a row. Used to detect rows that changed since the last export."""
+    hasher = hashlib.sha256()
+    for feature in schema.names:
+        value = row[feature]
+        hasher.update(value if isinstance(value, bytes) else value.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def new_manifest():
+    # rows: post_id -> [content hash, shard path in repo]
+    return {'watermark': {'post_id': -1}, 'run': 0, 'rows': {}}
+
+
+def load_manifest(export_dir):
+    manifest_path = os.path.join(export_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(export_dir, manifest):
+    with open(os.path.join(export_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+
+def manifest_splits(manifest):
+    splits = {split_of_shard(shard) for _, shard in manifest['rows'].values()}
+    return [split for split in SPLITS if split in splits]
+
+
+def write_dataset_card(output_dir, splits):
+    """Write a README.md that maps the shard files to splits, so that load_dataset() picks them up"""
+    lines = ["---", "configs:", "- config_name: default", "  data_files:"]
+    for split in splits:
+        lines.append(f"  - split: {split}")
+        lines.append(f"    path: data/{split}-*")
+    lines.append("---")
+
+    with open(os.path.join(output_dir, README_FILE), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_rows_to_shards(pages, data_dir, split_fn, manifest, shard_prefix='', max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                         rows_per_shard=DEFAULT_ROWS_PER_SHARD, compression='zstd', schema=EXPORT_SCHEMA):
+    """
+    Write the rows of the pages to per-split shards and record them in the manifest.
+    split_fn(row) returns the split of the row, or None to skip the row.
+    Returns the list of shard paths (in repo) that were written.
+    """
+    writers = {}
+    # post ids of rows written to the current shard of each split. They are recorded in the manifest once the
+    #  shard path is known, ie. after the rows are flushed.
+    pending_rows = {}
+    num_pages = 0
+    try:
+        for page in pages:
+            num_pages += 1
+            for row in page:
+                validate_export_row(row, schema)
+                split = split_fn(row)
+                if split is None:
+                    continue
+                if split not in writers:
+                    writers[split] = ShardWriter(data_dir, split, max_buffer_bytes, rows_per_shard,
+                                                 compression=compression, shard_prefix=shard_prefix, schema=schema)
+                    pending_rows[split] = []
+                writer = writers[split]
+                shard_index = writer.shard_index
+                writer.write(row)
+                pending_rows[split].append((row['post_id'], row_content_hash(row, schema), shard_index))
+            print(f"...Exported page {num_pages}, last post_id: {page[-1]['post_id']}")
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    shard_paths = []
+    for split, writer in writers.items():
+        split_shard_paths = [shard_path_in_repo(path) for path in writer.shard_paths]
+        shard_paths += split_shard_paths
+        for post_id, content_hash, shard_index in pending_rows[split]:
+            manifest['rows'][post_id] = [content_hash, split_shard_paths[shard_index]]
+            manifest['watermark']['post_id'] = max(manifest['watermark']['post_id'], int(post_id))
+
+    return shard_paths
+
+
+def export_dataset_from_db(output_dir, db_path=DB_PATH, post_ids=None, split_fn=None,
+                           page_size=DEFAULT_PAGE_SIZE, max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                           rows_per_shard=DEFAULT_ROWS_PER_SHARD):
+    """
+    Stream posts from the DB into Parquet shards under <output_dir>/data, one split at a time.
+    Returns a dict of split name to number of rows exported.
+    """
+    if split_fn is None:
+        split_fn = make_hash_split_fn()
+
+    # Remove shards of a previous export so that they are not mixed with the new ones
+    data_dir = os.path.join(output_dir, "data")
+    _clear_shards(data_dir)
+
+    manifest = new_manifest()
+    pages = iter_posts_from_db(db_path, post_ids=post_ids, page_size=page_size)
+    write_rows_to_shards(pages, data_dir, split_fn, manifest,
+                         max_buffer_bytes=max_buffer_bytes, rows_per_shard=rows_per_shard)
+
+    return _finish_export(output_dir, manifest)
+
+
+def _clear_shards(data_dir):
+    os.makedirs(data_dir, exist_ok=True)
+    for file_name in os.listdir(data_dir):
+        if file_name.endswith(".parquet"):
+            os.remove(os.path.join(data_dir, file_name))
+
+
+def _finish_export(output_dir, manifest):
+    # Write the dataset card and manifest of a full export. Returns a dict of split name to number of rows.
+    split_sizes = {}
+    for _, shard in manifest['rows'].values():
+        split = split_of_shard(shard)
+        split_sizes[split] = split_sizes.get(split, 0) + 1
+    if not split_sizes:
+        print("...No posts found in the DB to export")
+        return split_sizes
+
+    write_dataset_card(output_dir, manifest_splits(manifest))
+    save_manifest(output_dir, manifest)
+    print(f"...Export completed to {output_dir}. Split sizes: {split_sizes}")
+    return split_sizes
+
+
+def _export_partition(db_path, data_dir, partition, min_post_id, max_post_id, test_post_ids, validation_percent,
+                      test_percent, page_size, max_buffer_bytes, rows_per_shard, compression):
+    # Runs in a worker process: export the posts with min_post_id < post_id <= max_post_id to the shards of the
+    #  partition and return the manifest rows. The split function is built here because closures can't be pickled.
+    split_fn = make_hash_split_fn(test_post_ids, validation_percent, test_percent)
+    manifest = new_manifest()
+    pages = iter_posts_from_db(db_path, page_size=page_size, min_post_id=min_post_id, max_post_id=max_post_id)
+    write_rows_to_shards(pages, data_dir, split_fn, manifest, shard_prefix=f"p{partition:03d}-",
+                         max_buffer_bytes=max_buffer_bytes, rows_per_shard=rows_per_shard, compression=compression)
+    return manifest['rows']
+
+
+def export_dataset_parallel(output_dir, db_path=DB_PATH, test_post_ids=None, num_workers=None,
+                            validation_percent=DEFAULT_VALIDATION_PERCENT, test_percent=DEFAULT_TEST_PERCENT,
+                            page_size=DEFAULT_PAGE_SIZE, max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                            rows_per_shard=DEFAULT_ROWS_PER_SHARD, compression='zstd'):
+    """
+    Same as export_dataset_from_db() with the hash split, but the post_id ranges of the table are exported in
+    parallel by num_workers processes (default: number of CPUs).
+    Returns a dict of split name to number of rows exported.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    data_dir = os.path.join(output_dir, "data")
+    _clear_shards(data_dir)
+
+    ranges = post_id_ranges(num_workers * PARTITIONS_PER_WORKER, db_path)
+    print(f"...Exporting {len(ranges)} post_id ranges with {num_workers} worker processes")
+
+    manifest = new_manifest()
+    test_post_ids = [str(post_id) for post_id in (test_post_ids or [])]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(_export_partition, db_path, data_dir, partition, min_post_id, max_post_id,
+                            test_post_ids, validation_percent, test_percent, page_size, max_buffer_bytes,
+                            rows_per_shard, compression)
+            for partition, (min_post_id, max_post_id) in enumerate(ranges)
+        ]
+        # The ranges don't overlap, so merging the manifests of the partitions is a plain union
+        for future in futures:
+            partition_rows = future.result()
+            manifest['rows'].update(partition_rows)
+            for post_id in partition_rows:
+                manifest['watermark']['post_id'] = max(manifest['watermark']['post_id'], int(post_id))
+
+    return _finish_export(output_dir, manifest)
+
+
+def remove_rows_from_shard(export_dir, shard, post_ids):
+    """Rewrite the local copy of a shard without the given rows. Returns False if the shard ends up empty."""
+    shard_path = os.path.join(export_dir, shard)
+    table = pq.read_table(shard_path, schema=EXPORT_SCHEMA)
+    keep_mask = [post_id not in post_ids for post_id in table.column('post_id').to_pylist()]
+    table = table.filter(pa.array(keep_mask, type=pa.bool_()))
+
+    if table.num_rows == 0:
+        os.remove(shard_path)
+        return False
+
+    pq.write_table(table, shard_path, compression='zstd')
+    return True
+
+
+def export_incremental_from_db(export_dir, hub_repo, db_path=DB_PATH, split_fn=None, detect_changes=True,
+                               page_size=DEFAULT_PAGE_SIZE, max_buffer_bytes=DEFAULT_MAX_BUFFER_BYTES,
+                               rows_per_shard=DEFAULT_ROWS_PER_SHARD):
+    """
+    Export only the rows that are new or changed since the last export recorded in the manifest of hub_repo,
+    and upload the new shards (plus the existing shards that held the old version of changed rows) to hub_repo.
+
+    If detect_changes is False, only the rows above the watermark (post_id > highest exported post_id) are read.
+    Otherwise every processed row is read and hashed, which costs a pass over the local DB but no upload.
+    Returns the list of paths (in repo) that were uploaded.
+    """
+    if split_fn is None:
+        split_fn = make_hash_split_fn()
+
+    data_dir = os.path.join(export_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+
+    # The manifest in the repo is the source of truth of what has been published
+    print(f"...Getting manifest from {hub_repo}")
+    if hub_repo.download_file(MANIFEST_FILE, export_dir):
+        manifest = load_manifest(export_dir)
+    else:
+        print(f"...No manifest in {hub_repo}. All rows will be exported.")
+        manifest = new_manifest()
+
+    manifest['run'] += 1
+    watermark = manifest['watermark']['post_id']
+    print(f"...Incremental export run {manifest['run']}. Watermark post_id: {watermark}, "
+          f"rows already exported: {len(manifest['rows'])}")
+
+    # Old shards that contain the previous version of a changed row, and the rows to remove from them
+    changed_rows_by_shard = {}
+
+    def delta_split_fn(row):
+        entry = manifest['rows'].get(row['post_id'])
+        if entry is None:
+            return split_fn(row)
+        content_hash, shard = entry
+        if content_hash == row_content_hash(row):
+            return None
+        # Changed row: keep it in the same split, move it to the new shard
+        changed_rows_by_shard.setdefault(shard, set()).add(row['post_id'])
+        return split_of_shard(shard)
+
+    min_post_id = -1 if detect_changes else watermark
+    pages = iter_posts_from_db(db_path, page_size=page_size, min_post_id=min_post_id)
+    new_shards = write_rows_to_shards(pages, data_dir, delta_split_fn, manifest,
+                                      shard_prefix=f"r{manifest['run']:04d}-",
+                                      max_buffer_bytes=max_buffer_bytes, rows_per_shard=rows_per_shard)
+
+    if not new_shards:
+        print("...No new or changed rows since the last export. Nothing to upload.")
+        return []
+
+    rewritten_shards = []
+    deleted_shards = []
+    for shard, post_ids in changed_rows_by_shard.items():
+        if not os.path.exists(os.path.join(export_dir, shard)) and not hub_repo.download_file(shard, export_dir):
+            raise ValueError(f"Shard {shard} listed in the manifest is not in {hub_repo}")
+        if remove_rows_from_shard(export_dir, shard, post_ids):
+            rewritten_shards.append(shard)
+        else:
+            deleted_shards.append(shard)
+
+    write_dataset_card(export_dir, manifest_splits(manifest))
+    save_manifest(export_dir, manifest)
+
+    upload_paths = new_shards + rewritten_shards + [README_FILE, MANIFEST_FILE]
+    print(f"...Uploading {len(new_shards)} new and {len(rewritten_shards)} rewritten shards to {hub_repo}. "
+          f"Changed rows: {sum(len(ids) for ids in changed_rows_by_shard.values())}, "
+          f"deleted shards: {len(deleted_shards)}")
+    upload_dataset_files(export_dir, hub_repo, upload_paths, delete_paths=deleted_shards,
+                         commit_message=f"Incremental dataset export, run {manifest['run']}")
+    return upload_paths
@@ -0,0 +1,179 @@
+"""
+GGUF export in several quantizations, with an Ollama Modelfile per variant and a CPU benchmark of the variants
+
+export_gguf_variants() exports the trained model to GGUF once per quantization method (eg. Q4_K_M, Q5_K_M, Q8_0).
+Unsloth merges the LoRA adapter into the base model and converts it to a 16-bit GGUF only once, then quantizes that
+file to every method.
+
+write_modelfile() writes <variant>.Modelfile next to each GGUF file. Its TEMPLATE and SYSTEM are generated from the
+chat template and system prompt used in training (hn_prompts.py), so the served model sees the same format as in
+training and the Modelfile is never edited by hand.
+
+benchmark_gguf_variants() creates an Ollama model per variant (see hn_ollama.py) and measures, on CPU (num_gpu=0):
+- the file size and the load time (Ollama's load_duration of the first post, after unloading the model)
+- prompt and generation tokens/sec (prompt_eval_count/duration and eval_count/duration), on a fixed set of posts
+  of the test split
+- ROUGE-L of the generated summaries against output_summary (see hn_eval.py), to see what the smaller
+  quantizations cost in quality
+so the quantization for the CPU servers is chosen from measurements.
+"""
+
+import glob
+import json
+import os
+
+from hn_prompts import LLAMA_TEMPLATE, SYSTEM_PROMPT, USER_PROMPT_PREFIX
+
+DEFAULT_QUANTIZATIONS = ["q4_k_m", "q5_k_m", "q8_0"]
+
+BENCHMARK_FIELDS = ['quantization', 'file_size_mb', 'load_seconds', 'prompt_tokens_per_sec', 'tokens_per_sec',
+                    'mean_latency_seconds', 'rougeL']
+
+
+def export_gguf_variants(model, tokenizer, output_dir, quantizations=DEFAULT_QUANTIZATIONS):
+    """Export the model to one GGUF file per quantization method. Returns {quantization: GGUF path}."""
+    print(f"\nExporting model to GGUF in {output_dir} with quantizations: {', '.join(quantizations)}...")
+    model.save_pretrained_gguf(output_dir, tokenizer, quantization_method=list(quantizations))
+    gguf_files = find_gguf_files(output_dir, quantizations)
+    for quantization, path in gguf_files.items():
+        print(f"...{quantization}: {path} ({os.path.getsize(path) / 2 ** 20:.0f} MB)")
+    return gguf_files
+
+
+def find_gguf_files(output_dir, quantizations=DEFAULT_QUANTIZATIONS):
+    """{quantization: path} of the GGUF files in output_dir (file names end with .<QUANTIZATION>.gguf)"""
+    paths = glob.glob(os.path.join(output_dir, "*.gguf"))
+    gguf_files = {}
+    for quantization in quantizations:
+        matches = [path for path in paths if path.lower().endswith(f".{quantization.lower()}.gguf")]
+        if not matches:
+            raise ValueError(f"No {quantization} GGUF file in {output_dir}")
+        gguf_files[quantization] = max(matches, key=os.path.getmtime)
+    return gguf_files
+
+
+def ollama_template():
+    """The training chat template (hn_prompts.py) as an Ollama Go template. Ollama adds <|begin_of_text|> itself."""
+    template = LLAMA_TEMPLATE.format(SYSTEM="{{ .System }}", INPUT="{{ .Prompt }}", OUTPUT="{{ .Response }}")
+    return template.removeprefix("<|begin_of_text|>")
+
+
+def gguf_modelfile_path(gguf_path):
+    """<GGUF path without .gguf>.Modelfile"""
+    return os.path.splitext(gguf_path)[0] + ".Modelfile"
+
+
+def find_modelfile(output_dir, quantization):
+    """Path of the Modelfile that export wrote for the GGUF file of the quantization in output_dir"""
+    modelfile_path = gguf_modelfile_path(find_gguf_files(output_dir, [quantization])[quantization])
+    if not os.path.exists(modelfile_path):
+        raise ValueError(f"No Modelfile for {quantization} in {output_dir}. Run export (or pass --modelfile).")
+    return modelfile_path
+
+
+def write_modelfile(gguf_path, num_ctx=8192, temperature=1, system_prompt=SYSTEM_PROMPT):
+    """Write <GGUF path without .gguf>.Modelfile for the GGUF file. Returns its path."""
+    modelfile_path = gguf_modelfile_path(gguf_path)
+    lines = [
+        f"FROM ./{os.path.basename(gguf_path)}",
+        f'TEMPLATE """{ollama_template()}"""',
+        f'SYSTEM """{system_prompt}"""',
+        f"PARAMETER temperature {temperature}",
+        f"PARAMETER num_ctx {num_ctx}",
+        'PARAMETER stop "<|eot_id|>"',
+        'PARAMETER stop "<|end_of_text|>"',
+    ]
+    with open(modelfile_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return modelfile_path
+
+
+def benchmark_prompts(dataset, num_posts=5, max_input_tokens=4096):
+    """(post id, user prompt, reference summary) of the first num_posts posts, with the threads cut to size"""
+    from hn_thread import select_thread
+
+    dataset = dataset.select(range(min(num_posts, len(dataset))))
+    return [(post_id, f"{USER_PROMPT_PREFIX}\n{select_thread(comment, max_input_tokens)}", summary)
+            for post_id, comment, summary in zip(dataset['post_id'], dataset['input_comment'],
+                                                 dataset['output_summary'])]
+
+
+def benchmark_variant(server, model_name, prompts, max_new_tokens=512, num_ctx=8192, num_threads=None):
+    """Load time, tokens/sec and ROUGE-L of one Ollama model on CPU"""
+    from hn_eval import quality_metrics
+
+    options = {'num_gpu': 0, 'temperature': 0, 'num_predict': max_new_tokens, 'num_ctx': num_ctx}
+    if num_threads:
+        options['num_thread'] = num_threads
+
+    # Unload first, so the load time is measured from disk. A chat request without messages only loads the model
+    #  and its response has no timings, so the load time is the load_duration of the first post.
+    server.unload(model_name)
+
+    load_seconds = None
+    prompt_tokens = prompt_seconds = generated_tokens = generation_seconds = 0
+    latencies = []
+    rouge_l = []
+    for post_id, prompt, reference in prompts:
+        response = server.chat(model_name, [{'role': 'user', 'content': prompt}], options)
+        if load_seconds is None:
+            load_seconds = response.get('load_duration', 0) / 1e9
+        prompt_tokens += response.get('prompt_eval_count', 0)
+        prompt_seconds += response.get('prompt_eval_duration', 0) / 1e9
+        generated_tokens += response.get('eval_count', 0)
+        generation_seconds += response.get('eval_duration', 0) / 1e9
+        latencies.append(response.get('total_duration', 0) / 1e9)
+        rouge_l.append(quality_metrics(reference, response.get('message', {}).get('content', ''))['rougeL'])
+        print(f"...{model_name}: post {post_id}: {response.get('eval_count', 0)} tokens "
+              f"in {latencies[-1]:.1f} seconds")
+    server.unload(model_name)
+
+    return {
+        'load_seconds': round(load_seconds, 2) if load_seconds is not None else None,
+        'prompt_tokens_per_sec': round(prompt_tokens / prompt_seconds, 1) if prompt_seconds else None,
+        'tokens_per_sec': round(generated_tokens / generation_seconds, 1) if generation_seconds else None,
+        'mean_latency_seconds': round(sum(latencies) / len(latencies), 2) if latencies else None,
+        'rougeL': round(sum(rouge_l) / len(rouge_l), 4) if rouge_l else None,
+    }
+
+
+def benchmark_gguf_variants(gguf_files, prompts, server, model_name_prefix="hn-finetune", max_new_tokens=512,
+                            num_ctx=8192, num_threads=None, output_path="outputs/gguf_benchmark.json"):
+    """
+    Write a Modelfile for every GGUF file, create its Ollama model (if not up to date) and benchmark it.
+    Returns the result rows, also written to output_path.
+    """
+    results = []
+    for quantization, gguf_path in gguf_files.items():
+        model_name = f"{model_name_prefix}-{quantization.lower().replace('_', '-')}"
+        modelfile = write_modelfile(gguf_path, num_ctx)
+        server.ensure_model(model_name, modelfile)
+
+        print(f"\nBenchmarking {model_name} on CPU with {len(prompts)} posts...")
+        result = {
+            'quantization': quantization,
+            'model': model_name,
+            'file_size_mb': round(os.path.getsize(gguf_path) / 2 ** 20, 1),
+            **benchmark_variant(server, model_name, prompts, max_new_tokens, num_ctx, num_threads),
+        }
+        results.append(result)
+
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print_benchmark_results(results)
+    print(f"Benchmark results written to {output_path}")
+    return results
+
+
+def print_benchmark_results(results):
+    if not results:
+        return
+    rows = [[str(result[field]) for field in BENCHMARK_FIELDS] for result in results]
+    widths = [max(len(field), *(len(row[i]) for row in rows)) for i, field in enumerate(BENCHMARK_FIELDS)]
+    print("\nGGUF variants on CPU:")
+    print("  ".join(field.ljust(width) for field, width in zip(BENCHMARK_FIELDS, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
@@ -0,0 +1,170 @@
+"""
+Minimal file-level access to a dataset repo, either on the HuggingFace Hub or in a local directory.
+
+The export and upload code only needs to list, download and upload files of a dataset repo. HfHubRepo does this
+with the HF API. LocalHubRepo does the same against a plain directory that has the same layout as the HF repo,
+so the whole export/upload flow can be run and verified offline (a local directory can also be loaded with
+load_dataset(<directory>)).
+
+Files can also be uploaded in two steps (see hn_upload.py): preupload_file() stores the content of a file in the repo
+without making it visible, and upload_files() publishes the files in one commit, without sending the content again.
+"""
+
+import hashlib
+import os
+import shutil
+
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, HfApi, hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
+
+
+# Directory of a LocalHubRepo where pre-uploaded files are kept until they are committed
+STAGING_DIR = ".staging"
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class HfHubRepo:
+    """Dataset repo on the HuggingFace Hub"""
+
+    def __init__(self, repo_id, token=None):
+        self.repo_id = repo_id
+        self.token = token
+        self.hf_api = HfApi(token=token)
+
+    def __str__(self):
+        return f"hf://datasets/{self.repo_id}"
+
+    def resolve_revision(self, revision=None):
+        # Commit sha of the revision (branch, tag or sha). Defaults to the latest commit on main.
+        return self.hf_api.dataset_info(repo_id=self.repo_id, revision=revision).sha
+
+    def list_files(self, revision=None):
+        return self.hf_api.list_repo_files(repo_id=self.repo_id, repo_type="dataset", revision=revision)
+
+    def download_file(self, path_in_repo, local_dir, revision=None):
+        # Download the file to <local_dir>/<path_in_repo>. Return the local path, or None if the file doesn't exist.
+        try:
+            return hf_hub_download(
+                repo_id=self.repo_id,
+                repo_type="dataset",
+                filename=path_in_repo,
+                local_dir=local_dir,
+                revision=revision,
+                token=self.token
+            )
+        except EntryNotFoundError:
+            return None
+
+    def file_hashes(self, revision=None):
+        # path -> sha256 of the content, for the files stored in LFS (the data files). Other files are not included.
+        entries = self.hf_api.list_repo_tree(repo_id=self.repo_id, repo_type="dataset", revision=revision,
+                                             recursive=True)
+        return {entry.path: entry.lfs.sha256 for entry in entries if getattr(entry, 'lfs', None) is not None}
+
+    def preupload_file(self, local_dir, path_in_repo):
+        # Upload the content of <local_dir>/<path> to LFS storage. It is not visible until it is committed with
+        #  upload_files(). The Hub keeps the content by sha256, so the commit (or a resumed run) doesn't send it again.
+        operation = CommitOperationAdd(path_in_repo=path_in_repo,
+                                       path_or_fileobj=os.path.join(local_dir, path_in_repo))
+        self.hf_api.preupload_lfs_files(repo_id=self.repo_id, additions=[operation], repo_type="dataset")
+
+    def upload_files(self, local_dir, paths_in_repo, delete_paths=(), commit_message="Upload dataset files"):
+        # Upload <local_dir>/<path> for each of the paths and delete the delete_paths, all in one commit
+        operations = [
+            CommitOperationAdd(path_in_repo=path, path_or_fileobj=os.path.join(local_dir, path))
+            for path in paths_in_repo
+        ]
+        operations += [CommitOperationDelete(path_in_repo=path) for path in delete_paths]
+        if not operations:
+            return
+
+        self.hf_api.create_commit(
+            repo_id=self.repo_id,
+            repo_type="dataset",
+            operations=operations,
+            commit_message=commit_message
+        )
+
+
+class LocalHubRepo:
+    """Local directory that stands in for a dataset repo on the Hub"""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def __str__(self):
+        return self.root_dir
+
+    def resolve_revision(self, revision=None):
+        # A local directory has no commits. Use a hash of the file names, sizes and modification times instead,
+        #  so that the revision changes whenever a file is added, removed or rewritten.
+        hasher = hashlib.sha256()
+        for path in self.list_files():
+            stat = os.stat(os.path.join(self.root_dir, path))
+            hasher.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+        return hasher.hexdigest()[:40]
+
+    def list_files(self, revision=None):
+        paths = []
+        for dir_path, dir_names, file_names in os.walk(self.root_dir):
+            # Skip the staging dir of pre-uploaded files
+            dir_names[:] = [name for name in dir_names if name != STAGING_DIR]
+            for file_name in file_names:
+                full_path = os.path.join(dir_path, file_name)
+                paths.append(os.path.relpath(full_path, self.root_dir).replace(os.sep, "/"))
+        return sorted(paths)
+
+    def download_file(self, path_in_repo, local_dir, revision=None):
+        source_path = os.path.join(self.root_dir, path_in_repo)
+        if not os.path.exists(source_path):
+            return None
+
+        local_path = os.path.join(local_dir, path_in_repo)
+        if os.path.abspath(source_path) != os.path.abspath(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            shutil.copyfile(source_path, local_path)
+        return local_path
+
+    def file_hashes(self, revision=None):
+        return {path: file_sha256(os.path.join(self.root_dir, path)) for path in self.list_files()}
+
+    def _staged_path(self, sha256):
+        return os.path.join(self.root_dir, STAGING_DIR, sha256)
+
+    def preupload_file(self, local_dir, path_in_repo):
+        # Like LFS storage on the Hub: the content is stored by sha256, and is moved in place by upload_files()
+        source_path = os.path.join(local_dir, path_in_repo)
+        staged_path = self._staged_path(file_sha256(source_path))
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        shutil.copyfile(source_path, staged_path + ".tmp")
+        os.replace(staged_path + ".tmp", staged_path)
+
+    def upload_files(self, local_dir, paths_in_repo, delete_paths=(), commit_message="Upload dataset files"):
+        for path in paths_in_repo:
+            source_path = os.path.join(local_dir, path)
+            target_path = os.path.join(self.root_dir, path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            staged_path = self._staged_path(file_sha256(source_path))
+            if os.path.exists(staged_path):
+                os.replace(staged_path, target_path)
+            else:
+                shutil.copyfile(source_path, target_path)
+        for path in delete_paths:
+            target_path = os.path.join(self.root_dir, path)
+            if os.path.exists(target_path):
+                os.remove(target_path)
+
+
+def open_hub_repo(repo_id_or_dir, token=None):
+    """Return a LocalHubRepo if the argument is an existing local directory, else an HfHubRepo"""
+    if os.path.isdir(repo_id_or_dir):
+        return LocalHubRepo(repo_id_or_dir)
+    return HfHubRepo(repo_id_or_dir, token=token)
@@ -0,0 +1,206 @@
+"""
+Token length profile and memory outlier detection for the training data
+
+Some posts are much longer than others (120K+ chars of comments) and a few of them are enough to make the training
+stall or run out of memory. Instead of finding them by trial and error (one training attempt per guess), this
+computes the full token length of every post in every split (template + comments + summary, without truncation),
+prints histograms and percentiles, and estimates the activation memory of a training step for each post.
+Posts whose estimated step memory is over the memory budget are reported as outliers.
+
+The memory estimate is a rough model of a LoRA fine-tune with gradient checkpointing (see estimate_step_memory()).
+It is meant to rank posts and find the ones that clearly don't fit, not to predict the exact memory use.
+
+Usage:
+    uv run hn_length_profile.py --dataset annjose/hn-comments-small --tokenizer unsloth/llama-3-8b-bnb-4bit \\
+        --memory-gb 24 --batch-size 2
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from hn_prompts import SYSTEM_PROMPT, template_segments
+
+LENGTH_BUCKETS = [0, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+PERCENTILES = [50, 90, 95, 99, 100]
+
+# Shape of Llama-3-8B, used when the model config is not given
+LLAMA_3_8B_CONFIG = {
+    'hidden_size': 4096,
+    'intermediate_size': 14336,
+    'num_hidden_layers': 32,
+    'num_attention_heads': 32,
+    'vocab_size': 128256,
+    'num_parameters': 8.0e9,
+}
+
+
+def compute_token_lengths(dataset, tokenizer, system_prompt=SYSTEM_PROMPT, num_proc=None):
+    """Return (numpy array with the full (not truncated) token length of every post, list of post ids)"""
+    template_tokens = sum(len(ids) for ids in tokenizer(
+        list(template_segments(system_prompt)), add_special_tokens=False)["input_ids"]) + 1  # +1 for eos
+
+    def count_func(examples):
+        comment_ids = tokenizer(examples["input_comment"], add_special_tokens=False)["input_ids"]
+        summary_ids = tokenizer(examples["output_summary"], add_special_tokens=False)["input_ids"]
+        return {"num_tokens": [template_tokens + len(c) + len(s) for c, s in zip(comment_ids, summary_ids)]}
+
+    lengths_dataset = dataset.map(count_func, batched=True, batch_size=256, num_proc=num_proc,
+                                  remove_columns=[name for name in dataset.column_names if name != "post_id"],
+                                  desc="Counting tokens")
+    return np.asarray(lengths_dataset["num_tokens"], dtype=np.int64), lengths_dataset["post_id"]
+
+
+def estimate_step_memory(seq_lengths, batch_size=1, model_config=None, bytes_per_value=2, flash_attention=True,
+                         load_in_4bit=True):
+    """
+    Estimate the peak memory (bytes) of a training step for batches of padded sequences of the given lengths.
+    Vectorized: seq_lengths can be a numpy array.
+
+    The estimate has these parts:
+    - weights: 0.5 bytes per parameter in 4-bit (2 bytes in 16-bit)
+    - checkpointed activations: the input of every layer is kept for the backward pass
+    - one layer's activations being recomputed in the backward pass (attention + MLP intermediates)
+    - logits and their gradient in fp32 for the loss
+    - the attention scores matrix, only when flash attention is not used (quadratic in the sequence length)
+    """
+    config = model_config or LLAMA_3_8B_CONFIG
+    tokens = np.asarray(seq_lengths, dtype=np.float64) * batch_size
+    hidden = config['hidden_size']
+
+    weights = config['num_parameters'] * (0.5 if load_in_4bit else bytes_per_value)
+    checkpoints = tokens * hidden * config['num_hidden_layers'] * bytes_per_value
+    layer_activations = tokens * (10 * hidden + 3 * config['intermediate_size']) * bytes_per_value
+    logits = tokens * config['vocab_size'] * 4 * 2
+    attention_scores = 0
+    if not flash_attention:
+        attention_scores = (batch_size * config['num_attention_heads'] *
+                            np.asarray(seq_lengths, dtype=np.float64) ** 2 * bytes_per_value)
+
+    return weights + checkpoints + layer_activations + logits + attention_scores
+
+
+def length_histogram(lengths):
+    counts, edges = np.histogram(lengths, bins=LENGTH_BUCKETS + [max(int(lengths.max()) + 1, LENGTH_BUCKETS[-1] + 1)])
+    return [(int(edges[i]), int(edges[i + 1]), int(count)) for i, count in enumerate(counts)]
+
+
+def profile_split(split, dataset, tokenizer, memory_budget_bytes, batch_size=1, model_config=None,
+                  flash_attention=True, max_seq_length=None):
+    """
+    Profile one split. Returns a dict with the percentiles, histogram and outlier posts.
+    If max_seq_length is given, the posts are assumed to be truncated to it for the memory estimate.
+    """
+    lengths, post_ids = compute_token_lengths(dataset, tokenizer)
+    if len(lengths) == 0:
+        return {'split': split, 'num_posts': 0}
+
+    train_lengths = lengths if max_seq_length is None else np.minimum(lengths, max_seq_length)
+    memory = estimate_step_memory(train_lengths, batch_size, model_config, flash_attention=flash_attention)
+    outlier_idx = np.nonzero(memory > memory_budget_bytes)[0]
+    outlier_idx = outlier_idx[np.argsort(-lengths[outlier_idx])]
+
+    return {
+        'split': split,
+        'num_posts': len(lengths),
+        'total_tokens': int(lengths.sum()),
+        'mean_tokens': float(lengths.mean()),
+        'percentiles': {p: int(np.percentile(lengths, p)) for p in PERCENTILES},
+        'histogram': length_histogram(lengths),
+        'max_step_memory_gb': float(memory.max() / 1e9),
+        'outliers': [
+            {'post_id': post_ids[i], 'num_tokens': int(lengths[i]), 'step_memory_gb': round(float(memory[i]) / 1e9, 2)}
+            for i in outlier_idx
+        ],
+    }
+
+
+def print_split_profile(profile, memory_budget_gb):
+    print(f"\nSplit '{profile['split']}': {profile['num_posts']} posts")
+    if profile['num_posts'] == 0:
+        return
+    print(f"...Total tokens: {profile['total_tokens']}, mean: {profile['mean_tokens']:.0f}")
+    print("...Percentiles: " + ", ".join(f"p{p}: {value}" for p, value in profile['percentiles'].items()))
+    print("...Histogram (tokens):")
+    max_count = max(count for _, _, count in profile['histogram']) or 1
+    for low, high, count in profile['histogram']:
+        bar = '#' * int(40 * count / max_count)
+        print(f"      {low:>6} - {high:<6} {count:>6} {bar}")
+    print(f"...Max estimated step memory: {profile['max_step_memory_gb']:.1f} GB (budget: {memory_budget_gb} GB)")
+    if profile['outliers']:
+        print(f"...{len(profile['outliers'])} posts are predicted to stall or run out of memory:")
+        for outlier in profile['outliers']:
+            print(f"      post_id: {outlier['post_id']}, tokens: {outlier['num_tokens']}, "
+                  f"estimated step memory: {outlier['step_memory_gb']} GB")
+    else:
+        print("...No posts over the memory budget")
+
+
+def profile_dataset(dataset_dict, tokenizer, memory_budget_gb, batch_size=1, model_config=None,
+                    flash_attention=True, max_seq_length=None):
+    """Profile every split of the dataset. Returns the list of split profiles."""
+    profiles = []
+    for split, dataset in dataset_dict.items():
+        profile = profile_split(split, dataset, tokenizer, memory_budget_gb * 1e9, batch_size, model_config,
+                                flash_attention, max_seq_length)
+        print_split_profile(profile, memory_budget_gb)
+        profiles.append(profile)
+    return profiles
+
+
+def find_memory_outliers(dataset, tokenizer, memory_budget_gb, batch_size=1, model_config=None, max_seq_length=None):
+    """Return the post ids of the dataset that are predicted to go over the memory budget"""
+    profile = profile_split("train", dataset, tokenizer, memory_budget_gb * 1e9, batch_size, model_config,
+                            max_seq_length=max_seq_length)
+    return [outlier['post_id'] for outlier in profile.get('outliers', [])]
+
+
+def model_config_from_pretrained(model_name):
+    """
+    Read the model shape from its config.json on the Hub or in a local directory (no weights are downloaded).
+    The file is read directly: AutoConfig would import torch and the model classes.
+    """
+    if os.path.isdir(model_name):
+        config_path = os.path.join(model_name, "config.json")
+    else:
+        from huggingface_hub import hf_hub_download
+
+        config_path = hf_hub_download(model_name, "config.json")
+    with open(config_path) as f:
+        config = json.load(f)
+
+    num_parameters = (config['vocab_size'] * config['hidden_size'] * 2 +
+                      config['num_hidden_layers'] * (4 * config['hidden_size'] ** 2 +
+                                                     3 * config['hidden_size'] * config['intermediate_size']))
+    return {
+        'hidden_size': config['hidden_size'],
+        'intermediate_size': config['intermediate_size'],
+        'num_hidden_layers': config['num_hidden_layers'],
+        'num_attention_heads': config['num_attention_heads'],
+        'vocab_size': config['vocab_size'],
+        'num_parameters': num_parameters,
+    }
+
+
+if __name__ == "__main__":
+    from datasets import load_dataset
+    from dotenv import load_dotenv
+    from transformers import AutoTokenizer
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Token length profile and memory outliers of the training data")
+    parser.add_argument("--dataset", default="annjose/hn-comments-small", help="HF dataset id or local directory")
+    parser.add_argument("--tokenizer", default="unsloth/llama-3-8b-bnb-4bit", help="Tokenizer (and model config) name")
+    parser.add_argument("--memory-gb", type=float, default=24, help="GPU memory budget in GB")
+    parser.add_argument("--batch-size", type=int, default=2, help="per_device_train_batch_size of the trainer")
+    parser.add_argument("--no-flash-attention", action="store_true", help="Include the attention scores matrix")
+    parser.add_argument("--max-seq-length", type=int, default=None, help="Truncation length used for training")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    dataset_dict = load_dataset(args.dataset, token=os.environ.get('HF_TOKEN'))
+    profile_dataset(dataset_dict, tokenizer, args.memory_gb, args.batch_size,
+                    model_config_from_pretrained(args.tokenizer), not args.no_flash_attention, args.max_seq_length)
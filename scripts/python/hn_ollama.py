@@ -0,0 +1,202 @@
+"""
+Managed Ollama server for serving the exported model
+
+OllamaServer.start() reuses a server that already answers on the host, or starts `ollama serve` and polls its
+/api/version endpoint with exponential backoff until it's ready (instead of a fixed sleep). A server started here
+is stopped by stop() (or at the end of a with block); a reused server is left running.
+
+ensure_model() creates the Ollama model from a Modelfile only if needed. Ollama stores the GGUF file of a model as
+a blob named after its sha256, and the FROM line of the model's Modelfile (from /api/show) points to that blob. If
+it matches the sha256 of the local GGUF file, and the Modelfile didn't change since the last create (recorded in
+<Modelfile>.ollama.json), `ollama create` is skipped. The sha256 of the GGUF file is cached next to it
+(<gguf>.sha256, by size and mtime), so multi-GB files are hashed once.
+
+The binary is taken from OLLAMA_BINARY (default: ollama on the PATH), so the lifecycle can be exercised with a fake
+binary that serves the same endpoints.
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+import urllib.error
+import urllib.request
+
+from hn_hub import file_sha256
+
+DEFAULT_HOST = "127.0.0.1:11434"
+DEFAULT_STARTUP_TIMEOUT = 60
+DEFAULT_STOP_TIMEOUT = 10
+
+BLOB_DIGEST_PATTERN = re.compile(r'sha256[-:]([0-9a-f]{64})')
+
+
+def cached_file_sha256(path):
+    """sha256 of the file, cached in <path>.sha256 with its size and mtime"""
+    stat = os.stat(path)
+    cache_path = path + ".sha256"
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['sha256']
+
+    sha256 = file_sha256(path)
+    with open(cache_path, 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256}, f)
+    return sha256
+
+
+def modelfile_gguf_path(modelfile):
+    """The GGUF file of the FROM line of the Modelfile (relative paths are relative to the Modelfile)"""
+    with open(modelfile) as f:
+        for line in f:
+            if line.strip().upper().startswith("FROM "):
+                path = os.path.expanduser(line.strip()[len("FROM "):].strip())
+                return path if os.path.isabs(path) else os.path.join(os.path.dirname(os.path.abspath(modelfile)), path)
+    raise ValueError(f"No FROM line in {modelfile}")
+
+
+class OllamaServer:
+    """Ollama server on host: reused if it's already running, otherwise started and stopped here"""
+
+    def __init__(self, host=None, binary=None, startup_timeout=DEFAULT_STARTUP_TIMEOUT, log_path="outputs/ollama.log"):
+        self.host = host or os.environ.get('OLLAMA_HOST') or DEFAULT_HOST
+        if not self.host.startswith("http"):
+            self.host = f"http://{self.host}"
+        self.binary = binary or os.environ.get('OLLAMA_BINARY') or "ollama"
+        self.startup_timeout = startup_timeout
+        self.log_path = log_path
+        self.process = None
+
+    @property
+    def owned(self):
+        """True if the server process was started here"""
+        return self.process is not None
+
+    def _env(self):
+        return {**os.environ, 'OLLAMA_HOST': self.host.split("://", 1)[1]}
+
+    def _request(self, path, body=None, timeout=5):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(f"{self.host}{path}", data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read() or b'{}')
+
+    def version(self):
+        """Server version, or None if the server doesn't answer"""
+        try:
+            return self._request("/api/version", timeout=2).get('version')
+        except (urllib.error.URLError, ConnectionError, TimeoutError, ValueError):
+            return None
+
+    def is_healthy(self):
+        return self.version() is not None
+
+    def start(self):
+        if self.is_healthy():
+            print(f"\nUsing the Ollama server already running at {self.host} (version {self.version()})")
+            return self
+
+        print(f"\nStarting Ollama server at {self.host}...")
+        if os.path.dirname(self.log_path):
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        log_file = open(self.log_path, 'a')
+        try:
+            self.process = subprocess.Popen([self.binary, "serve"], env=self._env(), stdout=log_file,
+                                            stderr=subprocess.STDOUT)
+        except FileNotFoundError:
+            raise Exception(f"Ollama binary not found: {self.binary}. Install Ollama or set OLLAMA_BINARY.")
+        finally:
+            log_file.close()
+
+        start_time = time.monotonic()
+        delay = 0.05
+        while not self.is_healthy():
+            if self.process.poll() is not None:
+                exit_code = self.process.returncode
+                self.process = None
+                raise Exception(f"Ollama server exited with code {exit_code} before it was ready. See {self.log_path}")
+            if time.monotonic() - start_time > self.startup_timeout:
+                self.stop()
+                raise Exception(f"Ollama server not ready after {self.startup_timeout} seconds. See {self.log_path}")
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+        print(f"...Ollama server ready in {time.monotonic() - start_time:.2f} seconds (version {self.version()})")
+        return self
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        """Stop the server if it was started here: SIGTERM, then SIGKILL after timeout seconds"""
+        if self.process is None:
+            return
+        print(f"\nStopping Ollama server (pid {self.process.pid})...")
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def wait(self):
+        """Block until the server started here exits"""
+        if self.process is not None:
+            self.process.wait()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def chat(self, model_name, messages, options=None, keep_alive=None, timeout=600):
+        """Non-streaming /api/chat. With no messages, it only loads the model."""
+        body = {'model': model_name, 'messages': messages, 'stream': False, 'options': options or {}}
+        if keep_alive is not None:
+            body['keep_alive'] = keep_alive
+        return self._request("/api/chat", body, timeout=timeout)
+
+    def unload(self, model_name):
+        self._request("/api/chat", {'model': model_name, 'messages': [], 'keep_alive': 0}, timeout=60)
+
+    def model_blob_digests(self, model_name):
+        """sha256 digests of the blobs of the model (from its Modelfile), or None if the model doesn't exist"""
+        try:
+            show = self._request("/api/show", {'model': model_name}, timeout=30)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        return set(BLOB_DIGEST_PATTERN.findall(show.get('modelfile', '')))
+
+    def ensure_model(self, model_name, modelfile):
+        """Create the model from the Modelfile, unless the server already has it with the same GGUF and Modelfile"""
+        gguf_sha256 = cached_file_sha256(modelfile_gguf_path(modelfile))
+        with open(modelfile, 'rb') as f:
+            modelfile_sha256 = hashlib.sha256(f.read()).hexdigest()
+        state_path = modelfile + ".ollama.json"
+        state = {'model': model_name, 'host': self.host, 'gguf_sha256': gguf_sha256,
+                 'modelfile_sha256': modelfile_sha256}
+
+        digests = self.model_blob_digests(model_name)
+        previous_state = None
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                previous_state = json.load(f)
+        if digests is not None and gguf_sha256 in digests and previous_state == state:
+            print(f"...Ollama model {model_name} is up to date (sha256:{gguf_sha256[:12]}), not creating it again")
+            return False
+
+        print(f"\nCreating Ollama model {model_name} from {modelfile}...")
+        start_time = time.monotonic()
+        result = subprocess.run([self.binary, "create", model_name, "-f", modelfile], env=self._env(),
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"ollama create {model_name} failed with code {result.returncode}: {result.stderr.strip()}")
+
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+        print(f"...Ollama model {model_name} created in {time.monotonic() - start_time:.2f} seconds")
+        return True
@@ -0,0 +1,244 @@
+"""
+Token-budget-aware packing of the tokenized training data
+
+The posts range from ~500 to 30K+ tokens, so batches of padded examples are mostly padding and a batch with a few
+long posts takes much more memory than the others. pack_dataset() groups the examples (from tokenize_training_data())
+into bins of at most max_seq_length tokens, using best-fit decreasing: examples are placed longest first, each in the
+fullest bin that still has room for it. Every packed row has the same token budget, so every step does about the
+same amount of work and takes about the same memory. pack_iterable_dataset() packs a streamed dataset (see
+hn_streaming.py) the same way, within windows of a few hundred examples.
+
+PackedDataCollator keeps the examples in a packed row independent of each other:
+- position_ids restart at 0 for every example
+- labels are -100 at the first token of every example, so the model is not trained to predict an example from the
+  end of the previous one
+- by default, there is no attention_mask, only position_ids (like DataCollatorWithFlattening). Flash attention finds
+  the example boundaries from the position_ids only when there is no attention_mask. The eager/sdpa attention never
+  does, so the examples of a row would attend to each other.
+- with block_diagonal_mask=True, it builds a 4D causal mask that is block diagonal over the examples instead. This is
+  needed for the eager/sdpa attention (eg: on CPU).
+
+Run this file to compare the throughput of padded and packed batches on CPU with a tiny random Llama model:
+    uv run hn_packing.py
+"""
+
+import bisect
+import time
+
+from datasets import Dataset
+
+# Examples per packing window of a streamed dataset. Larger windows fill the rows better but hold more examples.
+DEFAULT_STREAM_PACK_BUFFER_SIZE = 256
+
+
+def pack_best_fit_decreasing(lengths, budget):
+    """Group the example indices into bins whose total length is at most budget. Returns a list of bins."""
+
+    # Examples longer than the budget should have been truncated by the tokenizer. Put them in a bin of their own.
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    bins = []
+    # Remaining space of the bins that are not full, kept sorted as (remaining, bin index) for bisect
+    open_bins = []
+    for idx in order:
+        length = lengths[idx]
+        # Fullest bin that still has room: the first bin with remaining >= length
+        pos = bisect.bisect_left(open_bins, (length, -1))
+        if pos < len(open_bins):
+            remaining, bin_idx = open_bins.pop(pos)
+        else:
+            bins.append([])
+            remaining, bin_idx = budget, len(bins) - 1
+        bins[bin_idx].append(idx)
+        remaining -= length
+        if remaining > 0:
+            bisect.insort(open_bins, (remaining, bin_idx))
+    return bins
+
+
+def pack_dataset(tokenized_dataset, max_seq_length):
+    """Pack the examples of a tokenized dataset into rows of at most max_seq_length tokens"""
+
+    lengths = tokenized_dataset["num_tokens"]
+    bins = pack_best_fit_decreasing(lengths, max_seq_length)
+
+    input_ids_dataset = tokenized_dataset.select_columns(["input_ids"])
+
+    def packed_rows():
+        for bin_indices in bins:
+            input_ids = []
+            seq_lengths = []
+            for example_ids in input_ids_dataset[bin_indices]["input_ids"]:
+                input_ids += example_ids[:max_seq_length]
+                seq_lengths.append(min(len(example_ids), max_seq_length))
+            yield {"input_ids": input_ids, "seq_lengths": seq_lengths, "num_tokens": len(input_ids)}
+
+    packed_dataset = Dataset.from_generator(packed_rows)
+
+    total_tokens = sum(lengths)
+    print(f"Packed {len(lengths)} examples ({total_tokens} tokens) into {len(bins)} rows of max {max_seq_length} "
+          f"tokens. Fill ratio: {total_tokens / (len(bins) * max_seq_length):.1%}")
+    return packed_dataset
+
+
+def pack_iterable_dataset(tokenized_dataset, max_seq_length, buffer_size=DEFAULT_STREAM_PACK_BUFFER_SIZE):
+    """
+    Pack a streamed tokenized dataset (see hn_streaming.py). The whole dataset is never known, so the examples are
+    packed with best-fit decreasing within windows of buffer_size examples.
+    """
+
+    def pack_func(examples):
+        result = {"input_ids": [], "seq_lengths": [], "num_tokens": []}
+        for bin_indices in pack_best_fit_decreasing(examples["num_tokens"], max_seq_length):
+            input_ids = []
+            seq_lengths = []
+            for idx in bin_indices:
+                example_ids = examples["input_ids"][idx][:max_seq_length]
+                input_ids += example_ids
+                seq_lengths.append(len(example_ids))
+            result["input_ids"].append(input_ids)
+            result["seq_lengths"].append(seq_lengths)
+            result["num_tokens"].append(len(input_ids))
+        return result
+
+    return tokenized_dataset.map(pack_func, batched=True, batch_size=buffer_size,
+                                 remove_columns=["post_id", "attention_mask", "num_comment_tokens",
+                                                 "num_summary_tokens", "truncated"])
+
+
+class PackedDataCollator:
+    """Collate packed rows into a batch with per-example position_ids, labels and (optionally) a block diagonal mask"""
+
+    def __init__(self, pad_token_id, block_diagonal_mask=False, mask_dtype=None):
+        self.pad_token_id = pad_token_id
+        self.block_diagonal_mask = block_diagonal_mask
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        import torch
+
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        batch_size = len(features)
+
+        input_ids = torch.full((batch_size, max_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_length), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_length), dtype=torch.long)
+        if self.block_diagonal_mask:
+            mask_dtype = self.mask_dtype or torch.float32
+            attention_mask = torch.full((batch_size, 1, max_length, max_length), torch.finfo(mask_dtype).min,
+                                        dtype=mask_dtype)
+
+        for row, feature in enumerate(features):
+            row_ids = torch.tensor(feature["input_ids"], dtype=torch.long)
+            input_ids[row, :len(row_ids)] = row_ids
+            labels[row, :len(row_ids)] = row_ids
+
+            start = 0
+            for seq_length in feature["seq_lengths"]:
+                end = start + seq_length
+                position_ids[row, start:end] = torch.arange(seq_length)
+                labels[row, start] = -100
+                if self.block_diagonal_mask:
+                    causal_block = torch.ones((seq_length, seq_length), dtype=torch.bool).tril()
+                    attention_mask[row, 0, start:end, start:end].masked_fill_(causal_block, 0)
+                start = end
+
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.block_diagonal_mask:
+            # Padding rows must attend to something, otherwise softmax over an all-masked row gives NaN
+            for row, feature in enumerate(features):
+                pad_positions = torch.arange(len(feature["input_ids"]), max_length)
+                attention_mask[row, 0, pad_positions, pad_positions] = 0
+            batch["attention_mask"] = attention_mask
+        # Without an attention_mask, the position_ids of the padding are 0, so flash attention treats every padding
+        #  token as an example of its own. Its labels are -100.
+        return batch
+
+
+class PaddedDataCollator:
+    """Collate unpacked tokenized examples into a right-padded batch. Used as the baseline in the benchmark."""
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        import torch
+
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        input_ids = torch.full((len(features), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), max_length), dtype=torch.long)
+        for row, feature in enumerate(features):
+            input_ids[row, :len(feature["input_ids"])] = torch.tensor(feature["input_ids"], dtype=torch.long)
+            attention_mask[row, :len(feature["input_ids"])] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, -100)
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def benchmark_collator(model, dataset, collator, batch_size, max_steps):
+    """Run forward/backward steps over the dataset and return real tokens/sec and padded token ratio"""
+    import torch
+
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+    model.train()
+
+    real_tokens = 0
+    total_tokens = 0
+    start_time = time.perf_counter()
+    steps = 0
+    for start in range(0, len(dataset), batch_size):
+        if steps >= max_steps:
+            break
+        features = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+        batch = collator(features)
+        loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+        real_tokens += sum(len(feature["input_ids"]) for feature in features)
+        total_tokens += batch["input_ids"].numel()
+        steps += 1
+    elapsed = time.perf_counter() - start_time
+    return {"steps": steps, "seconds": round(elapsed, 2), "tokens_per_sec": round(real_tokens / elapsed, 1),
+            "padding_ratio": round(1 - real_tokens / total_tokens, 3)}
+
+
+def make_tiny_model(vocab_size):
+    """Tiny random Llama model for CPU benchmarks"""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=8192)
+    config._attn_implementation = "sdpa"
+    return LlamaForCausalLM(config)
+
+
+def make_synthetic_tokenized_dataset(num_examples, max_seq_length, vocab_size=1000, seed=3407):
+    """Tokenized examples with a long-tailed length distribution like the HN posts (mostly short, a few very long)"""
+    import random
+
+    rng = random.Random(seed)
+    rows = {"input_ids": [], "num_tokens": []}
+    for _ in range(num_examples):
+        length = min(int(rng.lognormvariate(6.5, 0.9)) + 16, max_seq_length)
+        rows["input_ids"].append([rng.randrange(1, vocab_size) for _ in range(length)])
+        rows["num_tokens"].append(length)
+    return Dataset.from_dict(rows)
+
+
+if __name__ == "__main__":
+    max_seq_length = 2048
+    batch_size = 2
+    max_steps = 20
+    vocab_size = 1000
+
+    dataset = make_synthetic_tokenized_dataset(64, max_seq_length, vocab_size)
+    packed = pack_dataset(dataset, max_seq_length)
+
+    model = make_tiny_model(vocab_size)
+    padded_result = benchmark_collator(model, dataset, PaddedDataCollator(0), batch_size, max_steps)
+    print(f"Padded batches: {padded_result}")
+
+    model = make_tiny_model(vocab_size)
+    packed_result = benchmark_collator(model, packed, PackedDataCollator(0, block_diagonal_mask=True), 1, max_steps)
+    print(f"Packed rows:    {packed_result}")
@@ -0,0 +1,89 @@
+"""
+post_id -> row index lookup for dataset splits
+
+dataset.filter(lambda x: x['post_id'] == post_id) runs a Python function over every row and writes a new cache file,
+just to find one row. PostIdIndex maps post_id to row index. It is built once per split (from the post_id column)
+and saved next to the Arrow files of the split (<arrow file>.post_id_index.json), so later runs only load it.
+Lookups are O(1), and select_posts()/exclude_posts() use dataset.select() with the row indices, which doesn't
+copy or rewrite the data.
+"""
+
+import json
+import os
+
+import numpy as np
+
+INDEX_FILE_SUFFIX = ".post_id_index.json"
+
+# dataset fingerprint -> PostIdIndex built or loaded in this process
+_indexes = {}
+
+
+class PostIdIndex:
+    def __init__(self, row_by_post_id):
+        self.row_by_post_id = row_by_post_id
+
+    def __len__(self):
+        return len(self.row_by_post_id)
+
+    def __contains__(self, post_id):
+        return str(post_id) in self.row_by_post_id
+
+    def lookup(self, post_id):
+        """Row index of the post, or None if it is not in the split"""
+        return self.row_by_post_id.get(str(post_id))
+
+    def lookup_many(self, post_ids):
+        """Row indices of the posts that are in the split, in the order of post_ids"""
+        rows = (self.row_by_post_id.get(str(post_id)) for post_id in post_ids)
+        return np.fromiter((row for row in rows if row is not None), dtype=np.int64)
+
+
+def _index_path(dataset):
+    # Next to the first Arrow file of the dataset. Datasets that are only in memory have no files, and a selection
+    #  of rows (dataset with an indices mapping) shares the files of its source, so they don't get a saved index.
+    if not dataset.cache_files or dataset._indices is not None:
+        return None
+    return dataset.cache_files[0]['filename'] + INDEX_FILE_SUFFIX
+
+
+def get_post_index(dataset):
+    """Return the post_id index of the dataset: from memory, from the saved index file, or built from the data"""
+    fingerprint = dataset._fingerprint
+    if fingerprint in _indexes:
+        return _indexes[fingerprint]
+
+    index_path = _index_path(dataset)
+    index = None
+    if index_path and os.path.exists(index_path):
+        with open(index_path) as f:
+            saved = json.load(f)
+        if saved.get('fingerprint') == fingerprint:
+            index = PostIdIndex(saved['rows'])
+
+    if index is None:
+        post_ids = dataset.data.column('post_id').to_pylist() if dataset._indices is None else dataset['post_id']
+        index = PostIdIndex({str(post_id): row for row, post_id in enumerate(post_ids)})
+        if index_path:
+            try:
+                with open(index_path, 'w') as f:
+                    json.dump({'fingerprint': fingerprint, 'rows': index.row_by_post_id}, f)
+            except OSError as e:
+                # The data can be in a read-only cache. The index still works, it just isn't saved.
+                print(f"...Could not save post_id index to {index_path}: {e}")
+
+    _indexes[fingerprint] = index
+    return index
+
+
+def select_posts(dataset, post_ids):
+    """Rows of the dataset for the given post ids"""
+    return dataset.select(get_post_index(dataset).lookup_many(post_ids))
+
+
+def exclude_posts(dataset, post_ids):
+    """Rows of the dataset except the given post ids"""
+    excluded_rows = get_post_index(dataset).lookup_many(post_ids)
+    if len(excluded_rows) == 0:
+        return dataset
+    return dataset.select(np.setdiff1d(np.arange(len(dataset)), excluded_rows))
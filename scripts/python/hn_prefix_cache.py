@@ -0,0 +1,209 @@
+"""
+Shared-prefix KV cache for inference with the fixed system prompt
+
+Every prompt starts with the same text: the template header, the system prompt and USER_PROMPT_PREFIX (the text
+before the comment in template_segments(), see hn_prompts.py). TransformersTarget (hn_eval.py) computes the keys and
+values of that prefix again for every post. PrefixCachedTarget runs the prefix through the model once, keeps its KV
+cache and starts every generation from a copy of it, so the prefill only processes the thread and the rest of the
+template. The per-post suffixes are batched: each row of the batch is [prefix][padding][suffix], with the padding
+masked out, so the positions of the suffix tokens continue right after the prefix (generate() derives the position
+ids from the attention mask).
+
+The prefix and the suffix are tokenized separately, the same way as the training data (see hn_tokenize.py). With
+greedy decoding, the summaries are the same as without the cache.
+
+Run this file to compare time to first token, latency and CPU time per summary with and without the prefix cache on
+CPU, on the posts of the test split (synthetic posts and a small random Llama model by default):
+    uv run hn_prefix_cache.py --limit 16
+    uv run hn_prefix_cache.py --model HuggingFaceTB/SmolLM2-135M-Instruct --dataset annjose/hn-comments-small
+"""
+
+import argparse
+import copy
+import time
+
+from hn_eval import TransformersTarget
+from hn_prompts import SYSTEM_PROMPT, template_segments
+
+
+class PrefixCachedTarget(TransformersTarget):
+    """TransformersTarget that computes the KV cache of the shared prompt prefix once and reuses it for every batch"""
+
+    def __init__(self, model, tokenizer, model_id, max_new_tokens=1024, batch_size=4, system_prompt=SYSTEM_PROMPT):
+        super().__init__(model, tokenizer, model_id, max_new_tokens, batch_size, system_prompt)
+        self.prefix_text = template_segments(system_prompt)[0]
+        self.prefix_ids = tokenizer(self.prefix_text, add_special_tokens=False)["input_ids"]
+        self.prefix_cache = None
+        self.prefix_seconds = None
+
+    def cache_key(self):
+        return {**super().cache_key(), 'prefix_cache': True}
+
+    def _compute_prefix_cache(self):
+        import torch
+        from transformers import DynamicCache
+
+        start_time = time.perf_counter()
+        input_ids = torch.tensor([self.prefix_ids], device=self.model.device)
+        with torch.inference_mode():
+            self.prefix_cache = self.model(input_ids=input_ids, past_key_values=DynamicCache(),
+                                           use_cache=True).past_key_values
+        self.prefix_seconds = time.perf_counter() - start_time
+        print(f"...Computed the KV cache of the prompt prefix ({len(self.prefix_ids)} tokens) "
+              f"in {self.prefix_seconds:.2f} seconds")
+
+    def generate_inputs(self, prompts):
+        """[prefix][padding][suffix] rows, and a copy of the prefix cache for the batch (generate() extends it)"""
+        import torch
+
+        if not all(prompt.startswith(self.prefix_text) for prompt in prompts):
+            # Not prompts of this target (eg. another system prompt)
+            return super().generate_inputs(prompts)
+        if self.prefix_cache is None:
+            self._compute_prefix_cache()
+
+        suffix_ids = self.tokenizer([prompt[len(self.prefix_text):] for prompt in prompts],
+                                    add_special_tokens=False)["input_ids"]
+        max_suffix_length = max(len(ids) for ids in suffix_ids)
+        input_ids = []
+        attention_mask = []
+        for ids in suffix_ids:
+            num_padding = max_suffix_length - len(ids)
+            input_ids.append(self.prefix_ids + [self.tokenizer.pad_token_id] * num_padding + ids)
+            attention_mask.append([1] * len(self.prefix_ids) + [0] * num_padding + [1] * len(ids))
+
+        past_key_values = copy.deepcopy(self.prefix_cache)
+        past_key_values.batch_repeat_interleave(len(prompts))
+        return {
+            'input_ids': torch.tensor(input_ids, device=self.model.device),
+            'attention_mask': torch.tensor(attention_mask, device=self.model.device),
+            'past_key_values': past_key_values,
+        }
+
+
+def _run_target(target, prompts):
+    """Generate all the prompts in batches. Returns the outputs and the CPU seconds per summary."""
+    results = []
+    cpu_start = time.process_time()
+    for batch_start in range(0, len(prompts), target.batch_size):
+        results += target.generate_batch(prompts[batch_start:batch_start + target.batch_size])
+    return results, (time.process_time() - cpu_start) / len(prompts)
+
+
+def benchmark_prefix_cache(model, tokenizer, model_id, dataset, limit=16, batch_size=4, max_new_tokens=32,
+                           max_input_tokens=1024, system_prompt=SYSTEM_PROMPT):
+    """
+    Generate the summaries of the posts with and without the prefix cache, and compare TTFT, latency and CPU time
+    per summary. The prefix cache is computed before the timed runs (once per model, not per request).
+    """
+    from hn_thread import select_thread
+
+    plain_target = TransformersTarget(model, tokenizer, model_id, max_new_tokens, batch_size, system_prompt)
+    cached_target = PrefixCachedTarget(model, tokenizer, model_id, max_new_tokens, batch_size, system_prompt)
+
+    dataset = dataset.select(range(min(limit, len(dataset))))
+    prompts = [plain_target.prompt(select_thread(comment, max_input_tokens, plain_target.count_tokens))
+               for comment in dataset['input_comment']]
+    prompt_tokens = [len(ids) for ids in tokenizer(prompts, add_special_tokens=False)["input_ids"]]
+    mean_prompt_tokens = sum(prompt_tokens) / len(prompt_tokens)
+    prefix_share = len(cached_target.prefix_ids) / mean_prompt_tokens
+    print(f"\nBenchmarking the prefix cache on {len(prompts)} posts: prefix {len(cached_target.prefix_ids)} tokens, "
+          f"mean prompt {mean_prompt_tokens:.0f} tokens ({prefix_share:.1%} prefix), batch size: {batch_size}")
+
+    cached_target.generate_batch(prompts[:1])  # computes the prefix cache and warms up
+    plain_target.generate_batch(prompts[:1])
+    plain_results, plain_cpu_seconds = _run_target(plain_target, prompts)
+    cached_results, cached_cpu_seconds = _run_target(cached_target, prompts)
+
+    def summary(results, cpu_seconds):
+        return {
+            'mean_ttft_seconds': round(sum(result['ttft_seconds'] for result in results) / len(results), 4),
+            'mean_latency_seconds': round(sum(result['latency_seconds'] for result in results) / len(results), 4),
+            'cpu_seconds_per_summary': round(cpu_seconds, 4),
+        }
+
+    plain, cached = summary(plain_results, plain_cpu_seconds), summary(cached_results, cached_cpu_seconds)
+    report = {
+        'model': model_id,
+        'num_posts': len(prompts),
+        'prefix_tokens': len(cached_target.prefix_ids),
+        'mean_prompt_tokens': round(mean_prompt_tokens, 1),
+        'prefix_share': round(prefix_share, 4),
+        'prefix_cache_seconds': round(cached_target.prefix_seconds, 4),
+        'plain': plain,
+        'prefix_cached': cached,
+        'ttft_reduction': round(1 - cached['mean_ttft_seconds'] / plain['mean_ttft_seconds'], 4),
+        'cpu_reduction': round(1 - cached['cpu_seconds_per_summary'] / plain['cpu_seconds_per_summary'], 4),
+        'same_outputs': sum(a['output'] == b['output'] for a, b in zip(plain_results, cached_results)) / len(prompts),
+    }
+    return report
+
+
+def make_small_model(vocab_size, hidden_size=512, num_hidden_layers=8):
+    """Small random Llama model, large enough that the prefill dominates the time to first token on CPU"""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=hidden_size * 3,
+                         num_hidden_layers=num_hidden_layers, num_attention_heads=8, num_key_value_heads=8,
+                         max_position_embeddings=8192)
+    return LlamaForCausalLM(config).eval()
+
+
+if __name__ == "__main__":
+    import json
+    import os
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Compare generation with and without the prompt prefix KV cache")
+    parser.add_argument("--model", default=None, help="HF model id or directory. Default: a small random Llama model")
+    parser.add_argument("--dataset", default=None, help="HF dataset id or local directory. Default: synthetic posts")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--limit", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--max-input-tokens", type=int, default=1024, help="Reduce longer threads to this size")
+    parser.add_argument("--system-prompt-file", default=None, help="System prompt to use instead of SYSTEM_PROMPT")
+    parser.add_argument("--output", default="outputs/prefix_cache_benchmark.json")
+    args = parser.parse_args()
+
+    if args.model:
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        bench_tokenizer = AutoTokenizer.from_pretrained(args.model)
+        bench_model = AutoModelForCausalLM.from_pretrained(args.model, dtype=torch.float32).eval()
+    else:
+        from hn_synthetic import make_synthetic_tokenizer
+
+        bench_tokenizer = make_synthetic_tokenizer()
+        bench_model = make_small_model(len(bench_tokenizer))
+    if bench_tokenizer.pad_token_id is None:
+        bench_tokenizer.pad_token = bench_tokenizer.eos_token
+
+    if args.dataset:
+        from hn_dataset_cache import load_cached_dataset
+
+        bench_dataset = load_cached_dataset(args.dataset, token=os.environ.get('HF_TOKEN'))[args.split]
+    else:
+        from hn_synthetic import make_synthetic_post_dataset
+
+        # Not the seed of the training posts, like the synthetic validation/test split of finetune-hn-summary.py
+        bench_dataset = make_synthetic_post_dataset(args.limit, seed=1)
+
+    bench_system_prompt = SYSTEM_PROMPT
+    if args.system_prompt_file:
+        with open(args.system_prompt_file) as f:
+            bench_system_prompt = f.read().strip()
+
+    bench_report = benchmark_prefix_cache(bench_model, bench_tokenizer, args.model or "small-random-llama",
+                                          bench_dataset, args.limit, args.batch_size, args.max_new_tokens,
+                                          args.max_input_tokens, bench_system_prompt)
+    print(json.dumps(bench_report, indent=2))
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(bench_report, f, indent=2)
+    print(f"Benchmark results written to {args.output}")
@@ -0,0 +1,42 @@
+"""
+Prompts and chat template used to fine-tune and run the HN summarization model.
+
+The same system prompt and template must be used when formatting the training data and at inference time,
+so they are kept in one place and shared by the training, evaluation and serving code.
+"""
+
+SYSTEM_PROMPT = """You are an AI assistant specialized in analyzing and summarizing Hacker News discussions.
+A discussion consists of threaded comments where each comment can have child comments (replies) nested underneath it,
+forming interconnected conversation branches. Your task is to provide concise, meaningful summaries that capture the
+essence of the discussion while prioritizing engaging and high quality content."""
+
+USER_PROMPT_PREFIX = "This is your input:\n The title of the post and comments are separated by dashed lines."
+
+LLAMA_TEMPLATE = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+
+{SYSTEM}<|eot_id|><|start_header_id|>user<|end_header_id|>
+
+{INPUT}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+
+{OUTPUT}<|eot_id|>"""
+
+
+def format_prompt(comment, summary="", system_prompt=SYSTEM_PROMPT):
+    """Format one post in the chat template. Leave summary empty to get the prompt for inference."""
+    user_prompt = f"{USER_PROMPT_PREFIX}\n{comment}"
+    prompt = LLAMA_TEMPLATE.format(SYSTEM=system_prompt, INPUT=user_prompt, OUTPUT=summary)
+    if not summary:
+        # For inference, the prompt ends at the assistant header and the model generates the summary
+        prompt = prompt[:-len("<|eot_id|>")]
+    return prompt
+
+
+def template_segments(system_prompt=SYSTEM_PROMPT):
+    """
+    Split the template into the fixed text around the comment and the summary:
+    (text before the comment, text between the comment and the summary, text after the summary)
+    """
+    prompt = format_prompt("{COMMENT}", "{SUMMARY}", system_prompt)
+    before_comment, rest = prompt.split("{COMMENT}")
+    between, after_summary = rest.split("{SUMMARY}")
+    return before_comment, between, after_summary
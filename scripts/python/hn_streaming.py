@@ -0,0 +1,209 @@
+"""
+Streaming training input from local Parquet/Arrow shards
+
+The default pipeline loads the whole train split, tokenize_training_data() writes a tokenized copy and packing a
+third one, and the filters on the way read whole columns, so host RAM grows with the corpus. With data.streaming on,
+the train split is read lazily from its shard files instead: the Parquet shards of an export (see hn_export.py), or
+the Arrow files of a revision in the dataset cache (see hn_dataset_cache.py).
+- the shards are read one record batch at a time (datasets streaming mode), never as a whole table
+- the order of the shards and of the rows (within a buffer of shuffle_buffer_size rows) is shuffled every epoch
+- the posts are formatted and tokenized on the fly with the same function as tokenize_training_data() (see
+  hn_tokenize.py), and packed within windows of examples (see pack_iterable_dataset() in hn_packing.py). The shards
+  of a compressed export (see hn_compress.py) are decompressed one batch at a time, right before the tokenization.
+- all of this runs in the DataLoader worker processes (num_workers, each worker reads its own shards), which keep
+  prefetch_factor batches ready ahead of the training step
+
+The memory used by the input is bounded by the buffers, not by the size of the dataset. Deduplication and the memory
+outlier filter need the whole split, so they are not applied here: posts can be excluded by id instead. The dataset
+has no length, so the trainer needs max_steps. On resume, the Trainer skips the batches that were already trained on
+by reading them again.
+
+Run this file to measure the peak RSS of streaming synthetic shards of growing size (it should stay flat), compared
+to the in-memory pipeline:
+    uv run hn_streaming.py
+"""
+
+import glob
+import os
+
+from hn_compress import COMPRESSED_EXPORT_SCHEMA, decompressing_func, shard_export_codecs
+from hn_export import split_of_shard
+from hn_prompts import SYSTEM_PROMPT
+from hn_tokenize import DEFAULT_MAX_OUTPUT_TOKENS, make_tokenize_func
+
+DEFAULT_SHUFFLE_BUFFER_SIZE = 1000
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_PREFETCH_FACTOR = 4
+
+SHARD_EXTENSIONS = (".parquet", ".arrow")
+
+
+def find_shards(path, split="train"):
+    """
+    Shard files of the split in path: an export directory (data/<split>-*.parquet), a revision directory of the
+    dataset cache (<split>/*.arrow), a directory of shards, or a glob pattern
+    """
+    if glob.has_magic(path):
+        paths = glob.glob(path)
+    elif os.path.isdir(os.path.join(path, "data")):
+        paths = [shard for shard in glob.glob(os.path.join(path, "data", "*.parquet")) if split_of_shard(shard) == split]
+    elif os.path.isdir(os.path.join(path, split)):
+        paths = glob.glob(os.path.join(path, split, "*.arrow"))
+    else:
+        paths = glob.glob(os.path.join(path, "*"))
+    paths = sorted(shard for shard in paths if shard.endswith(SHARD_EXTENSIONS))
+
+    if not paths:
+        raise ValueError(f"No {split} shards (.parquet or .arrow files) found in {path}")
+    if len({os.path.splitext(shard)[1] for shard in paths}) > 1:
+        raise ValueError(f"Shards of {path} mix Parquet and Arrow files")
+    return paths
+
+
+def load_streaming_dataset(shard_paths, shuffle_buffer_size=DEFAULT_SHUFFLE_BUFFER_SIZE, seed=3407):
+    """IterableDataset of the rows of the shards, shuffled within a buffer of shuffle_buffer_size rows (0: in order)"""
+    from datasets import load_dataset
+
+    file_format = "parquet" if shard_paths[0].endswith(".parquet") else "arrow"
+    dataset = load_dataset(file_format, data_files={"train": shard_paths}, split="train", streaming=True)
+    if shuffle_buffer_size:
+        dataset = dataset.shuffle(seed=seed, buffer_size=shuffle_buffer_size)
+    return dataset
+
+
+def streaming_training_dataset(shard_paths, tokenizer, max_seq_length, max_output_tokens=DEFAULT_MAX_OUTPUT_TOKENS,
+                               thread_aware=True, shuffle_buffer_size=DEFAULT_SHUFFLE_BUFFER_SIZE, seed=3407,
+                               exclude_ids=None, system_prompt=SYSTEM_PROMPT):
+    """
+    IterableDataset of the tokenized posts of the shards, with the columns of tokenize_training_data().
+    Nothing is read until the dataset is iterated.
+    """
+    print(f"\nStreaming training data from {len(shard_paths)} shards with shuffle buffer: {shuffle_buffer_size}, "
+          f"max_seq_length: {max_seq_length}, max_output_tokens: {max_output_tokens}, thread_aware: {thread_aware}")
+    dataset = load_streaming_dataset(shard_paths, shuffle_buffer_size, seed)
+    if exclude_ids:
+        exclude_ids = set(exclude_ids)
+        dataset = dataset.filter(lambda post_id: post_id not in exclude_ids, input_columns="post_id")
+
+    tokenize_func = make_tokenize_func(tokenizer, max_seq_length, max_output_tokens, thread_aware, system_prompt)
+    columns = ["post_id", "input_comment", "output_summary"]
+    codecs = shard_export_codecs(shard_paths)
+    if codecs is not None:
+        # Shards of a compressed export (see hn_compress.py): every batch is decompressed right before it is tokenized
+        tokenize_func = decompressing_func(tokenize_func, codecs)
+        columns = COMPRESSED_EXPORT_SCHEMA.names
+    return dataset.map(tokenize_func, batched=True, batch_size=64, remove_columns=columns)
+
+
+def write_synthetic_shards(data_dir, num_posts, rows_per_shard=500, seed=3407, first_post_id=40000000):
+    """Write synthetic posts (see hn_synthetic.py) to train Parquet shards, one post at a time. Returns the paths."""
+    import random
+
+    from hn_export import ShardWriter
+    from hn_synthetic import synthetic_post
+
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(seed)
+    writer = ShardWriter(data_dir, "train", rows_per_shard=rows_per_shard)
+    for i in range(num_posts):
+        num_comments = min(200, max(5, int(rng.lognormvariate(3.0, 0.9))))
+        input_comment, output_summary = synthetic_post(rng, num_comments)
+        writer.write({'post_id': str(first_post_id + i), 'input_comment': input_comment,
+                      'output_summary': output_summary})
+    writer.close()
+    return writer.shard_paths
+
+
+def _workers_rss_mb():
+    """Current total RSS of the child processes (the DataLoader workers), in MB. Linux only."""
+    pid = os.getpid()
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            child_pids = f.read().split()
+    except OSError:
+        return 0
+    rss_kb = 0
+    for child_pid in child_pids:
+        try:
+            with open(f"/proc/{child_pid}/status") as f:
+                rss_kb += sum(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        except OSError:
+            # The worker exited
+            pass
+    return rss_kb / 1024
+
+
+def _measure_input_pipeline(shard_paths, streaming, max_seq_length, num_workers, prefetch_factor, cache_dir, queue):
+    """Run the training input of the shards to the end (without a model) and put its peak RSS on the queue"""
+    import resource
+    import time
+
+    from torch.utils.data import DataLoader
+
+    from hn_packing import pack_dataset, pack_iterable_dataset
+    from hn_synthetic import make_synthetic_tokenizer
+
+    tokenizer = make_synthetic_tokenizer()
+    start_time = time.perf_counter()
+    if streaming:
+        dataset = pack_iterable_dataset(streaming_training_dataset(shard_paths, tokenizer, max_seq_length, 256),
+                                        max_seq_length)
+        # Forked workers like the Trainer's DataLoader on Linux (the tokenize function is a closure, it can't be
+        #  pickled for spawned workers)
+        loader = DataLoader(dataset, batch_size=8, collate_fn=list, num_workers=num_workers,
+                            prefetch_factor=prefetch_factor if num_workers else None,
+                            multiprocessing_context="fork" if num_workers else None)
+    else:
+        from datasets import Dataset
+
+        from hn_tokenize import tokenize_training_data
+
+        dataset = Dataset.from_parquet(shard_paths, cache_dir=os.path.join(cache_dir, "hf"))
+        tokenized = tokenize_training_data(dataset, tokenizer, max_seq_length, 256,
+                                           cache_dir=os.path.join(cache_dir, "tokenized"))
+        loader = DataLoader(pack_dataset(tokenized, max_seq_length), batch_size=8, collate_fn=list)
+
+    num_rows = num_tokens = 0
+    peak_workers_rss_mb = 0
+    for batch in loader:
+        num_rows += len(batch)
+        num_tokens += sum(row["num_tokens"] for row in batch)
+        peak_workers_rss_mb = max(peak_workers_rss_mb, _workers_rss_mb())
+    # ru_maxrss is in KB on Linux. The children's ru_maxrss is not used: importing torch forks a process, which counts
+    #  with the full RSS of this process at that time.
+    queue.put({'rows': num_rows, 'tokens': num_tokens, 'seconds': round(time.perf_counter() - start_time, 1),
+               'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+               'peak_workers_rss_mb': round(peak_workers_rss_mb)})
+
+
+def measure_input_pipeline(shard_paths, streaming=True, max_seq_length=2048, num_workers=DEFAULT_NUM_WORKERS,
+                           prefetch_factor=DEFAULT_PREFETCH_FACTOR, cache_dir="cache/streaming_benchmark"):
+    """Peak RSS of the input pipeline, measured in a fresh process so that the runs don't share their peak"""
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure_input_pipeline, args=(shard_paths, streaming, max_seq_length,
+                                                                    num_workers, prefetch_factor, cache_dir, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception(f"Input pipeline measurement failed with exit code {process.exitcode}")
+    return queue.get()
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 4000, 16000]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_posts in sizes:
+            data_dir = os.path.join(tmp_dir, f"posts-{num_posts}", "data")
+            shard_paths = write_synthetic_shards(data_dir, num_posts)
+            shards_mb = sum(os.path.getsize(path) for path in shard_paths) / 2 ** 20
+            for streaming in [False, True]:
+                result = measure_input_pipeline(shard_paths, streaming,
+                                                cache_dir=os.path.join(tmp_dir, f"cache-{num_posts}"))
+                print(f"{num_posts} posts ({shards_mb:.0f} MB of shards), "
+                      f"{'streaming' if streaming else 'in memory'}: {result}")
@@ -0,0 +1,359 @@
+"""
+Content-addressed cache of the generated summaries, with incremental re-summarization of updated threads
+
+A summary is cached under the hash of the normalized thread (title and comments, see normalize_thread()) and of the
+target (the model id with its adapter and quantization, max_new_tokens and the system prompt, see
+target_fingerprint() in hn_eval.py). A post that is requested again with the same comments, by any process, is a
+cache hit, and a new model (eg. another GGUF quantization) never gets the summaries of the previous one. The model id
+plays the role of llm_model_name in posts_comments, and it is kept with every entry.
+
+The cache is a SQLite file. Every read updates the last access time of the entry, and once the entries are larger
+than max_bytes in total, the least recently used ones are removed.
+
+With incremental=True, a thread that is not in the cache is summarized in parts:
+- every top-level subtree ([n] and its replies) of at least min_subtree_chars is summarized on its own (with the
+  title), and the partial summary is cached under the hash of the subtree. The key leaves out the scores and the
+  reply and downvote counts (they change at every download) and the top-level index (a new top-level comment shifts
+  the following ones), so only subtrees with new or edited comments are summarized again.
+- the thread is then condensed: the large subtrees are replaced by one line with their partial summary, the small
+  ones are kept as they are, and the condensed thread is summarized into the final summary.
+When a few comments are added to a thread, only the changed subtrees and the (much shorter) condensed thread are
+generated. The first incremental summary of a thread costs more than a full one (the parts and the merge).
+
+Run this file to summarize synthetic threads with the stub chat completions server (see hn_eval.py), a second time
+(cache hits) and after adding a few comments, fully and incrementally:
+    uv run hn_summary_cache.py
+Or to summarize posts of the DB with a served model, through the cache:
+    uv run hn_summary_cache.py --post-ids 42000000,42000001 --base-url http://localhost:11434/v1 --model hn-finetune
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+
+from hn_eval import target_fingerprint
+from hn_thread import _render, parse_thread, select_thread
+
+DEFAULT_CACHE_PATH = "cache/summaries.sqlite"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MIN_SUBTREE_CHARS = 2000
+
+# Scores and counts of a comment line, which change between downloads: (score: 850) <replies: 2> {downvotes: 0}
+COMMENT_COUNTS_PATTERN = re.compile(r'^(\[[\d.]+\]) \(score: [^)]*\)(?: <replies: \d+>)?(?: \{downvotes: \d+\})?')
+MARKDOWN_PREFIX_PATTERN = re.compile(r'^\s*(?:#{1,6}|[*-]|\d+\.)\s+')
+
+CACHE_SCHEMA_SQL = [
+    '''create table if not exists summaries (
+        key         text primary key,
+        model_id    text,
+        value       text,
+        num_bytes   integer,
+        last_access real
+    )''',
+    "create index if not exists idx_summaries_last_access on summaries (last_access)",
+]
+
+
+def normalize_thread(text):
+    """Unicode NFC, one kind of line break, single spaces and no empty lines: the text the cache key is computed on"""
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    lines = (" ".join(line.split()) for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def thread_key(text, fingerprint):
+    """Cache key of the summary of a whole thread"""
+    return "thread:" + _hash(normalize_thread(text), fingerprint)
+
+
+def subtree_key(node, fingerprint):
+    """Cache key of the partial summary of a top-level subtree, without its counts and its top-level index"""
+    lines = []
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        for line in current.lines:
+            line = COMMENT_COUNTS_PATTERN.sub(lambda match: "[*" + match.group(1)[len(node.path) + 1:], line, count=1)
+            lines.append(line)
+        stack.extend(reversed(current.children))
+    return "subtree:" + _hash(normalize_thread("\n".join(lines)), fingerprint)
+
+
+class SummaryCache:
+    """Summaries on disk (SQLite), with least recently used eviction once they use more than max_bytes"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("pragma journal_mode = WAL")
+        for sql in CACHE_SCHEMA_SQL:
+            self.conn.execute(sql)
+        self.conn.commit()
+        self.hits = self.misses = self.evictions = 0
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key):
+        """The cached value (a JSON value), or None"""
+        row = self.conn.execute("select value from summaries where key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("update summaries set last_access = ? where key = ?", (time.time(), key))
+        self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value, model_id=None):
+        value = json.dumps(value)
+        num_bytes = len(key) + len(value.encode("utf-8"))
+        self.conn.execute("insert or replace into summaries (key, model_id, value, num_bytes, last_access) "
+                          "values (?, ?, ?, ?, ?)", (key, model_id, value, num_bytes, time.time()))
+        self.evict()
+        self.conn.commit()
+
+    def total_bytes(self):
+        return self.conn.execute("select coalesce(sum(num_bytes), 0) from summaries").fetchone()[0]
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes"""
+        excess = self.total_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, num_bytes in self.conn.execute("select key, num_bytes from summaries order by last_access"):
+            keys.append((key,))
+            excess -= num_bytes
+            if excess <= 0:
+                break
+        self.conn.executemany("delete from summaries where key = ?", keys)
+        self.evictions += len(keys)
+
+    def stats(self):
+        count, total_bytes = self.conn.execute("select count(*), coalesce(sum(num_bytes), 0) from summaries").fetchone()
+        return {'entries': count, 'bytes': total_bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+def _flatten_summary(summary):
+    """The summary on one line, without the markdown headings and list markers"""
+    lines = (MARKDOWN_PREFIX_PATTERN.sub('', line).strip() for line in summary.split('\n'))
+    return " ".join(line for line in lines if line)
+
+
+def _relabel_paths(summary, old_root, new_root):
+    """Replace the comment paths [old_root...] of a reused partial summary by [new_root...]"""
+    if old_root == new_root:
+        return summary
+    return re.sub(rf'\[{re.escape(old_root)}((?:\.\d+)*)\]', lambda match: f"[{new_root}{match.group(1)}]", summary)
+
+
+def _count_comments(node):
+    count = 0
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        count += 1
+        stack.extend(current.children)
+    return count
+
+
+class CachedSummarizer:
+    """Summarize threads with an eval target (see hn_eval.py), through a SummaryCache"""
+
+    def __init__(self, target, cache, incremental=False, min_subtree_chars=DEFAULT_MIN_SUBTREE_CHARS,
+                 max_input_tokens=None):
+        self.target = target
+        self.cache = cache
+        self.incremental = incremental
+        self.min_subtree_chars = min_subtree_chars
+        self.max_input_tokens = max_input_tokens
+        # Threads reduced to another size give other summaries
+        self.fingerprint = f"{target_fingerprint(target)}:{max_input_tokens}"
+
+    def _generate(self, threads):
+        """Summaries of the threads, in batches of the target. Returns (summaries, prompt tokens, output tokens)."""
+        if self.max_input_tokens:
+            threads = [select_thread(thread, self.max_input_tokens, self.target.count_tokens) for thread in threads]
+        prompts = [self.target.prompt(thread) for thread in threads]
+        results = []
+        for batch_start in range(0, len(prompts), self.target.batch_size):
+            results += self.target.generate_batch(prompts[batch_start:batch_start + self.target.batch_size])
+        for result in results:
+            if 'error' in result:
+                raise Exception(f"Summary generation failed: {result['error']}")
+        return ([result['output'] for result in results], sum(self.target.count_tokens(prompts)),
+                sum(result['output_tokens'] for result in results))
+
+    def summarize(self, thread):
+        """Returns (summary, info). info has the mode (hit, full or incremental) and the generated tokens."""
+        start_time = time.perf_counter()
+        key = thread_key(thread, self.fingerprint)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, {'mode': 'hit', 'prompt_tokens': 0, 'output_tokens': 0,
+                            'seconds': round(time.perf_counter() - start_time, 4)}
+
+        if self.incremental:
+            summary, info = self._summarize_incremental(thread)
+        else:
+            [summary], prompt_tokens, output_tokens = self._generate([thread])
+            info = {'mode': 'full', 'prompt_tokens': prompt_tokens, 'output_tokens': output_tokens}
+        self.cache.put(key, summary, self.target.model_id)
+        info['seconds'] = round(time.perf_counter() - start_time, 4)
+        return summary, info
+
+    def _summarize_incremental(self, thread):
+        header, top_level = parse_thread(thread)
+        large = [node for node in top_level if len(_render([], [node])) >= self.min_subtree_chars]
+
+        partial_summaries = {}
+        missing = []
+        for node in large:
+            cached = self.cache.get(subtree_key(node, self.fingerprint))
+            if cached is None:
+                missing.append(node)
+            else:
+                partial_summaries[node.path] = _relabel_paths(cached['summary'], cached['root'], node.path)
+
+        prompt_tokens = output_tokens = 0
+        if missing:
+            summaries, prompt_tokens, output_tokens = self._generate([_render(header, [node]) for node in missing])
+            for node, summary in zip(missing, summaries):
+                partial_summaries[node.path] = summary
+                self.cache.put(subtree_key(node, self.fingerprint), {'summary': summary, 'root': node.path},
+                               self.target.model_id)
+
+        # The condensed thread: the small subtrees as they are, one summary line for each large one
+        lines = list(header)
+        for node in top_level:
+            if node.path in partial_summaries:
+                prefix = COMMENT_COUNTS_PATTERN.match(node.lines[0])
+                prefix = prefix.group(0) if prefix else f"[{node.path}]"
+                lines.append(f"{prefix} summary of {_count_comments(node)} comments: "
+                             f"{_flatten_summary(partial_summaries[node.path])}")
+            else:
+                lines.append(_render([], [node]).rstrip('\n'))
+        [summary], merge_prompt_tokens, merge_output_tokens = self._generate(['\n'.join(lines) + '\n'])
+
+        return summary, {'mode': 'incremental', 'prompt_tokens': prompt_tokens + merge_prompt_tokens,
+                         'output_tokens': output_tokens + merge_output_tokens, 'subtrees': len(large),
+                         'generated_subtrees': len(missing)}
+
+
+def _updated_thread(rng, thread, num_comments):
+    """The thread with num_comments new replies in the last top-level subtree, like a download a few minutes later"""
+    from hn_synthetic import synthetic_comment_text
+
+    _, top_level = parse_thread(thread)
+    last = top_level[-1]
+    lines = thread.rstrip('\n').split('\n')
+    for i in range(num_comments):
+        lines.append(f"[{last.path}.{len(last.children) + i + 1}] (score: {rng.randint(1, 50)}) <replies: 0> "
+                     f"{{downvotes: 0}} user{rng.randint(1, 5000)}: {synthetic_comment_text(rng)}")
+    return '\n'.join(lines) + '\n'
+
+
+def benchmark_summary_cache(target, cache_dir, num_posts=8, num_comments=150, new_comments=3, seed=3407):
+    """
+    Generated tokens of the first summaries of synthetic threads, of the same requests again and of the threads with a
+    few new comments, with and without incremental mode
+    """
+    import random
+
+    from hn_synthetic import synthetic_post
+
+    rng = random.Random(seed)
+    threads = [synthetic_post(rng, num_comments)[0] for _ in range(num_posts)]
+    updated_threads = [_updated_thread(rng, thread, new_comments) for thread in threads]
+    # Prompt tokens of summarizing the updated threads from scratch
+    full_update_tokens = sum(target.count_tokens([target.prompt(thread) for thread in updated_threads]))
+
+    report = {'num_posts': num_posts, 'num_comments': num_comments, 'new_comments': new_comments,
+              'full_update_prompt_tokens': full_update_tokens}
+    for mode in ["full", "incremental"]:
+        cache = SummaryCache(os.path.join(cache_dir, f"{mode}.sqlite"))
+        summarizer = CachedSummarizer(target, cache, incremental=mode == "incremental")
+
+        phases = {}
+        for phase, phase_threads in [('first', threads), ('repeat', threads), ('update', updated_threads)]:
+            infos = [summarizer.summarize(thread)[1] for thread in phase_threads]
+            phases[phase] = {
+                'hits': sum(info['mode'] == 'hit' for info in infos),
+                'prompt_tokens': sum(info['prompt_tokens'] for info in infos),
+                'output_tokens': sum(info['output_tokens'] for info in infos),
+                'seconds': round(sum(info['seconds'] for info in infos), 3),
+            }
+        phases['update_cost'] = round(phases['update']['prompt_tokens'] / full_update_tokens, 3)
+        report[mode] = {**phases, 'cache': cache.stats()}
+        cache.close()
+    return report
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from hn_eval import OpenAICompatibleTarget, start_stub_server
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Summarize threads through the summary cache")
+    parser.add_argument("--base-url", default=None,
+                        help="OpenAI compatible API base URL. Default: the built-in stub server")
+    parser.add_argument("--model", default="hn-finetune-model", help="Model name on the server")
+    parser.add_argument("--model-id", default=None,
+                        help="Model id in the cache key (eg. the name with its adapter and quantization)")
+    parser.add_argument("--post-ids", default=None, help="Comma separated post ids of the DB to summarize")
+    parser.add_argument("--db", default="../data/hn_posts.db")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH)
+    parser.add_argument("--max-bytes", type=int, default=DEFAULT_MAX_BYTES)
+    parser.add_argument("--incremental", action="store_true", help="Summarize only the changed top-level subtrees")
+    parser.add_argument("--max-new-tokens", type=int, default=1024)
+    parser.add_argument("--max-input-tokens", type=int, default=None, help="Reduce longer threads to this size")
+    args = parser.parse_args()
+
+    stub_server = None
+    base_url = args.base_url
+    if base_url is None:
+        stub_server, base_url = start_stub_server()
+    summary_target = OpenAICompatibleTarget(base_url, args.model, api_key=os.environ.get('OPENAI_API_KEY'),
+                                            max_new_tokens=args.max_new_tokens, model_id=args.model_id)
+
+    if args.post_ids:
+        from hn_db import iter_post_pages
+        from hn_export import EXPORT_COLUMNS_SQL
+
+        summary_cache = SummaryCache(args.cache, args.max_bytes)
+        summarizer = CachedSummarizer(summary_target, summary_cache, args.incremental,
+                                      max_input_tokens=args.max_input_tokens)
+        for page in iter_post_pages(EXPORT_COLUMNS_SQL, args.db, post_ids=args.post_ids.split(",")):
+            for row in page:
+                post_summary, post_info = summarizer.summarize(row['input_comment'])
+                print(f"\n{row['post_id']}: {post_info}\n{post_summary}")
+        print(f"\nSummary cache: {summary_cache.stats()}")
+        summary_cache.close()
+    else:
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            print(json.dumps(benchmark_summary_cache(summary_target, tmp_dir), indent=2))
+
+    if stub_server is not None:
+        stub_server.shutdown()
@@ -0,0 +1,146 @@
+"""
+Sweep over training configurations (sequence length, batch size, LoRA rank, packing, ...)
+
+run_sweep() runs a short training for every combination of the values in the sweep section of the config
+(see hn_train_config.py) and collects the throughput and memory of each run from its step profile
+(hn_train_profiler.py). A run that runs out of memory is recorded as OOM and the sweep goes on with the next one.
+
+Sweep runs always start from scratch and don't save checkpoints, so every run measures the same steps. Every run is
+in a fresh (spawned) process, so its peak memory is its own and not the peak of the runs before it, the order of the
+runs doesn't change the results, and a run killed for running out of memory doesn't stop the sweep.
+
+The deduplicated and the tokenized data are cached on disk (see hn_dedup.py and tokenize_training_data()), so only
+the first run prepares them and runs with the same sequence length tokenize only once.
+
+The results are printed as a table and written to a CSV file. The fastest configuration whose peak memory is
+within the memory budget is reported at the end.
+"""
+
+import csv
+import os
+import signal
+
+from hn_train_config import expand_sweep
+
+SWEEP_RESULT_FIELDS = ['run', 'status', 'tokens_per_sec', 'mean_step_seconds', 'padding_ratio', 'peak_memory_mb',
+                       'fits_memory']
+
+
+def _is_out_of_memory(e):
+    import torch
+
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e).lower()
+
+
+def _sweep_run(run_training, run_config, run_args, queue):
+    """Run one config of the sweep and put its profile summary (or the error) on the queue"""
+    try:
+        queue.put({'summary': run_training(run_config, *run_args)})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}", 'oom': _is_out_of_memory(e)})
+
+
+def run_in_process(run_training, run_config, run_args=()):
+    """
+    Call run_training(run_config, *run_args) in a fresh process. Returns its profile summary, raises MemoryError if it
+    ran out of memory (or was killed, as the OOM killer does) and Exception if it failed.
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_sweep_run, args=(run_training, run_config, run_args, queue))
+    process.start()
+    process.join()
+    if queue.empty():
+        if process.exitcode == -signal.SIGKILL:
+            raise MemoryError(f"Sweep run was killed (exit code {process.exitcode}), probably out of memory")
+        raise Exception(f"Sweep run failed with exit code {process.exitcode}")
+    result = queue.get()
+    if 'error' in result:
+        raise (MemoryError if result['oom'] else Exception)(result['error'])
+    return result['summary']
+
+
+def run_sweep(config, run_training, output_path="outputs/sweep_results.csv", run_args=()):
+    """
+    Call run_training(run_config, *run_args) for every config of the sweep, each in a fresh process. run_training must
+    be a module level function (it's pickled to the process) that returns the profile summary of the run (see
+    TrainingProfilerCallback.summary()). Returns the list of result rows.
+    """
+    runs = expand_sweep(config)
+    sweep_keys = list(config.get('sweep') or {})
+    memory_budget_mb = config['data']['memory_budget_gb'] * 1024
+    print(f"\nSweep of {len(runs)} runs over: {', '.join(sweep_keys) or '(no sweep values)'}")
+
+    results = []
+    for index, (overrides, run_config) in enumerate(runs):
+        run_config['trainer'].update(resume=False, save_strategy='no')
+        run_name = run_config['trainer']['run_name']
+        print(f"\n=== Sweep run {index + 1}/{len(runs)}: {overrides or run_name}")
+        result = {'run': run_name, **overrides}
+        try:
+            summary = run_in_process(run_training, run_config, run_args)
+            result.update({
+                'status': 'ok',
+                'tokens_per_sec': summary['tokens_per_sec'],
+                'mean_step_seconds': summary['mean_step_seconds'],
+                'padding_ratio': summary['padding_ratio'],
+                'peak_memory_mb': summary['peak_memory_mb'],
+                'fits_memory': summary['peak_memory_mb'] <= memory_budget_mb,
+            })
+        except MemoryError as e:
+            print(f"...Sweep run {run_name} ran out of memory: {e}")
+            result.update({'status': 'OOM', 'fits_memory': False})
+        except Exception as e:
+            print(f"...Sweep run {run_name} failed: {e}")
+            result.update({'status': "error", 'fits_memory': False})
+
+        results.append(result)
+        write_sweep_results(results, sweep_keys, output_path)
+
+    print_sweep_results(results, sweep_keys)
+    return results
+
+
+def best_sweep_result(results):
+    """The run with the highest throughput among the ones that fit in memory"""
+    fitting = [result for result in results if result.get('fits_memory')]
+    return max(fitting, key=lambda result: result['tokens_per_sec']) if fitting else None
+
+
+def write_sweep_results(results, sweep_keys, output_path):
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=sweep_keys + SWEEP_RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def print_sweep_results(results, sweep_keys):
+    columns = [key.rsplit('.', 1)[-1] for key in sweep_keys] + ['status', 'tokens/sec', 'step (s)', 'padding',
+                                                                  'peak MB', 'fits']
+    rows = []
+    for result in results:
+        ok = result['status'] == 'ok'
+        rows.append([str(result[key]) for key in sweep_keys] + [
+            result['status'],
+            f"{result['tokens_per_sec']:.1f}" if ok else "-",
+            f"{result['mean_step_seconds']:.3f}" if ok else "-",
+            f"{100 * result['padding_ratio']:.1f}%" if ok else "-",
+            f"{result['peak_memory_mb']:.0f}" if ok else "-",
+            "yes" if result['fits_memory'] else "no",
+        ])
+
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("\nSweep results:")
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+    best = best_sweep_result(results)
+    if best:
+        print(f"\nFastest config that fits in memory: {best['run']} ({best['tokens_per_sec']:.1f} tokens/sec)")
+    else:
+        print("\nNo config fits in memory")
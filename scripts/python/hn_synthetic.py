@@ -0,0 +1,195 @@
+"""
+Synthetic HN posts for CPU runs, benchmarks and CI
+
+The generated posts have the same shape as the real ones: the input_comment is a title header followed by comment
+lines in the format written by download.js (see hn_thread.py), with nested replies, and the output_summary is a
+markdown summary with headings. Everything is generated from a seed, so the same arguments give the same data.
+
+make_synthetic_tokenizer() trains a small byte-level BPE tokenizer on synthetic threads, with the special tokens of
+the Llama-3 template (see hn_prompts.py), so the tokenization, packing and training code can run without
+downloading a tokenizer.
+
+write_synthetic_db() writes processed synthetic posts to a posts_comments table with the schema of download.js, for
+the code that reads the DB. Threads can be sized in characters instead of comments (up to 150K+ characters, like the
+longest real threads), and rows are written in batches, so a DB of 100K posts takes a few minutes.
+"""
+
+import json
+import random
+import re
+import sqlite3
+
+from datasets import Dataset
+
+WORDS = [
+    "the", "a", "to", "of", "and", "is", "in", "that", "it", "for", "this", "not", "with", "you", "but", "on", "are",
+    "be", "have", "as", "was", "they", "can", "if", "or", "just", "what", "so", "would", "more", "about", "my",
+    "code", "rust", "python", "model", "llm", "data", "database", "sqlite", "postgres", "startup", "company",
+    "google", "apple", "open", "source", "license", "browser", "performance", "memory", "latency", "cache",
+    "compiler", "kernel", "linux", "server", "cloud", "cost", "pricing", "users", "privacy", "security", "bug",
+    "release", "version", "api", "team", "engineers", "hiring", "remote", "work", "years", "time", "people",
+    "think", "agree", "disagree", "actually", "really", "better", "worse", "simple", "complex", "fast", "slow",
+]
+
+SPECIAL_TOKENS = ["<|begin_of_text|>", "<|end_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>",
+                  "<pad>"]
+
+
+def _sentence(rng, min_words, max_words):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + "."
+
+
+def synthetic_comment_text(rng, max_sentences=6):
+    return " ".join(_sentence(rng, 4, 20) for _ in range(rng.randint(1, max_sentences)))
+
+
+def synthetic_thread(rng, num_comments=None, max_depth=5, max_sentences=6, num_chars=None):
+    """
+    Formatted comment lines of a thread with num_comments comments, or with whole top-level subtrees until it has
+    num_chars characters (it can be longer by the last subtree)
+    """
+    lines = []
+    remaining = num_comments if num_comments is not None else float('inf')
+    thread_chars = 0
+    top_index = 0
+    while remaining > 0 and (num_chars is None or thread_chars < num_chars):
+        top_index += 1
+        # (path, depth) of the comments to write, depth first
+        stack = [(str(top_index), 0)]
+        while stack and remaining > 0:
+            path, depth = stack.pop()
+            num_replies = min(rng.randint(0, 3) if depth < max_depth else 0, remaining - 1)
+            remaining -= 1
+            score = max(1, int(rng.paretovariate(1.2) * 10)) if depth == 0 else rng.randint(1, 200)
+            lines.append(f"[{path}] (score: {score}) <replies: {num_replies}> {{downvotes: {rng.randint(0, 2)}}} "
+                         f"user{rng.randint(1, 5000)}: {synthetic_comment_text(rng, max_sentences)}")
+            thread_chars += len(lines[-1]) + 1
+            stack.extend((f"{path}.{i}", depth + 1) for i in range(num_replies, 0, -1))
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_summary(rng, num_sections=3):
+    lines = ["# Overview", _sentence(rng, 20, 40), ""]
+    for _ in range(num_sections):
+        lines.append(f"# {_sentence(rng, 2, 5)[:-1]}")
+        lines += [f"* {_sentence(rng, 8, 25)}" for _ in range(rng.randint(2, 4))]
+        lines.append("")
+    return "\n".join(lines)
+
+
+def synthetic_post(rng, num_comments):
+    title = _sentence(rng, 4, 10)[:-1]
+    input_comment = f"---- Post Title: \n{title}\n----- Comments: \n{synthetic_thread(rng, num_comments)}"
+    return input_comment, synthetic_summary(rng)
+
+
+def make_synthetic_post_dataset(num_posts, seed=3407, min_comments=5, max_comments=200, first_post_id=40000000):
+    """Dataset with the columns of the HF dataset (post_id, input_comment, output_summary)"""
+    rng = random.Random(seed)
+    rows = {"post_id": [], "input_comment": [], "output_summary": []}
+    for i in range(num_posts):
+        # Long tailed like the real posts: most threads are short, a few are very long
+        num_comments = min(max_comments, max(min_comments, int(rng.lognormvariate(3.0, 0.9))))
+        input_comment, output_summary = synthetic_post(rng, num_comments)
+        rows["post_id"].append(str(first_post_id + i))
+        rows["input_comment"].append(input_comment)
+        rows["output_summary"].append(output_summary)
+    return Dataset.from_dict(rows)
+
+
+def make_synthetic_tokenizer(vocab_size=2000, seed=3407):
+    """Small byte-level BPE tokenizer trained on synthetic threads, with the Llama-3 template special tokens"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    rng = random.Random(seed)
+    texts = [synthetic_post(rng, 20)[0] for _ in range(100)] + [synthetic_summary(rng) for _ in range(100)]
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|begin_of_text|>",
+                                   eos_token="<|end_of_text|>", pad_token="<pad>")
+
+
+POSTS_COMMENTS_SQL = '''
+    create table if not exists posts_comments (
+        post_id                         integer primary key,
+        post_author                     text,
+        post_created_at                 integer,
+        post_title                      text,
+        post_url                        text,
+        post_total_comments             integer,
+        post_points                     integer,
+        post_formatted_comments         text,
+        comment_path_map                text,
+        comment_info_map                text,
+        downloaded_at                   text default (datetime('now')),
+        llm_response_summary            text,
+        llm_response_input_token_count  integer,
+        llm_response_output_token_count integer,
+        llm_response_total_token_count  integer,
+        llm_processed                   integer default 0,
+        llm_model_name                  text
+    )
+'''
+
+SYNTHETIC_LINE_PATTERN = re.compile(r'^\[([\d.]+)\] \(score: (\d+)\) <replies: (\d+)> \{downvotes: (\d+)\} (\w+):')
+
+
+def synthetic_comment_maps(rng, formatted_comments):
+    """comment_path_map and comment_info_map of the formatted comments, as JSON arrays like download.js saves them"""
+    path_map = []
+    info_map = []
+    for position, line in enumerate(formatted_comments.split('\n')):
+        match = SYNTHETIC_LINE_PATTERN.match(line)
+        if not match:
+            continue
+        path, score, replies, downvotes, author = match.groups()
+        comment_id = rng.randint(40000000, 43000000)
+        path_map.append([path, comment_id])
+        info_map.append([comment_id, {'author': author, 'path': path, 'replies': int(replies), 'position': position,
+                                      'downvotes': int(downvotes), 'score': int(score)}])
+    return json.dumps(path_map), json.dumps(info_map)
+
+
+def synthetic_thread_chars(rng, max_thread_chars):
+    """Long tailed thread size in characters (median ~3K), at most max_thread_chars"""
+    return min(max_thread_chars, int(rng.lognormvariate(8.0, 1.2)))
+
+
+def write_synthetic_db(db_path, num_posts, seed=3407, min_comments=5, max_comments=200, first_post_id=40000000,
+                       model_name="gemini-2.0-flash", max_thread_chars=None, batch_size=1000):
+    """
+    Write processed synthetic posts to the posts_comments table of a DB file, with the schema of download.js.
+    With max_thread_chars, the threads are sized in characters instead of comments (see synthetic_thread_chars()),
+    and every 100th thread has max_thread_chars characters, so the longest threads are in every run.
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    conn.execute(POSTS_COMMENTS_SQL)
+    rows = []
+    for i in range(num_posts):
+        if max_thread_chars:
+            num_chars = max_thread_chars if i % 100 == 0 else synthetic_thread_chars(rng, max_thread_chars)
+            formatted_comments = synthetic_thread(rng, num_chars=num_chars)
+        else:
+            num_comments = min(max_comments, max(min_comments, int(rng.lognormvariate(3.0, 0.9))))
+            formatted_comments = synthetic_thread(rng, num_comments)
+        path_map, info_map = synthetic_comment_maps(rng, formatted_comments)
+        rows.append((first_post_id + i, _sentence(rng, 4, 10)[:-1], formatted_comments.count('\n'),
+                     formatted_comments, path_map, info_map, synthetic_summary(rng), model_name))
+        if len(rows) >= batch_size or i == num_posts - 1:
+            conn.executemany('''
+                insert or replace into posts_comments (post_id, post_title, post_total_comments,
+                                                       post_formatted_comments, comment_path_map, comment_info_map,
+                                                       llm_response_summary, llm_processed, llm_model_name)
+                values (?, ?, ?, ?, ?, ?, ?, 1, ?)
+            ''', rows)
+            conn.commit()
+            rows = []
+    conn.close()
@@ -0,0 +1,184 @@
+"""
+Thread-aware selection and chunking of the formatted HN comments
+
+The input_comment of a post is the title followed by one line per comment, in the format written by download.js:
+    [1.2.1] (score: 850) <replies: 2> {downvotes: 0} author: comment text
+The hierarchy path gives the position of the comment in the thread, so the lines can be parsed into a tree in one pass.
+
+Instead of cutting the text at a fixed length (which cuts a discussion in the middle of a comment and drops
+everything after it), select_thread() keeps whole subtrees, highest score first, until the token budget is used up.
+A subtree that is too big for the remaining budget is split: its root comment is kept and its replies are
+selected the same way. split_thread() groups whole subtrees into chunks of at most the budget instead.
+
+Parsing, counting and selection are all linear in the number of comments (plus sorting the replies of each
+comment by score), so this is cheap even for threads with 100K+ chars.
+"""
+
+import re
+
+COMMENT_LINE_PATTERN = re.compile(r'^\[(\d+(?:\.\d+)*)\] \(score: (-?\d+(?:\.\d+)?)\)')
+
+
+class CommentNode:
+    """A comment and its replies. lines holds the text of the comment (usually one line)."""
+
+    __slots__ = ('path', 'score', 'lines', 'children', 'own_tokens', 'subtree_tokens')
+
+    def __init__(self, path, score, line):
+        self.path = path
+        self.score = score
+        self.lines = [line]
+        self.children = []
+        self.own_tokens = 0
+        self.subtree_tokens = 0
+
+
+def estimate_tokens(texts):
+    """Cheap token count estimate (~4 chars per token) used when no tokenizer is given"""
+    return [len(text) // 4 + 1 for text in texts]
+
+
+def parse_thread(text):
+    """
+    Parse the formatted comments into a tree.
+    Returns (header lines, list of top-level CommentNode). The header is everything before the first comment line.
+    """
+    header = []
+    top_level = []
+    nodes_by_path = {}
+    current = None
+
+    for line in text.split('\n'):
+        match = COMMENT_LINE_PATTERN.match(line)
+        if not match:
+            # Not a comment line: either part of the header, or a continuation of the current comment
+            if current is None:
+                header.append(line)
+            elif line:
+                current.lines.append(line)
+            continue
+
+        path, score = match.group(1), float(match.group(2))
+        current = CommentNode(path, score, line)
+        nodes_by_path[path] = current
+
+        parent_path = path.rpartition('.')[0]
+        parent = nodes_by_path.get(parent_path) if parent_path else None
+        if parent is not None:
+            parent.children.append(current)
+        else:
+            # Top-level comment, or a reply whose parent is missing in the text. Keep it as a top-level subtree.
+            top_level.append(current)
+
+    return header, top_level
+
+
+def count_subtree_tokens(header, top_level, count_tokens=estimate_tokens):
+    """Set own_tokens and subtree_tokens on every node. Returns the token count of the header."""
+
+    # Collect all nodes (depth first) and count the tokens of all their text in one batch call
+    nodes = []
+    stack = list(reversed(top_level))
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.children))
+
+    counts = count_tokens(['\n'.join(header)] + ['\n'.join(node.lines) + '\n' for node in nodes])
+    for node, count in zip(nodes, counts[1:]):
+        node.own_tokens = count
+
+    # Children come after their parent in depth first order, so summing in reverse gives the subtree totals
+    for node in reversed(nodes):
+        node.subtree_tokens = node.own_tokens + sum(child.subtree_tokens for child in node.children)
+
+    return counts[0]
+
+
+def _select_subtrees(nodes, budget, selected):
+    """Add whole subtrees (highest score first) to selected, splitting the ones that don't fit. Returns used tokens."""
+    used = 0
+    for node in sorted(nodes, key=lambda n: n.score, reverse=True):
+        remaining = budget - used
+        if node.subtree_tokens <= remaining:
+            _add_subtree(node, selected)
+            used += node.subtree_tokens
+        elif node.own_tokens <= remaining:
+            # Keep the comment and as many of its replies (and their replies) as fit
+            selected.add(node.path)
+            used += node.own_tokens
+            used += _select_subtrees(node.children, budget - used, selected)
+    return used
+
+
+def _add_subtree(node, selected):
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        selected.add(current.path)
+        stack.extend(current.children)
+
+
+def _render(header, top_level, selected=None):
+    lines = list(header)
+    stack = list(reversed(top_level))
+    while stack:
+        node = stack.pop()
+        if selected is None or node.path in selected:
+            lines.extend(node.lines)
+            stack.extend(reversed(node.children))
+    return '\n'.join(lines) + '\n'
+
+
+def select_thread(text, token_budget, count_tokens=estimate_tokens):
+    """
+    Return the comments text reduced to at most token_budget tokens by keeping the highest scored whole subtrees.
+    The kept comments stay in their original order. The text is returned as is if it fits in the budget.
+    """
+    header, top_level = parse_thread(text)
+    header_tokens = count_subtree_tokens(header, top_level, count_tokens)
+    total_tokens = header_tokens + sum(node.subtree_tokens for node in top_level)
+    if total_tokens <= token_budget:
+        return text
+
+    selected = set()
+    _select_subtrees(top_level, token_budget - header_tokens, selected)
+    return _render(header, top_level, selected)
+
+
+def split_thread(text, token_budget, count_tokens=estimate_tokens):
+    """
+    Split the comments into chunks of at most token_budget tokens, each with the header and whole top-level subtrees
+    in the original order. A top-level subtree that is bigger than the budget is reduced with select_thread().
+    """
+    header, top_level = parse_thread(text)
+    header_tokens = count_subtree_tokens(header, top_level, count_tokens)
+    subtree_budget = token_budget - header_tokens
+
+    chunks = []
+    current_nodes = []
+    current_tokens = 0
+    for node in top_level:
+        if node.subtree_tokens > subtree_budget:
+            # Too big for one chunk. Keep its best parts in a chunk of its own.
+            selected = set()
+            _select_subtrees([node], subtree_budget, selected)
+            chunks.append(_render(header, [node], selected))
+            continue
+        if current_tokens + node.subtree_tokens > subtree_budget:
+            chunks.append(_render(header, current_nodes))
+            current_nodes = []
+            current_tokens = 0
+        current_nodes.append(node)
+        current_tokens += node.subtree_tokens
+
+    if current_nodes:
+        chunks.append(_render(header, current_nodes))
+    return chunks
+
+
+def make_tokenizer_counter(tokenizer):
+    """Return a count_tokens function that uses the tokenizer (one batch call for all the comments of a thread)"""
+    def count_tokens(texts):
+        return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    return count_tokens
@@ -0,0 +1,127 @@
+"""
+Cached tokenization of the training data
+
+tokenize_training_data() formats the posts in the chat template and tokenizes them in batches. The result has
+input_ids, attention_mask and the exact token counts of every example, so truncation is done in tokens (not chars)
+and SFTTrainer doesn't need to tokenize the dataset again. Comments that don't fit are reduced by keeping the
+highest scored whole subtrees of the thread (see hn_thread.py), instead of being cut off at the token limit.
+The tokenized dataset is saved to disk under a fingerprint of the tokenizer, the template, the truncation settings
+and the data. Later runs with the same inputs load it from disk (memory-mapped) and skip all the work.
+"""
+
+import hashlib
+import os
+
+from datasets import load_from_disk
+from datasets.fingerprint import Hasher
+
+from hn_prompts import SYSTEM_PROMPT, template_segments
+from hn_thread import make_tokenizer_counter, select_thread
+
+DEFAULT_CACHE_DIR = "cache/tokenized"
+
+# Cap on the summary tokens. The comments get the rest of max_seq_length.
+DEFAULT_MAX_OUTPUT_TOKENS = 2048
+
+
+def tokenized_data_fingerprint(dataset, tokenizer, max_seq_length, max_output_tokens, thread_aware,
+                               system_prompt=SYSTEM_PROMPT):
+    """Fingerprint of everything that the tokenized data depends on"""
+    hasher = hashlib.sha256()
+    for part in [
+        Hasher.hash(tokenizer),
+        "".join(template_segments(system_prompt)),
+        str(max_seq_length),
+        str(max_output_tokens),
+        str(thread_aware),
+        dataset._fingerprint,
+    ]:
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+
+def make_tokenize_func(tokenizer, max_seq_length, max_output_tokens, thread_aware=True, system_prompt=SYSTEM_PROMPT):
+    """Return the batched map function that formats and tokenizes posts"""
+    count_tokens = make_tokenizer_counter(tokenizer)
+
+    # The template text around the comment and summary is the same for every post, so tokenize it once
+    before_comment, between, after_summary = template_segments(system_prompt)
+    before_ids, between_ids, after_ids = tokenizer(
+        [before_comment, between, after_summary + tokenizer.eos_token], add_special_tokens=False
+    )["input_ids"]
+    template_length = len(before_ids) + len(between_ids) + len(after_ids)
+
+    def tokenize_func(examples):
+        # Skip the posts with empty comment or summary
+        keep = [bool(comment) and bool(summary)
+                for comment, summary in zip(examples["input_comment"], examples["output_summary"])]
+        post_ids = [post_id for post_id, flag in zip(examples["post_id"], keep) if flag]
+        comments = [comment for comment, flag in zip(examples["input_comment"], keep) if flag]
+        summaries = [summary for summary, flag in zip(examples["output_summary"], keep) if flag]
+
+        comment_ids = tokenizer(comments, add_special_tokens=False)["input_ids"] if comments else []
+        summary_ids = tokenizer(summaries, add_special_tokens=False)["input_ids"] if summaries else []
+
+        result = {"post_id": [], "input_ids": [], "attention_mask": [],
+                  "num_tokens": [], "num_comment_tokens": [], "num_summary_tokens": [], "truncated": []}
+        for post_id, comment, comment_tokens, summary_tokens in zip(post_ids, comments, comment_ids, summary_ids):
+            truncated = False
+            if len(summary_tokens) > max_output_tokens:
+                summary_tokens = summary_tokens[:max_output_tokens]
+                truncated = True
+            max_comment_tokens = max(max_seq_length - template_length - len(summary_tokens), 0)
+            if len(comment_tokens) > max_comment_tokens:
+                if thread_aware:
+                    # Keep the best whole subtrees. Line by line token counts can differ from the count of the joined
+                    #  text by a few tokens, so the slice below still enforces the limit.
+                    comment = select_thread(comment, max_comment_tokens, count_tokens)
+                    comment_tokens = tokenizer(comment, add_special_tokens=False)["input_ids"]
+                comment_tokens = comment_tokens[:max_comment_tokens]
+                truncated = True
+
+            input_ids = before_ids + comment_tokens + between_ids + summary_tokens + after_ids
+            result["post_id"].append(post_id)
+            result["input_ids"].append(input_ids)
+            result["attention_mask"].append([1] * len(input_ids))
+            result["num_tokens"].append(len(input_ids))
+            result["num_comment_tokens"].append(len(comment_tokens))
+            result["num_summary_tokens"].append(len(summary_tokens))
+            result["truncated"].append(truncated)
+        return result
+
+    return tokenize_func
+
+
+def tokenize_training_data(dataset, tokenizer, max_seq_length, max_output_tokens=DEFAULT_MAX_OUTPUT_TOKENS,
+                           thread_aware=True, cache_dir=DEFAULT_CACHE_DIR, num_proc=None, system_prompt=SYSTEM_PROMPT):
+    """Format and tokenize the dataset in batches, or load the result from the cache if it was done before"""
+
+    fingerprint = tokenized_data_fingerprint(dataset, tokenizer, max_seq_length, max_output_tokens, thread_aware,
+                                             system_prompt)
+    cache_path = os.path.join(cache_dir, fingerprint)
+    if os.path.exists(cache_path):
+        print(f"\nLoading tokenized data from cache: {cache_path}")
+        return load_from_disk(cache_path)
+
+    print(f"\nTokenizing {len(dataset)} posts with max_seq_length: {max_seq_length}, "
+          f"max_output_tokens: {max_output_tokens}, thread_aware: {thread_aware}...")
+    tokenize_func = make_tokenize_func(tokenizer, max_seq_length, max_output_tokens, thread_aware, system_prompt)
+    tokenized_dataset = dataset.map(
+        tokenize_func,
+        batched=True,
+        batch_size=64,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing",
+    )
+
+    # Save to a temp dir first, so that an interrupted run doesn't leave a partial cache entry
+    tmp_path = cache_path + ".tmp"
+    tokenized_dataset.save_to_disk(tmp_path)
+    os.replace(tmp_path, cache_path)
+    print(f"Tokenized {len(tokenized_dataset)} examples "
+          f"({sum(tokenized_dataset['truncated'])} truncated). Saved to cache: {cache_path}")
+
+    # Reload from the cache so that the returned dataset is memory-mapped from the cache files
+    return load_from_disk(cache_path)
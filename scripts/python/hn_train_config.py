@@ -0,0 +1,178 @@
+"""
+Training run configuration
+
+A run is described by a config with one section per step of finetune-hn-summary.py:
+- model: initialize_model() (backend, base model, max_seq_length, 4-bit loading)
+- lora: setup_lora_adapter() (rank, alpha, dropout, target modules)
+- data: loading, dedup and tokenization of the training data
+- trainer: setup_trainer() (packing, wandb, profile file and the TrainingArguments)
+- sweep: optional grid of values to try, see hn_sweep.py
+
+Config files are TOML (or YAML, if pyyaml is installed) with the same sections. Only the values that differ from
+DEFAULT_CONFIG need to be in the file. See configs/train.toml and configs/train_tiny_cpu.toml.
+
+The "tiny" model backend replaces the Unsloth model with a tiny random Llama model, a synthetic tokenizer and a
+plain PEFT LoRA adapter, so the whole training pipeline (and a sweep) runs on CPU in seconds.
+"""
+
+import copy
+import itertools
+import os
+import tomllib
+
+DEFAULT_CONFIG = {
+    'model': {
+        'backend': 'unsloth',  # or 'tiny'
+        'base_model_name': 'unsloth/llama-3-8b-bnb-4bit',
+        'max_seq_length': 8192,
+        'load_in_4bit': True,
+        'dtype': 'auto',
+    },
+    'lora': {
+        'r': 16,
+        'lora_alpha': 16,
+        'lora_dropout': 0,
+        'target_modules': ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+        'use_gradient_checkpointing': 'unsloth',
+        'random_state': 3407,
+    },
+    'data': {
+        'dataset_id': 'annjose/hn-comments-small',
+        'revision': '',
+        # > 0: use this many synthetic posts (hn_synthetic.py) instead of the dataset
+        'synthetic_posts': 0,
+        'dedup': True,
+        'exclude_memory_outliers': True,
+        'memory_budget_gb': 24,
+        'max_output_tokens': 2048,
+        'thread_aware': True,
+        # Stream the train split from its shard files instead of loading it (see hn_streaming.py). Dedup and the
+        #  memory outlier filter are not applied, and trainer.max_steps is needed.
+        'streaming': False,
+        # Export directory, dataset cache revision directory or glob of .parquet/.arrow files. Default: the dataset
+        #  cache revision of dataset_id.
+        'shards': '',
+        'shuffle_buffer_size': 1000,
+        'num_workers': 2,
+        'prefetch_factor': 4,
+    },
+    'trainer': {
+        'run_name': 'ann-text-trunc-1medium_4small_posts_Llama-3-8b-bnb-4bit_beast_4096',
+        'packing': False,
+        'block_diagonal_mask': False,
+        'use_wandb': True,
+        'profile_path': 'outputs/train_profile.jsonl',
+        # "auto": resume from the latest checkpoint of the run if there is one, true: it must exist, false: start
+        #  over, or the path of a checkpoint (see hn_checkpoint.py)
+        'resume': 'auto',
+        'per_device_train_batch_size': 2,
+        'gradient_accumulation_steps': 4,
+        'warmup_steps': 5,
+        'max_steps': 60,
+        'learning_rate': 2e-4,
+        'optim': 'adamw_8bit',
+        'weight_decay': 0.01,
+        'lr_scheduler_type': 'linear',
+        'seed': 3407,
+        # Checkpoints are saved in <output_dir>/<run_name>
+        'output_dir': 'outputs',
+        'logging_steps': 1,
+        'save_strategy': 'steps',
+        'save_steps': 20,
+        'save_total_limit': 2,
+    },
+    # Dotted key -> list of values, eg. "model.max_seq_length" = [2048, 4096]
+    'sweep': {},
+}
+
+# Sections whose keys are all passed to TrainingArguments, except these
+TRAINER_RUN_KEYS = ['run_name', 'packing', 'block_diagonal_mask', 'use_wandb', 'profile_path', 'resume']
+
+
+def _merge(base, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict) and key != 'sweep':
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def load_train_config(path=None, overrides=None):
+    """Return DEFAULT_CONFIG updated with the values of the config file and of the overrides dict"""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(f"pyyaml is needed to read {path}. Install it or use a TOML config.")
+            with open(path) as f:
+                file_config = yaml.safe_load(f) or {}
+        else:
+            with open(path, 'rb') as f:
+                file_config = tomllib.load(f)
+
+        unknown = set(file_config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown sections in {path}: {sorted(unknown)}")
+        _merge(config, file_config)
+
+    if overrides:
+        _merge(config, overrides)
+    return config
+
+
+def get_config_value(config, dotted_key):
+    section, key = dotted_key.split('.', 1)
+    return config[section][key]
+
+
+def set_config_value(config, dotted_key, value):
+    section, key = dotted_key.split('.', 1)
+    if section not in config or key not in config[section]:
+        raise ValueError(f"Unknown config key: {dotted_key}")
+    config[section][key] = value
+
+
+def training_arguments_config(config):
+    """The trainer section without the keys that are not TrainingArguments"""
+    return {key: value for key, value in config['trainer'].items() if key not in TRAINER_RUN_KEYS}
+
+
+def run_output_dir(config):
+    # Each run has its own checkpoints, so a run never resumes from the checkpoint of another config
+    return os.path.join(config['trainer']['output_dir'], config['trainer']['run_name'])
+
+
+def expand_sweep(config):
+    """
+    Return a list of (overrides, run config), one for every combination of the sweep values (the config itself if
+    there is no sweep). The run name of each config gets the overridden values as a suffix.
+    """
+    sweep = config.get('sweep') or {}
+    if not sweep:
+        return [({}, config)]
+
+    keys = list(sweep)
+    runs = []
+    for values in itertools.product(*(sweep[key] for key in keys)):
+        run_config = copy.deepcopy(config)
+        run_config['sweep'] = {}
+        overrides = dict(zip(keys, values))
+        for key, value in overrides.items():
+            set_config_value(run_config, key, value)
+        suffix = "-".join(f"{key.rsplit('.', 1)[-1]}={value}" for key, value in overrides.items())
+        run_config['trainer']['run_name'] = f"{config['trainer']['run_name']}-{suffix}"
+        runs.append((overrides, run_config))
+    return runs
+
+
+def config_dtype(config):
+    # 'auto' -> None (detected by Unsloth)
+    dtype = config['model']['dtype']
+    return None if dtype in (None, '', 'auto') else dtype
+
+
+def config_revision(config):
+    return config['data']['revision'] or None
@@ -0,0 +1,263 @@
+"""
+Per-step profile of the training loop, written to a local JSONL or CSV file (no wandb needed)
+
+TrainingProfilerCallback is a TrainerCallback that splits the wall time of every optimizer step into phases:
+- data: waiting for the batches (dataloader and collator), plus logging/checkpointing of the previous step
+- forward: the forward pass of the model (timed with forward hooks on the model)
+- backward: the backward pass and gradient clipping
+- optimizer: the optimizer step, lr scheduler and zero_grad
+It also records the real (non-padding) and padded tokens of the step, real tokens/sec and the peak memory of the
+step. memory_metric says what the peak is:
+- cuda_max_allocated: the peak CUDA memory allocated by torch during the step
+- peak_rss: the peak RSS of the process during the step (CPU, on Linux: the peak is reset through
+  /proc/self/clear_refs after every step)
+- process_max_rss: the peak RSS of the process since it started (CPU elsewhere). It can't be reset, so it grows with
+  everything the process did before, including earlier runs.
+
+On GPU the callback synchronizes CUDA at every phase boundary, so the times are the time of the work and not of
+queueing the kernels. That adds a little overhead, so use it to compare configurations, not in every run.
+
+Every step is written as one row as soon as it ends, so the file is usable even if training is interrupted. At the
+end of training, a summary row (means over the steps after the first, which includes the warmup) is appended to
+<output file>.summary.jsonl, so runs with different packing, sequence length or batch size can be compared offline.
+"""
+
+import csv
+import json
+import os
+import resource
+import sys
+import time
+
+from transformers import TrainerCallback
+
+PHASES = ['data', 'forward', 'backward', 'optimizer']
+
+STEP_FIELDS = (['run', 'step', 'step_seconds'] + [f'{phase}_seconds' for phase in PHASES] +
+               ['micro_batches', 'real_tokens', 'padded_tokens', 'padding_ratio', 'tokens_per_sec', 'peak_memory_mb',
+                'memory_metric'])
+
+
+def count_batch_tokens(inputs):
+    """Return (real tokens, total tokens including padding) of a batch of model inputs"""
+    input_ids = inputs.get('input_ids')
+    if input_ids is None:
+        return 0, 0
+    total = input_ids.numel()
+
+    attention_mask = inputs.get('attention_mask')
+    if attention_mask is not None and attention_mask.dim() == 2:
+        return int(attention_mask.sum()), total
+
+    # Packed rows without a 2D mask (see hn_packing.py): the padding is at the end of each row, where position_ids
+    #  stay 0. The real tokens of a row end at its last non-zero position.
+    position_ids = inputs.get('position_ids')
+    if position_ids is not None:
+        import torch
+
+        positions = torch.arange(1, position_ids.shape[-1] + 1, device=position_ids.device)
+        return int(((position_ids > 0) * positions).max(dim=-1).values.sum()), total
+
+    return total, total
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets the peak RSS (VmHWM) of the process to its current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return round(int(line.split()[1]) / 2 ** 10, 1)
+    return None
+
+
+def reset_peak_memory():
+    """Start a new peak memory measurement. Returns the memory_metric that _peak_memory_mb() will report."""
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        return 'cuda_max_allocated'
+    return 'peak_rss' if _reset_peak_rss() else 'process_max_rss'
+
+
+def _peak_memory_mb(memory_metric):
+    """Peak memory since the last reset_peak_memory() (see memory_metric in the module docstring)"""
+    if memory_metric == 'cuda_max_allocated':
+        import torch
+
+        return round(torch.cuda.max_memory_allocated() / 2 ** 20, 1)
+    if memory_metric == 'peak_rss':
+        return _peak_rss_mb()
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+
+class ProfileSink:
+    """Appends records to a JSONL file, or to a CSV file if the path ends with .csv"""
+
+    def __init__(self, path, fields=STEP_FIELDS):
+        self.path = path
+        self.fields = fields
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, record):
+        if self.path.endswith('.csv'):
+            write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.fields, extrasaction='ignore')
+                if write_header:
+                    writer.writeheader()
+                writer.writerow(record)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+class TrainingProfilerCallback(TrainerCallback):
+    """Records the phase times, tokens and peak memory of every optimizer step (see the module docstring)"""
+
+    def __init__(self, output_path="outputs/train_profile.jsonl", run_name=None, run_config=None, sync_cuda=True):
+        self.sink = ProfileSink(output_path)
+        self.summary_path = os.path.splitext(output_path)[0] + ".summary.jsonl"
+        self.run_name = run_name
+        self.run_config = run_config or {}
+        self.sync_cuda = sync_cuda
+
+        self.records = []
+        self.current = None
+        self.mark = None
+        self.hook_handles = []
+        self.memory_metric = None
+
+    def _elapsed(self):
+        # Seconds since the last phase boundary, and move the boundary to now
+        if self.sync_cuda:
+            import torch
+
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        now = time.perf_counter()
+        elapsed = now - self.mark
+        self.mark = now
+        return elapsed
+
+    def _add(self, phase):
+        if self.current is not None:
+            self.current[f'{phase}_seconds'] += self._elapsed()
+
+    def _forward_pre_hook(self, module, args, kwargs):
+        if self.current is None or not module.training:
+            return
+        self._add('data')
+        real_tokens, padded_tokens = count_batch_tokens(kwargs)
+        self.current['micro_batches'] += 1
+        self.current['real_tokens'] += real_tokens
+        self.current['padded_tokens'] += padded_tokens
+
+    def _forward_hook(self, module, args, kwargs, output):
+        if self.current is not None and module.training:
+            self._add('forward')
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self.run_name = self.run_name or args.run_name
+        self.hook_handles = [
+            model.register_forward_pre_hook(self._forward_pre_hook, with_kwargs=True),
+            model.register_forward_hook(self._forward_hook, with_kwargs=True),
+        ]
+        self.records = []
+        self.memory_metric = reset_peak_memory()
+        self.mark = time.perf_counter()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        # Time since the end of the previous step: waiting for the batches, logging and saving
+        data_seconds = self._elapsed()
+        self.current = {field: 0 for field in STEP_FIELDS}
+        self.current['run'] = self.run_name
+        self.current['data_seconds'] = data_seconds
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self._add('backward')
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._add('backward')
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self._add('optimizer')
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.current is None:
+            return
+        self._add('optimizer')
+
+        record = self.current
+        self.current = None
+        record['step'] = state.global_step
+        record['step_seconds'] = sum(record[f'{phase}_seconds'] for phase in PHASES)
+        for phase in PHASES:
+            record[f'{phase}_seconds'] = round(record[f'{phase}_seconds'], 4)
+        record['padding_ratio'] = round(1 - record['real_tokens'] / max(record['padded_tokens'], 1), 4)
+        record['tokens_per_sec'] = round(record['real_tokens'] / max(record['step_seconds'], 1e-9), 1)
+        record['step_seconds'] = round(record['step_seconds'], 4)
+        record['peak_memory_mb'] = _peak_memory_mb(self.memory_metric)
+        record['memory_metric'] = self.memory_metric
+        reset_peak_memory()
+
+        self.records.append(record)
+        self.sink.write(record)
+        # Don't count the time spent writing the record in the next step
+        self._elapsed()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+
+        summary = self.summary()
+        if summary is None:
+            return
+        with open(self.summary_path, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+        print_profile_summary(summary)
+
+    def summary(self):
+        """Means over the steps (the first step is left out if there are others, as it includes the warmup)"""
+        records = self.records[1:] if len(self.records) > 1 else self.records
+        if not records:
+            return None
+
+        total_seconds = sum(record['step_seconds'] for record in records)
+        real_tokens = sum(record['real_tokens'] for record in records)
+        padded_tokens = sum(record['padded_tokens'] for record in records)
+        summary = {
+            'run': self.run_name,
+            **self.run_config,
+            'steps': len(records),
+            'mean_step_seconds': round(total_seconds / len(records), 4),
+            'tokens_per_sec': round(real_tokens / max(total_seconds, 1e-9), 1),
+            'padding_ratio': round(1 - real_tokens / max(padded_tokens, 1), 4),
+            'peak_memory_mb': max(record['peak_memory_mb'] for record in records),
+            'memory_metric': self.memory_metric,
+        }
+        for phase in PHASES:
+            phase_seconds = sum(record[f'{phase}_seconds'] for record in records)
+            summary[f'{phase}_fraction'] = round(phase_seconds / max(total_seconds, 1e-9), 3)
+        return summary
+
+
+def print_profile_summary(summary):
+    print(f"\nTraining profile of run {summary['run']}: {summary['steps']} steps")
+    print(f"...Mean step: {summary['mean_step_seconds']}s, real tokens/sec: {summary['tokens_per_sec']}, "
+          f"padding: {100 * summary['padding_ratio']:.1f}%, "
+          f"peak memory: {summary['peak_memory_mb']} MB ({summary['memory_metric']})")
+    print("...Time per phase: " + ", ".join(f"{phase}: {100 * summary[f'{phase}_fraction']:.1f}%" for phase in PHASES))
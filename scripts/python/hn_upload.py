@@ -0,0 +1,159 @@
+"""
+Resumable, concurrent upload of exported dataset files to a dataset repo (see hn_hub.py)
+
+upload_dataset_files() uploads the shards in a bounded pool of threads, each upload retried with exponential backoff
+on network and server errors. The shard contents are uploaded first ("pre-uploaded": stored in the repo but not yet
+visible), and all the files are published at the end in one commit, so readers never see a half uploaded dataset.
+
+Shards are identified by the sha256 of their content:
+- shards that are already in the repo with the same content are not uploaded again
+- every shard that is pre-uploaded is recorded in <export_dir>/upload_progress.json. If the run is interrupted,
+  the next run skips the shards recorded there and only uploads the rest. The file is removed after the commit.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hn_hub import file_sha256
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+PROGRESS_FILE = "upload_progress.json"
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+# HTTP status codes that are worth retrying: timeout, rate limit and server errors
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Network errors that are worth retrying. The Hub client (huggingface_hub) makes its requests with requests.
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError)
+if requests is not None:
+    RETRYABLE_ERRORS += (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def is_retryable_error(e):
+    """True for errors that can go away on retry (connection errors, timeouts, 429 and 5xx responses)"""
+    response = getattr(e, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    # Other OSErrors (eg. disk full, too many open files, a file that can't be read) fail the same way on every attempt
+    return isinstance(e, RETRYABLE_ERRORS)
+
+
+def retry_with_backoff(func, description, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                       max_delay=DEFAULT_MAX_DELAY):
+    """Call func() until it succeeds, waiting base_delay * 2^attempt (with jitter) between attempts"""
+    for attempt in range(max_attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not is_retryable_error(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"...{description} failed (attempt {attempt + 1}/{max_attempts}): {e}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class UploadProgress:
+    """The shards (path -> sha256) already pre-uploaded to a repo, saved to disk after every shard"""
+
+    def __init__(self, export_dir, repo_name):
+        self.path = os.path.join(export_dir, PROGRESS_FILE)
+        self.repo_name = repo_name
+        self.lock = threading.Lock()
+        self.uploaded = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            # Progress of an upload to another repo is of no use
+            if saved.get('repo') == repo_name:
+                self.uploaded = saved['uploaded']
+
+    def is_uploaded(self, path_in_repo, sha256):
+        return self.uploaded.get(path_in_repo) == sha256
+
+    def mark_uploaded(self, path_in_repo, sha256):
+        with self.lock:
+            self.uploaded[path_in_repo] = sha256
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'repo': self.repo_name, 'uploaded': self.uploaded}, f)
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def upload_dataset_files(export_dir, hub_repo, paths_in_repo, delete_paths=(), commit_message="Upload dataset files",
+                         max_workers=DEFAULT_MAX_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                         base_delay=DEFAULT_BASE_DELAY):
+    """
+    Upload <export_dir>/<path> for each of the paths to hub_repo and delete the delete_paths, in one commit.
+    Files that are in the repo with the same content are skipped. Returns the list of paths that were committed.
+    """
+    def retry(func, description):
+        return retry_with_backoff(func, description, max_attempts=max_attempts, base_delay=base_delay)
+
+    remote_hashes = retry(lambda: hub_repo.file_hashes(), f"Listing files of {hub_repo}")
+    progress = UploadProgress(export_dir, str(hub_repo))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        local_hashes = dict(zip(paths_in_repo, executor.map(
+            lambda path: file_sha256(os.path.join(export_dir, path)), paths_in_repo)))
+
+        changed_paths = [path for path in paths_in_repo if remote_hashes.get(path) != local_hashes[path]]
+        pending_paths = [path for path in changed_paths if not progress.is_uploaded(path, local_hashes[path])]
+        print(f"...Uploading {len(pending_paths)} files to {hub_repo} with {max_workers} threads. "
+              f"Unchanged in the repo: {len(paths_in_repo) - len(changed_paths)}, "
+              f"already uploaded by a previous run: {len(changed_paths) - len(pending_paths)}")
+
+        def preupload(path):
+            retry(lambda: hub_repo.preupload_file(export_dir, path), f"Upload of {path}")
+            progress.mark_uploaded(path, local_hashes[path])
+            print(f"...Uploaded {path}")
+
+        # list() re-raises the first error, after the other uploads have finished (and were recorded)
+        list(executor.map(preupload, pending_paths))
+
+    delete_paths = [path for path in delete_paths if path not in local_hashes]
+    if not changed_paths and not delete_paths:
+        print(f"...All files are already in {hub_repo}. Nothing to commit.")
+        progress.clear()
+        return []
+
+    retry(lambda: hub_repo.upload_files(export_dir, changed_paths, delete_paths=delete_paths,
+                                        commit_message=commit_message),
+          f"Commit to {hub_repo}")
+    progress.clear()
+    print(f"...Committed {len(changed_paths)} files and {len(delete_paths)} deletions to {hub_repo}")
+    return changed_paths
+
+
+def upload_export_dir(export_dir, hub_repo, commit_message="Upload dataset shards exported from DB",
+                      max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Upload a full export (dataset card, manifest and shards). The shards in the repo that are not part of the
+    export are deleted in the same commit, so the repo has only the new data files.
+    """
+    # dictionaries.parquet: the compression dictionaries of a compressed export (see hn_compress.py)
+    paths_in_repo = [name for name in ["README.md", "manifest.json", "dictionaries.parquet"]
+                     if os.path.exists(os.path.join(export_dir, name))]
+    data_dir = os.path.join(export_dir, "data")
+    paths_in_repo += [f"data/{name}" for name in sorted(os.listdir(data_dir)) if name.endswith(".parquet")]
+
+    remote_paths = retry_with_backoff(lambda: hub_repo.list_files(), f"Listing files of {hub_repo}")
+    delete_paths = [path for path in remote_paths if path.startswith("data/") and path.endswith(".parquet")]
+    return upload_dataset_files(export_dir, hub_repo, paths_in_repo, delete_paths=delete_paths,
+                                commit_message=commit_message, max_workers=max_workers)
@@ -1,8 +1,16 @@
 import os
-from datasets import Dataset, DatasetDict, Features, Value, load_dataset
+from datasets import Dataset, DatasetDict, Features, Value
 from getpass import getpass
 from dotenv import load_dotenv
 from huggingface_hub import HfApi, create_repo, delete_repo
+from hn_compress import DEFAULT_STORE_PATH, build_compressed_store, export_compressed_dataset
+from hn_export import (export_dataset_from_db, export_dataset_parallel, export_incremental_from_db, make_hash_split_fn,
+                       split_for_post_id, write_dataset_card)
+from hn_hub import HfHubRepo
+from hn_dataset_cache import load_cached_dataset
+from hn_post_index import select_posts
+from hn_upload import upload_export_dir
+from hn_db import DB_PATH, db_file_state, iter_post_pages
 
 # Load environment variables from .env file
 load_dotenv()
@@ -87,10 +95,12 @@ def initialize_hface_dataset():
     except Exception as e:
         raise Exception(f"Error intializing dataset. Exception: \n---(exc_start)---\n{e}\n---(exc_end)---")
 
-def load_hface_dataset():
+def load_hface_dataset(revision=None, offline=None):
     try:
+        # Load all splits once through the local cache (see hn_dataset_cache.py). The repo is resolved only once and
+        #  a revision that was loaded before is memory-mapped from disk instead of downloaded again.
         print(f"...Loading dataset '{HF_REPO_NAME}' ...")
-        dataset_dict = load_dataset(HF_REPO_NAME, token=os.environ['HF_TOKEN'])
+        dataset_dict = load_cached_dataset(HF_REPO_NAME, revision=revision, offline=offline, token=os.environ['HF_TOKEN'])
         print(f"...Successfully loaded dataset")
 
         splits = dataset_dict.keys()
@@ -98,7 +108,7 @@ def load_hface_dataset():
 
         for split in splits:
             print(f"\n...Split '{split}', size: {len(dataset_dict[split])}.")
-            split_dataset = load_dataset(HF_REPO_NAME, split=split, token=os.environ['HF_TOKEN'])
+            split_dataset = dataset_dict[split]
             if len(split_dataset) > 0:
                 print(f"...  First row:"
                       f"\n      post_id: {split_dataset[0]['post_id']}"
@@ -111,14 +121,15 @@ def load_hface_dataset():
         return dataset_dict
 
     except Exception as e:
-        raise Exception(f"Error loading dataset {HF_REPO_NAME}. Exception thrown by HF API load_dataset(): \n\t---(exc_start)---\n\t{e}\n\t---(exc_end)---")
+        raise Exception(f"Error loading dataset {HF_REPO_NAME}. Exception thrown by load_cached_dataset(): \n\t---(exc_start)---\n\t{e}\n\t---(exc_end)---")
 
 def get_datarow(dataset, post_id, split = None):
     # Load the data row for the given post_id from the given split. If split is not given, use train
     if split is None:
         split = "train"
 
-    datarow_000 = dataset[split].filter(lambda x: x['post_id'] == post_id)
+    # Look up the row through the post_id index of the split (see hn_post_index.py) instead of scanning all rows
+    datarow_000 = select_posts(dataset[split], [post_id])
     if len(datarow_000) == 0:
         print(f"...No row for post_id: {post_id}, split: {split}")
     else :
@@ -174,26 +185,37 @@ def upload_sample_set_from_db():
     print(f"Sample post Ids for test: {sample_test_post_ids}")
     upload_dataset_from_db(sample_train_val_post_ids, sample_test_post_ids)
 
-def upload_dataset_from_db(train_val_post_ids, test_post_ids):
+def posts_from_db(post_ids, db_state=None):
+    # Generator of the rows of the given posts, read page by page through the shared DB connection (see hn_db.py).
+    #  The post ids are joined from a temp table instead of an 'in (...)' list in the SQL text, so the query is the same
+    #  for any number of ids and doesn't hit the SQLite limits on large id sets.
+    #  db_state is not used here. It's only in gen_kwargs to be part of the dataset fingerprint (see dataset_from_db()).
+    columns_sql = '''
+        cast(post_id as text) as post_id,
+        '---- Post Title: \n' || post_title || '\n----- Comments: \n' || post_formatted_comments as input_comment,
+        llm_response_summary as output_summary
+    '''
+    for page in iter_post_pages(columns_sql, DB_PATH, post_ids=post_ids):
+        yield from page
+
+def dataset_from_db(post_ids):
+    # The dataset is cached by the HF datasets library under a fingerprint of gen_kwargs only, not of the rows it
+    #  yields. With the post ids and the state of the DB file (see hn_db.py) in gen_kwargs, the cached result is reused
+    #  only for the same ids and an unchanged DB: after any write to the DB (eg. a new llm_response_summary), the
+    #  rows are read again.
+    gen_kwargs = {'post_ids': sorted(int(post_id) for post_id in post_ids), 'db_state': db_file_state(DB_PATH)}
+    return Dataset.from_generator(posts_from_db, gen_kwargs=gen_kwargs)
+
+def upload_dataset_from_db(train_val_post_ids, test_post_ids, hub_repo=None):
+    # With hub_repo (eg. a LocalHubRepo from hn_hub.py), the splits are uploaded as Parquet shards to that repo instead
+    #  of pushed to HF_REPO_NAME, so this can run offline
 
     print("\nPreparing dataset to upload to HF...")
 
     if len(train_val_post_ids) > 0:
         # create train+val dataset from the train post ids
-        train_val_post_ids_str = ','.join(str(post_id) for post_id in train_val_post_ids)
-        query = f'''
-            select cast(post_id as text) as post_id,
-                   '---- Post Title: \n' || post_title || '\n----- Comments: \n' || post_formatted_comments as input_comment,
-                   llm_response_summary as output_summary
-            from posts_comments
-            where post_id in ({train_val_post_ids_str})
-        '''
-        # print(f"query for train and val: {query}")
-
-        uri = "sqlite:///../data/hn_posts.db"
-
-        print(f"Executing Dataset.from_sql() with train_val_post_ids_str: {train_val_post_ids_str}")
-        train_val_dataset = Dataset.from_sql(query, uri)
+        print(f"Executing Dataset.from_generator(posts_from_db) with train_val_post_ids: {train_val_post_ids}")
+        train_val_dataset = dataset_from_db(train_val_post_ids)
         print(f"Dataset from sqlite query (for training and validation): {train_val_dataset}")
 
         # Verify that data was loaded into the dataset and it conforms to the schema
@@ -205,12 +227,13 @@ def upload_dataset_from_db(train_val_post_ids, test_post_ids):
             if feature not in train_val_dataset.features:
                 raise ValueError(f"Missing expected feature: {feature}")
 
-        # Split the remaining data 80-20 for train/validation.
-        # Note: datasets library's test split is intended to be used as validation set.
+        # Split the remaining data 80-20 for train/validation by the hash of the post id (see hn_export.py).
+        #  The split of a post depends only on its id, so adding posts doesn't move the existing posts to another split.
         if(len(train_val_dataset) > 1):
-            split_dataset = train_val_dataset.train_test_split(test_size=0.2, seed=42)
-            train_dataset = split_dataset['train']
-            validation_dataset = split_dataset['test']
+            is_validation = [split_for_post_id(post_id, validation_percent=20, test_percent=0) == 'validation'
+                             for post_id in train_val_dataset['post_id']]
+            train_dataset = train_val_dataset.select([i for i, flag in enumerate(is_validation) if not flag])
+            validation_dataset = train_val_dataset.select([i for i, flag in enumerate(is_validation) if flag])
         else:
             # If there is only one post, we cannot split it into train and validation sets.
             #  So use the single-element list for training set and leave validation set as None
@@ -223,16 +246,8 @@ def upload_dataset_from_db(train_val_post_ids, test_post_ids):
 
     # create test dataset from the test post ids
     if(len(test_post_ids) > 0):
-        test_post_ids_str = ','.join(str(post_id) for post_id in test_post_ids)
-        query_test_data = f'''
-                select cast(post_id as text) as post_id,
-                       '---- Post Title: \n' || post_title || '\n----- Comments: \n' || post_formatted_comments as input_comment,
-                       llm_response_summary as output_summary
-                from posts_comments
-                where post_id in ({test_post_ids_str})
-            '''
-        print(f"Executing Dataset.from_sql() with test_post_ids_str: {test_post_ids_str}")
-        test_dataset = Dataset.from_sql(query_test_data, uri)
+        print(f"Executing Dataset.from_generator(posts_from_db) with test_post_ids: {test_post_ids}")
+        test_dataset = dataset_from_db(test_post_ids)
     else:
         # If there are no test post ids, create an empty dataset
         print(f"No test post ids provided. test_post_ids is empty. Creating empty test dataset")
@@ -279,6 +294,10 @@ def upload_dataset_from_db(train_val_post_ids, test_post_ids):
     else:
         print("  Test dataset: empty")
 
+    if hub_repo is not None:
+        upload_dataset_dict(dataset_dict, hub_repo)
+        return
+
     # Upload the dataset to HF
     try:
         print(f"Uploading to HF repo: {HF_REPO_NAME} ...")
@@ -293,6 +312,87 @@ def upload_dataset_from_db(train_val_post_ids, test_post_ids):
     except Exception as e:
         raise Exception(f"Error uploading dataset: Exception thrown by HF API push_to_hub() \n\t---(exc_start)---\n\t{e}\n\t---(exc_end)---")
 
+def upload_dataset_dict(dataset_dict, hub_repo, export_dir="export-sample"):
+    # Write every split to one Parquet shard (data/<split>-00000.parquet) with a dataset card, and upload the export
+    #  dir to hub_repo like a full export (see hn_upload.py)
+    data_dir = os.path.join(export_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    for file_name in os.listdir(data_dir):
+        if file_name.endswith(".parquet"):
+            os.remove(os.path.join(data_dir, file_name))
+    for split, split_dataset in dataset_dict.items():
+        split_dataset.to_parquet(os.path.join(data_dir, f"{split}-00000.parquet"))
+    write_dataset_card(export_dir, list(dataset_dict.keys()))
+
+    print(f"Uploading {export_dir} to {hub_repo} ...")
+    upload_export_dir(export_dir, hub_repo)
+
+def upload_full_dataset_from_db(test_post_ids, export_dir="export", num_workers=1):
+    # Export all the processed posts in the DB to Parquet shards on local disk and upload the shards to HF.
+    #  Unlike upload_dataset_from_db(), the rows are streamed from the DB page by page, so the memory used
+    #  is constant and does not grow with the number of posts in the table.
+    #  With num_workers > 1 (or None for all CPUs), post_id ranges are exported in parallel worker processes.
+    print(f"\nExporting all processed posts from DB to {export_dir} ...")
+    if num_workers == 1:
+        split_sizes = export_dataset_from_db(export_dir, split_fn=make_hash_split_fn(test_post_ids))
+    else:
+        split_sizes = export_dataset_parallel(export_dir, test_post_ids=test_post_ids, num_workers=num_workers)
+    if not split_sizes:
+        print("All datasets are empty. No data to upload to HF")
+        return
+
+    upload_exported_dataset(export_dir)
+
+def compressed_repo_name(repo_name):
+    # Repo of the compressed export of repo_name. Only the streaming input (see hn_streaming.py) can read its shards,
+    #  so they must not replace the plain shards that load_hface_dataset(), get_datarow() and the training read.
+    return f"{repo_name}-compressed"
+
+def upload_compressed_dataset_from_db(test_post_ids, export_dir="export-compressed", retrain=False):
+    # Same as upload_full_dataset_from_db(), but from the dictionary-compressed store (see hn_compress.py): the posts
+    #  are compressed into the store first, and the comments and summaries go to the shards still compressed.
+    #  The dictionaries are uploaded with the shards (dictionaries.parquet), to a repo of its own (see
+    #  compressed_repo_name()). HF_REPO_NAME is not changed.
+    print(f"\nCompressing all posts from DB to {DEFAULT_STORE_PATH} ...")
+    build_compressed_store(DB_PATH, DEFAULT_STORE_PATH, retrain=retrain)
+    print(f"\nExporting all processed posts from the compressed store to {export_dir} ...")
+    split_sizes = export_compressed_dataset(export_dir, DEFAULT_STORE_PATH, split_fn=make_hash_split_fn(test_post_ids))
+    if not split_sizes:
+        print("All datasets are empty. No data to upload to HF")
+        return
+
+    repo_name = compressed_repo_name(HF_REPO_NAME)
+    create_repo(repo_id=repo_name, repo_type="dataset", private=False, exist_ok=True, token=os.environ['HF_TOKEN'])
+    upload_exported_dataset(export_dir, repo_name)
+
+def upload_exported_dataset(export_dir, repo_name=None):
+    # Upload the shards, dataset card and manifest written by export_dataset_from_db().
+    #  The shards of the previous upload are deleted in the same commit, so the repo has only the new data files.
+    #  Shards are uploaded concurrently with retries. If the upload is interrupted, running it again uploads only
+    #  the shards that were not uploaded yet (see hn_upload.py).
+    repo_name = repo_name or HF_REPO_NAME
+    try:
+        print(f"Uploading {export_dir} to HF repo: {repo_name} ...")
+
+        hub_repo = HfHubRepo(repo_name, token=os.environ['HF_TOKEN'])
+        upload_export_dir(export_dir, hub_repo)
+
+        print(f"Successfully uploaded dataset to HF repo: {repo_name}")
+    except Exception as e:
+        raise Exception(f"Error uploading dataset: \n\t---(exc_start)---\n\t{e}\n\t---(exc_end)---")
+
+def upload_incremental_dataset_from_db(test_post_ids, export_dir="export"):
+    # Upload only the posts that are new or changed since the last export (full or incremental).
+    #  The manifest.json in the HF repo has the watermark and the content hash of every row that was uploaded before,
+    #  so only the new shards (and the old shards that had a changed row) are uploaded.
+    print(f"\nExporting new and changed posts from DB to {export_dir} ...")
+    try:
+        hub_repo = HfHubRepo(HF_REPO_NAME, token=os.environ['HF_TOKEN'])
+        uploaded_paths = export_incremental_from_db(export_dir, hub_repo, split_fn=make_hash_split_fn(test_post_ids))
+        print(f"Successfully uploaded {len(uploaded_paths)} files to HF repo: {HF_REPO_NAME}")
+    except Exception as e:
+        raise Exception(f"Error uploading incremental dataset: \n\t---(exc_start)---\n\t{e}\n\t---(exc_end)---")
+
 def empty_hface_dataset(dataset_dict):
     # create a new dataset with the same features but with empty lists - one each for train, val and test
     features = dataset_dict['train'].features
@@ -379,6 +479,16 @@ if __name__ == "__main__":
         # print(f"\nLoading the full dataset from {HF_REPO_NAME} ...")
         # upload_dataset_from_db()
 
+        # print(f"\nExporting and uploading all processed posts to {HF_REPO_NAME} ...")
+        # upload_full_dataset_from_db(test_post_ids=[42866572])
+        # upload_full_dataset_from_db(test_post_ids=[42866572], num_workers=None)
+
+        # print(f"\nExporting and uploading all processed posts, compressed, to {compressed_repo_name(HF_REPO_NAME)}")
+        # upload_compressed_dataset_from_db(test_post_ids=[42866572])
+
+        # print(f"\nUploading new and changed posts to {HF_REPO_NAME} ...")
+        # upload_incremental_dataset_from_db(test_post_ids=[42866572])
+
         print(f"\nChecking if dataset is valid: {HF_REPO_NAME} ...")
         post_dataset_dict = load_hface_dataset()
 